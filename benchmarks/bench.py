@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""Benchmarks for the audio analysis and motion hot paths.
+
+Runs against the simulated bird with its audio output not pacing itself, so
+no hardware is needed and a clip plays as fast as the CPU allows. Compares
+against the numbers in baselines.json (kept per machine type, since a Pi and
+a laptop have nothing in common) and exits non-zero if anything got slower
+than the tolerance.
+
+    python benchmarks/bench.py              # run, compare with the baselines
+    python benchmarks/bench.py --save       # run, store as the new baselines
+    python benchmarks/bench.py --sweep      # also sweep CHUNK sizes
+
+The sweep plays the whole sounds/ corpus at each chunk size with the amplitude
+worked out live, and reports CPU per second of audio against how finely the
+beak can follow the audio (one decision per chunk).
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from squawker import backend
+backend.use('sim')
+from squawker import sim, motors, sound, actions, envelope, soundbank, pulse, mixer, audioengine, syllables
+from squawker.wavfile import WavFile
+
+BASELINES = os.path.join(HERE, "baselines.json")
+SOUNDS = os.path.join(ROOT, "sounds")
+CHUNKS = (256, 512, 1024, 2048, 4096, 8192)
+# Slower than the baseline by more than this counts as a regression. Sub-microsecond
+# timings still wander by a third between runs, even on a quiet machine
+TOLERANCE = 0.5
+
+
+def best_of(fn, number, repeat = 7):
+    """Microseconds per call, best of a few runs to keep the noise down."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        took = (time.perf_counter() - start) / number * 1e6
+        best = took if best is None else min(best, took)
+    return best
+
+
+@contextlib.contextmanager
+def quiet():
+    """Everything in the package prints, which would swamp the timings."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+
+class _NoWait(pulse.PulseEngine):
+    def _wait_until(self, deadline, cancelled):
+        return True
+
+
+@contextlib.contextmanager
+def no_sleep():
+    """Skips the motor run times and sleeps, leaving just the code around them."""
+    saved = actions.sleep, pulse._engine
+    actions.sleep = lambda seconds: None
+    pulse._engine = _NoWait(priority=None)
+    try:
+        yield
+    finally:
+        actions.sleep, pulse._engine = saved
+
+
+def corpus():
+    files = sorted(os.path.join(SOUNDS, f) for f in os.listdir(SOUNDS) if f.lower().endswith('.wav'))
+    seconds = 0.0
+    for path in files:
+        with WavFile(path) as wf:
+            seconds += wf.duration
+    return files, seconds
+
+
+def play_all(squawk, files):
+    """Plays every file, returns CPU seconds used."""
+    start = time.process_time()
+    with quiet():
+        for path in files:
+            squawk.run(path)
+    return time.process_time() - start
+
+
+def bench_audio(beak, body, files, seconds):
+    results = {}
+    squawk = sound.Squawk(beak, body)
+    with WavFile(files[0]) as wf:
+        view = next(wf.chunks(squawk.CHUNK))
+        levels = wf.levels(view)
+        with quiet():
+            results["squawk_io_us"] = best_of(lambda: squawk._squawk_io(levels), 2000)
+            results["getwavefmt_us"] = best_of(lambda: squawk._getwavefmt(wf), 2000)
+
+    # Amplitude worked out as it plays
+    results["run_live_cpu_ms_per_audio_s"] = play_all(squawk, files) / seconds * 1000
+
+    # Decisions looked up from the envelope index, kept in memory and never saved
+    index = envelope.EnvelopeIndex(os.devnull)
+    for path in files:
+        index.add(path)
+    cached = sound.Squawk(beak, body, index)
+    cached.lookahead = False
+    results["run_cached_cpu_ms_per_audio_s"] = play_all(cached, files) / seconds * 1000
+
+    # The offline syllable analysis, for every clip
+    start = time.process_time()
+    for path in files:
+        with WavFile(path) as wf:
+            syllables.track(wf.levels(wf.frames), wf.rate)
+    results["syllables_cpu_ms_per_audio_s"] = (time.process_time() - start) / seconds * 1000
+
+    # Starting a clip out of a bank against opening the wav file
+    with tempfile.TemporaryDirectory() as tmp:
+        with quiet():
+            bank = soundbank.SoundBank(soundbank.build(SOUNDS, os.path.join(tmp, "sounds.bank")))
+        name = os.path.basename(files[0])
+        def open_wav():
+            with WavFile(files[0]):
+                pass
+        results["open_wav_us"] = best_of(open_wav, 2000)
+        results["open_bank_clip_us"] = best_of(lambda: bank.clip(name), 2000)
+        bank.close()
+
+    # A block of ambience under two loud voices, ducking and saturating
+    mix = mixer.Mixer(audioengine.AudioEngine())
+    mix._buffers()
+    for path, voice in ((files[0], False), (files[1], True), (files[2], True)):
+        mix.sources.append(mixer.ClipSource(WavFile(path), mix.channels, mix.rate, 2.0, loop=True, voice=voice))
+        mix.sources[-1]._start(mix.rate)
+    results["mix_block_us"] = best_of(mix.mix, 500)
+    return results
+
+
+def bench_motion(body):
+    results = {}
+    rng = random.Random(1)
+    pairs = [(rng.randrange(222), rng.randrange(222)) for _ in range(100)]
+    def moveparams():
+        for current, dst in pairs:
+            body._moveparams(current, dst)
+    results["moveparams_us"] = best_of(moveparams, 500) / len(pairs)
+
+    names = list(actions.actionmap)
+    def shortestpath():
+        for name in names:
+            actions.shortestpath(body, name)
+    results["shortestpath_us"] = best_of(shortestpath, 2000) / len(names)
+
+    with quiet(), no_sleep():
+        results["run_action_us"] = best_of(lambda: actions.run_action(body, rng.choice(names)), 200)
+        results["plan_4_actions_us"] = best_of(lambda: actions.plan(body, names), 20)
+    body.body_motor.throttle = 0
+    return results
+
+
+def sweep(beak, body, files, seconds):
+    """CPU per second of audio at each chunk size, amplitude worked out live."""
+    squawk = sound.Squawk(beak, body)
+    with WavFile(files[0]) as wf:
+        rate = wf.rate
+    rows = []
+    for chunk in CHUNKS:
+        squawk.CHUNK = chunk
+        cpu = play_all(squawk, files) / seconds
+        rows.append((chunk, chunk / rate * 1000, cpu * 1000))
+    print(f"\n{'chunk':>6} {'sync ms':>8} {'cpu ms/s':>9} {'% core':>7}")
+    for chunk, resolution, cpu in rows:
+        print(f"{chunk:6d} {resolution:8.1f} {cpu:9.2f} {cpu / 10:7.2f}")
+    return {f"sweep_{chunk}_cpu_ms_per_audio_s": cpu for chunk, _, cpu in rows}
+
+
+def compare(results, baseline, tolerance):
+    """Prints each result next to its baseline.
+
+    Returns:
+        list: names of the results that got slower than the tolerance
+    """
+    slower = []
+    for name, value in sorted(results.items()):
+        base = baseline.get(name)
+        if base is None:
+            print(f"{name:36} {value:10.2f}   (no baseline)")
+            continue
+        change = (value - base) / base if base else 0.0
+        flag = ""
+        if change > tolerance:
+            flag = "  <-- slower"
+            slower.append(name)
+        print(f"{name:36} {value:10.2f}   baseline {base:10.2f}  {change:+7.1%}{flag}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the audio and motion hot paths on the sim.')
+    parser.add_argument('--save', action='store_true', help="Store the results as the baselines.")
+    parser.add_argument('--sweep', action='store_true', help="Also sweep the chunk size.")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help="Fraction slower than the baseline that counts as a regression.")
+    args = parser.parse_args()
+
+    # A null audio sink: the sim's stream throws the samples away without pacing
+    sim.pyaudio.realtime = False
+    with quiet():
+        beak = motors.EyeBeakController()
+        body = motors.BodyController()
+    files, seconds = corpus()
+    print(f"{len(files)} clips, {seconds:.1f}s of audio, on {platform.machine()}")
+
+    results = {}
+    results.update(bench_audio(beak, body, files, seconds))
+    results.update(bench_motion(body))
+    if args.sweep:
+        results.update(sweep(beak, body, files, seconds))
+    print()
+
+    machine = platform.machine()
+    try:
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+    except (OSError, ValueError):
+        baselines = {}
+    slower = compare(results, baselines.get(machine, {}), args.tolerance)
+
+    if args.save:
+        baselines.setdefault(machine, {}).update(results)
+        with open(BASELINES, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"\nSaved baselines for {machine} to {BASELINES}")
+    elif slower:
+        print(f"\n{len(slower)} benchmarks got slower than {args.tolerance:.0%}: {', '.join(slower)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+"""Runs a whole flock of Squawkers from one host.
+
+Each bird gets its own process with its own MotorKit (by I2C address) and
+GPIO pins, running the same show as run.py. The clips and their analysis get
+decoded once into shared memory (see squawker/sharedbank.py) and every bird
+plays out of that, so memory goes up with the number of different clips
+rather than birds x clips.
+
+The supervisor doesn't do any bird stuff itself, it just keeps an eye on the
+birds. Each one bumps a heartbeat from its event loop, and a bird that dies or
+stops beating gets killed and started again on its own, without the others
+noticing.
+
+The birds come from a JSON file:
+
+    {
+        "backend": "pi",
+        "birds": [
+            {"name": "polly", "address": "0x60", "sounddir": "sounds",
+             "specialdir": "specialsounds", "trigger": "file:/tmp/rfid-polly",
+             "pins": {"left_eye": 12, "right_eye": 5, "body": 6}},
+            {"name": "pete", "address": "0x61", "sounddir": "sounds",
+             "trigger": "file:/tmp/rfid-pete",
+             "pins": {"left_eye": 16, "right_eye": 20, "body": 21}}
+        ]
+    }
+"""
+
+import argparse, asyncio, json, os, sys, time
+import multiprocessing
+from signal import signal, SIGINT, SIGTERM
+import run
+from squawker import backend, motors, triggers, sharedbank
+from squawker.logger import logger
+
+# Seconds between heartbeats from each bird
+HEARTBEAT = 1
+# A bird that hasn't beaten for this long is stuck
+STALL = 10
+# Extra time a new bird gets to home its motors before it has to beat
+GRACE = 20
+# Seconds to wait before restarting a bird, doubling each time it fails
+# quickly, up to RESTART_MAX
+RESTART_MIN = 1
+RESTART_MAX = 60
+# A bird that runs this long before failing starts the backoff over
+HEALTHY = 60
+
+DEFAULT_PINS = {"left_eye": 12, "right_eye": 5, "body": 6}
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Drive several birds from one host.')
+    parser.add_argument('config', type=str, help="JSON file listing the birds.")
+    parser.add_argument('--backend', choices=sorted(backend.BACKENDS), default=None,
+                        help="Overrides the backend in the config file.")
+    return parser.parse_args()
+
+
+def load_config(path):
+    """Reads the fleet config, filling in the defaults.
+
+    Returns:
+        tuple: (backend name, list of bird dicts)
+
+    Raises:
+        ValueError: something's missing or doubled up
+    """
+    with open(path) as f:
+        config = json.load(f)
+    birds = []
+    base = os.path.dirname(os.path.abspath(path))
+    for i, bird in enumerate(config.get("birds", [])):
+        name = bird.get("name", f"bird{i}")
+        if "sounddir" not in bird:
+            raise ValueError(f"{name} needs a sounddir")
+        address = bird.get("address", 0x60)
+        # Relative directories are relative to the config file
+        sounddir = os.path.join(base, bird["sounddir"])
+        birds.append({
+            "name": name,
+            "address": int(address, 0) if isinstance(address, str) else address,
+            "pins": dict(DEFAULT_PINS, **bird.get("pins", {})),
+            "sounddir": sounddir,
+            "specialdir": os.path.join(base, bird.get("specialdir", bird["sounddir"])),
+            "trigger": bird.get("trigger", f"file:/tmp/rfid-{name}"),
+            "metrics_listen": bird.get("metrics_listen"),
+        })
+    if not birds:
+        raise ValueError(f"No birds in {path}")
+    for key in ("name", "address"):
+        values = [b[key] for b in birds]
+        if len(set(values)) != len(values):
+            raise ValueError(f"Two birds have the same {key}")
+    return config.get("backend", backend.current()), birds
+
+
+class _Prefixed:
+    """Puts the bird's name in front of every line it prints."""
+    def __init__(self, stream, name) -> None:
+        self.stream = stream
+        self.prefix = f"[{name}] "
+        self.fresh = True
+
+    def write(self, text):
+        out = []
+        for line in text.splitlines(True):
+            if self.fresh:
+                out.append(self.prefix)
+            out.append(line)
+            self.fresh = line.endswith('\n')
+        self.stream.write(''.join(out))
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+async def heartbeat(beats, slot):
+    """Tells the supervisor this bird's event loop is still going. Runs forever."""
+    while True:
+        beats[slot] = time.monotonic()
+        await asyncio.sleep(HEARTBEAT)
+
+
+async def _bird(bird, body, beak, library, trigger, beats, slot):
+    await asyncio.gather(
+        run.main(body, beak, bird["sounddir"], bird["specialdir"], 0, trigger,
+                 metrics_listen=bird["metrics_listen"], library=library),
+        heartbeat(beats, slot),
+    )
+
+
+def bird_main(bird, backend_name, bank_name, index, beats, slot):
+    """One bird's process."""
+    sys.stdout = _Prefixed(sys.stdout, bird["name"])
+    # The logger grabbed the real stdout when it was imported
+    for h in logger.handlers:
+        h.setStream(sys.stdout)
+    backend.use(backend_name)
+    bank = sharedbank.SharedBank.attach(bank_name, index)
+    library = sharedbank.SharedLibrary(bank, [bird["sounddir"], bird["specialdir"]])
+    print(f"Playing {len(library.entries)} clips out of the shared bank")
+
+    pins = bird["pins"]
+    if backend_name == "sim":
+        # There's one pretend bird per process, wire its switches up like this one
+        from squawker import sim
+        sim.rig.wire(pins["left_eye"], pins["right_eye"], pins["body"])
+    kit = backend.MotorKit(address=bird["address"])
+    beak = motors.EyeBeakController(left_eye_switch=pins["left_eye"], right_eye_switch=pins["right_eye"],
+                                    eye_beak_motor=kit.motor1)
+    body = motors.BodyController(body_switch=pins["body"], body_motor=kit.motor2)
+    run.register_handler([beak, body])
+
+    trigger = triggers.from_spec(bird["trigger"])
+    asyncio.run(_bird(bird, body, beak, library, trigger, beats, slot))
+
+
+class Supervisor:
+    """Starts the birds and restarts any that die or get stuck.
+
+    Args:
+        birds (list): bird dicts from load_config()
+        backend_name (str): pi or sim
+        bank (SharedBank): the clips every bird plays from
+    """
+    def __init__(self, birds, backend_name, bank) -> None:
+        self.birds = birds
+        self.backend = backend_name
+        self.bank = bank
+        # Spawned rather than forked, so nothing from this process leaks
+        # into the birds except what gets passed to them
+        self.ctx = multiprocessing.get_context("spawn")
+        self.beats = self.ctx.Array('d', len(birds), lock=False)
+        self.procs = [None] * len(birds)
+        self.started = [0.0] * len(birds)
+        self.backoff = [RESTART_MIN] * len(birds)
+        self.due = [0.0] * len(birds)
+        self.restarts = [0] * len(birds)
+        self.running = True
+
+    def start(self, slot):
+        bird = self.birds[slot]
+        proc = self.ctx.Process(target=bird_main, name=f"squawker-{bird['name']}",
+                                args=(bird, self.backend, self.bank.name, self.bank.index, self.beats, slot))
+        now = time.monotonic()
+        self.beats[slot] = now + GRACE
+        self.started[slot] = now
+        proc.start()
+        self.procs[slot] = proc
+        print(f"Started {bird['name']} as pid {proc.pid}")
+
+    def stop(self, slot, timeout = 5):
+        """SIGTERM first so the bird stops its motors, then SIGKILL."""
+        proc = self.procs[slot]
+        if proc is None:
+            return
+        if proc.is_alive():
+            proc.terminate()
+            proc.join(timeout)
+            if proc.is_alive():
+                print(f"{self.birds[slot]['name']} won't stop, killing it")
+                proc.kill()
+                proc.join()
+        self.procs[slot] = None
+
+    def check(self, slot):
+        """Restarts a bird that died or stalled, after its backoff."""
+        name = self.birds[slot]["name"]
+        proc = self.procs[slot]
+        now = time.monotonic()
+        if proc is None:
+            if now >= self.due[slot]:
+                self.restarts[slot] += 1
+                self.start(slot)
+            return
+        if proc.is_alive():
+            if now - self.beats[slot] < STALL:
+                return
+            print(f"{name} hasn't checked in for {now - self.beats[slot]:.0f}s, restarting it")
+        else:
+            print(f"{name} exited with {proc.exitcode}, restarting it")
+        self.stop(slot)
+        if now - self.started[slot] > HEALTHY:
+            self.backoff[slot] = RESTART_MIN
+        self.due[slot] = now + self.backoff[slot]
+        print(f"Restarting {name} in {self.backoff[slot]}s")
+        self.backoff[slot] = min(self.backoff[slot] * 2, RESTART_MAX)
+
+    def run(self):
+        """Runs the fleet until shutdown() gets called."""
+        for slot in range(len(self.birds)):
+            self.start(slot)
+        while self.running:
+            for slot in range(len(self.birds)):
+                self.check(slot)
+            time.sleep(HEARTBEAT)
+
+    def shutdown(self):
+        self.running = False
+        for slot in range(len(self.birds)):
+            self.stop(slot)
+
+
+if __name__ == '__main__':
+    args = parseArgs()
+    backend_name, birds = load_config(args.config)
+    if args.backend:
+        backend_name = args.backend
+    logger.info(f"Fleet of {len(birds)} birds on the {backend_name} backend")
+
+    directories = []
+    for bird in birds:
+        for d in (bird["sounddir"], bird["specialdir"]):
+            if d not in directories:
+                directories.append(d)
+    bank = sharedbank.SharedBank.build(directories)
+    clips = len(bank.index["clips"])
+    separate = sum(bank.unshared_bytes([b["sounddir"], b["specialdir"]]) for b in birds)
+    logger.info(f"Sound bank has {clips} unique clips in {bank.nbytes / 1e6:.1f} MB, "
+                f"{separate / 1e6:.1f} MB if every bird kept its own")
+
+    supervisor = Supervisor(birds, backend_name, bank)
+    def shutdown(signum, frame):
+        print('Shutting down the fleet.')
+        supervisor.running = False
+    signal(SIGINT, shutdown)
+    signal(SIGTERM, shutdown)
+    try:
+        supervisor.run()
+    finally:
+        supervisor.shutdown()
+        bank.close()
+        bank.unlink()
@@ -4,19 +4,64 @@
 Requires a path to a directory full of 16bit wave files. 
 Will probably crash on an empty directory."""
 
-import argparse, os, sys, logging, asyncio
+import argparse, os, sys, asyncio
 from functools import partial
 from signal import signal, SIGINT, SIGTERM
-from time import sleep
-from random import randrange, choice
-import RPi.GPIO as GPIO
+import time
+from random import randrange, sample
 import squawker
-from squawker import motors, sound
+# Only the light modules up front. sound, lipsync, library, mixer and control
+# pull in numpy and the audio stack, which startup imports on a thread while
+# the motors home, so they're reached through squawker.<name> once it has.
+from squawker import motors, backend, triggers, scheduler, metrics, trace, startup
+from squawker.logger import logger
+from squawker.backend import GPIO
+
+SPECIALDIR = '/home/dave/Code/squawker/specialsounds'
+# Seconds each kind of command can wait in line before it's not worth doing
+RFID_DEADLINE = 5
+SOUND_DEADLINE = 30
+MOTION_DEADLINE = 10
+BLINK_DEADLINE = 2
+# Level the ambience plays at under everything, and how long it takes to come in
+AMBIENCE_GAIN = 0.3
+AMBIENCE_FADE = 3
 
 def parseArgs():
     parser = argparse.ArgumentParser(
     description='Do animatronic stuff.')
-    parser.add_argument('sounddir', type=str, help="Relative path to directory with wav files.")
+    parser.add_argument('sounddir', type=str,
+                        help="Relative path to directory with wav files, or a bank of them (see squawker.soundbank).")
+    parser.add_argument('--specialdir', type=str, default=SPECIALDIR,
+                        help="Directory or bank with wav files for RFID events.")
+    parser.add_argument('--backend', choices=sorted(backend.BACKENDS), default=backend.current(),
+                        help="Real hardware (pi) or the simulated bird (sim).")
+    parser.add_argument('--trigger', type=str, default='file:/tmp/rfid',
+                        help="RFID trigger source: file:PATH, fifo:PATH, serial:DEV[@BAUD] or evdev:DEV.")
+    parser.add_argument('--debounce', type=float, default=triggers.DEBOUNCE,
+                        help="Seconds to ignore triggers after one fires.")
+    parser.add_argument('--beak-latency', type=float, default=None,
+                        help="Seconds early to start the beak motor ahead of the audio, defaults to lipsync.BEAK_LATENCY.")
+    parser.add_argument('--body-latency', type=float, default=None,
+                        help="Seconds early to start the body motor ahead of the audio, defaults to lipsync.BODY_LATENCY.")
+    parser.add_argument('--cache-mb', type=int, default=None,
+                        help="MB of decoded clips to keep in RAM, defaults to library.BUDGET.")
+    parser.add_argument('--metrics-file', type=str, default=None,
+                        help="Prometheus textfile to keep updated, e.g. for node_exporter.")
+    parser.add_argument('--metrics-listen', type=str, default=None,
+                        help="Serve metrics over HTTP on HOST:PORT or unix:PATH.")
+    parser.add_argument('--trace', type=str, default=trace.TRACE_PATH,
+                        help="Where the motor/switch trace gets dumped on SIGUSR1 or a crash.")
+    parser.add_argument('--startup-budget', type=float, default=startup.BUDGET,
+                        help="Seconds from starting to ready before it's worth a warning.")
+    parser.add_argument('--ambience', type=str, default=None,
+                        help="Wav file to loop underneath everything, ducked while the bird talks.")
+    parser.add_argument('--ambience-gain', type=float, default=AMBIENCE_GAIN,
+                        help="Level of the ambience, 1 is as recorded.")
+    parser.add_argument('--duck', type=float, default=None,
+                        help="Level the ambience drops to while the bird talks, defaults to mixer.DUCK.")
+    parser.add_argument('--control', type=str, default='/tmp/squawker.sock',
+                        help="Unix socket to take commands on (see squawker.control), '' for none.")
     return parser.parse_args()
 
 def handler(signal, frame, motors):
@@ -33,150 +78,159 @@ def register_handler(motors):
     signal(SIGINT, handler)
     signal(SIGTERM, handler)
 
-async def eyeblinking(beak, q: asyncio.Queue) -> None:
+async def eyeblinking(beak, sched) -> None:
     """Coroutine which blinks the eyes on a randomized interval.
-    suspends itself if the queue is not empty.
+    Blinks go to the back of the line behind everything else.
 
     Args:
         beak (MotorKit): Motor attached to the beak/eyes
-        q (asyncio.Queue): Queue
+        sched (Scheduler): runs the blinks
     """
     slp = randrange(4,14)
     print(f'Blinking coro wait {str(slp)} seconds.')
     await asyncio.sleep(slp)
     while True:
-        await q.join()
-        beak.set_eyes('closed')
-        await asyncio.sleep(0.1)
-        beak.set_eyes('open')
+        # Not worth blinking late, just wait for the next one
+        await sched.submit(scheduler.Blink(beak, deadline=BLINK_DEADLINE))
         slp = randrange(4,14)
         print(f'Blinking again in {str(slp)} seconds.')
         await asyncio.sleep(slp)
             
-async def ambientMotion(body, q: asyncio.Queue) -> None:
+async def ambientMotion(body, sched) -> None:
     """Coroutine which moves the body on a randomized interval.
-    suspends itself if the queue is not empty.
+    Sounds and RFID events cut the movement short.
 
     Args:
         body (MotorKit): Motor attached to the body
-        q (asyncio.Queue): Queue
+        sched (Scheduler): runs the movements
     """
     slp = randrange(10,40)
     print(f"Body coro wait {str(slp)} seconds.")
     await asyncio.sleep(slp)
     while True:
-        await q.join()
-        squawker.rnd_action(body)
+        # A couple of actions at a time, in whatever order is quickest from here
+        names = sample(list(squawker.actionmap), randrange(1,3))
+        await sched.submit(scheduler.BodyMotion(body, names, deadline=MOTION_DEADLINE))
         slp = randrange(10,40)
         print(f"Body movement in {str(slp)} seconds.")
         await asyncio.sleep(slp)
-    
-async def eventdirector(q):
-    tasklist = []
-    while not q.empty():
-        task = await q.get()
-        if "sound" in task or "rfid" in task:
-            print('Received sound queue task.')
-            cmd = task.get("sound").get("cmd")
-            filename = task.get("sound").get("filename")
-            cmd.run(filename)
-            print('Releasing sound queue task.')
-            q.task_done()
-        else:
-            print("Unrecognized task, releasing.")
-            q.task_done()
            
-async def sounds(directory, body, beak, q: asyncio.Queue) -> None:
+async def sounds(directory, body, beak, library, sched, squawk=None) -> None:
     """Coroutine that activates a wav file routine on a random interval.
-    Ambient motion functions suspend during these activations
+    Ambient motion waits its turn during these, RFID sounds cut them off.
 
     Args:
         directory (str): directory of wav files
         body (MotorKit): Motor attached to the body
         beak (MotorKit): Motor attached to the beak/eyes
-        q (asyncio.Queue): Queue
+        library (SoundLibrary): Index of the wav files
+        sched (Scheduler): runs the sounds
+        squawk (Squawk): what plays them, defaults to a new one
     """
-    files = [os.path.join(directory, file) for file in os.listdir(directory)]
-    squawk = sound.Squawk(beak, body)
+    squawk = squawk or squawker.sound.Squawk(beak, body, library.envelopes, library=library)
     slp = randrange(30,60)
     print(f'Sound coro wait {str(slp)}')
     await asyncio.sleep(slp)
     
     while True:
         slp = randrange(30,60)
-        await q.join()
-        filename = choice(files)
-        print(f"\nEnqueuing file {filename}.")
-        qitem = {"sound": {"cmd": squawk, "filename" :filename}}
-        await q.put(qitem)
-        while body.body_motor.throttle != 0 or beak.eye_beak_motor.throttle != 0:
-            await asyncio.sleep(0)
-        await eventdirector(q)
-        await q.join()
-        print(f'Next sound activation in {str(slp)}\n')
+        # Picked fresh each time, so sounds added while running get played too
+        filename = library.choice(directory)
+        if filename is None:
+            print(f"No sounds in {directory}, trying again in {str(slp)}")
+            await asyncio.sleep(slp)
+            continue
+        print(f"\nScheduling file {filename}.")
+        done = await sched.submit(scheduler.PlaySound(squawk, filename, deadline=SOUND_DEADLINE))
+        print(f'Sound {done.status}. Next sound activation in {str(slp)}\n')
         await asyncio.sleep(slp)
         
-async def rfidevent(body, beak, q: asyncio.Queue) -> None:
-    """Simulate an RFID event by updating a file"""
-    directory = '/home/dave/Code/squawker/specialsounds'
-    tmpfile = '/tmp/rfid'
-    files = [os.path.join(directory, file) for file in os.listdir(directory)]
+async def rfidevent(directory, body, beak, library, source, sched, squawk=None) -> None:
+    """Plays a special sound whenever the trigger source reports a tag.
+    These jump the queue and cut off whatever ambient stuff is going on.
+
+    Args:
+        directory (str): directory of wav files for RFID events
+        body (MotorKit): Motor attached to the body
+        beak (MotorKit): Motor attached to the beak/eyes
+        library (SoundLibrary): Index of the wav files
+        source (TriggerSource): where RFID events come from
+        sched (Scheduler): runs the sounds
+        squawk (Squawk): what plays them, defaults to a new one
+    """
+    squawk = squawk or squawker.sound.Squawk(beak, body, library.envelopes, library=library)
     
-    with open(tmpfile,'w+') as f:
-        pass
-        
-    while True:
-        f = open(tmpfile,'r')
-        text = f.read()
-        f.close()
-        if 'rfid_event' in text:
-            print("RFID Event detected")
-            squawk = sound.Squawk(beak, body)
-            filename = choice(files)
-            qitem = {"sound": {"cmd": squawk, "filename": filename}}
-            await q.put(qitem)
-            while body.body_motor.throttle != 0 or beak.eye_beak_motor.throttle != 0:
-                await asyncio.sleep(0)
-            await eventdirector(q)
-            await q.join()
-            f = open(tmpfile, 'w')
-            f.close()
-            
-        await asyncio.sleep(0)
+    # Sleeps until the source has something, no more spinning on /tmp/rfid
+    async for tag in source.events():
+        trigger = time.monotonic()
+        print(f"RFID Event detected: {tag}")
+        filename = library.choice(directory)
+        if filename is None:
+            print(f"No sounds in {directory} for RFID events.")
+            continue
+        # Don't wait for it to finish, so the next tag gets read straight away
+        sched.submit(scheduler.PlaySound(squawk, filename, trigger, scheduler.RFID, RFID_DEADLINE))
     
-async def main(body, beak, sounddir):
-    q = asyncio.Queue()
-    eye_task = asyncio.create_task(eyeblinking(beak, q))
-    body_task = asyncio.create_task(ambientMotion(body, q))
-    sound_task = asyncio.create_task(sounds(sounddir, body, beak, q))
-    rfid_task = asyncio.create_task(rfidevent(body, beak, q))
-    await asyncio.gather(eye_task, body_task, sound_task, rfid_task)
+async def main(body, beak, sounddir, specialdir, cache, trigger, metrics_file=None, metrics_listen=None,
+               budget=startup.BUDGET, library=None, ambience=None, ambience_gain=AMBIENCE_GAIN, duck=None,
+               control_path=None, beak_latency=None, body_latency=None):
+    # Motors home while the sounds get scanned and the sound card opens
+    library = await startup.start(beak, body, [sounddir, specialdir], cache, budget, library=library)
+    # Squawk picks these up as its defaults
+    if beak_latency is not None:
+        squawker.lipsync.BEAK_LATENCY = beak_latency
+    if body_latency is not None:
+        squawker.lipsync.BODY_LATENCY = body_latency
+    engine = None
+    if ambience:
+        # Everything goes through the mixer so the ambience can carry on underneath
+        engine = squawker.mixer.Mixer(duck=squawker.mixer.DUCK if duck is None else duck).open()
+        engine.play(ambience, gain=ambience_gain, loop=True, fade_in=AMBIENCE_FADE)
+    squawk = squawker.sound.Squawk(beak, body, library.envelopes, engine=engine, library=library)
+    sched = scheduler.Scheduler()
+    coros = [
+        sched.run(),
+        eyeblinking(beak, sched),
+        ambientMotion(body, sched),
+        sounds(sounddir, body, beak, library, sched, squawk),
+        rfidevent(specialdir, body, beak, library, trigger, sched, squawk),
+        library.watch(),
+        metrics.loop_lag(),
+    ]
+    if metrics_file:
+        coros.append(metrics.textfile(metrics_file))
+    if metrics_listen:
+        coros.append(metrics.serve(metrics_listen))
+    if control_path:
+        # Sounds asked for by name come from either directory, random ones are special sounds
+        server = squawker.control.ControlServer(sched, squawk, library, [specialdir, sounddir], SOUND_DEADLINE)
+        coros.append(server.serve(control_path))
+    try:
+        await asyncio.gather(*coros)
+    finally:
+        sched.report()
 
 if __name__ == '__main__':
     args = parseArgs()
     
-    logger = logging.getLogger(__name__)
-    logger.setLevel(logging.INFO)
-    formatter = logging.Formatter(fmt="%(asctime)s %(name)s.%(levelname)s: %(message)s", datefmt="%Y.%m.%d %H:%M:%S")
-    handler = logging.StreamHandler(stream=sys.stdout)
-    handler.setFormatter(formatter)
-    logger.addHandler(handler)
-    
     sounddir = args.sounddir
+    specialdir = args.specialdir
+    backend.use(args.backend)
+    logger.info(f"Using the {args.backend} backend")
+    trace.install(args.trace)
+    
     beak = motors.EyeBeakController()
     body = motors.BodyController()
     
     register_handler([beak, body])
     
-    sleep(1)
-    
-    logger.info("Initialize motors to a known position")
-    # print("Initialize motors to a known position")
-    body.resetbody()
-    beak.fullblink()
-    sleep(1)
-    
-    asyncio.run(main(body, beak, sounddir))
+    trigger = triggers.from_spec(args.trigger, debounce=args.debounce)
+    cache = args.cache_mb * 1024 * 1024 if args.cache_mb is not None else None
+    asyncio.run(main(body, beak, sounddir, specialdir, cache, trigger,
+                     args.metrics_file, args.metrics_listen, args.startup_budget,
+                     ambience=args.ambience, ambience_gain=args.ambience_gain, duck=args.duck,
+                     control_path=args.control, beak_latency=args.beak_latency,
+                     body_latency=args.body_latency))
         
     body.body_motor.throttle = 0
     beak.eye_beak_motor.throttle = 0
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""Runs run.py's behaviour for a simulated day in a few seconds.
+
+The blink, ambient motion, sound and RFID coroutines from run.py go through
+the real Scheduler, on a virtual clock (see squawker/virtual.py) with stand-in
+controllers, so hours of randomized sleeps take no time at all. At the end
+it reports what a long run would have looked like:
+
+    - what each kind of command waited in the queue, and what happened to it
+    - motor-on time and duty for each motor, and time spent playing sounds
+    - idle gaps, stretches where the bird did nothing at all
+    - anything that drove a motor while something else was already driving it
+
+    python soak.py sounds --specialdir specialsounds --hours 24
+"""
+
+import argparse, asyncio, contextlib, io, random, time
+import run
+from squawker import scheduler, virtual, startup
+from squawker.logger import logger
+
+# An idle gap longer than this is worth counting on its own
+LONG_GAP = 60
+
+
+def parseArgs():
+    parser = argparse.ArgumentParser(description='Soak test run.py on a virtual clock.')
+    parser.add_argument('sounddir', type=str, help="Directory with wav files, or a bank of them.")
+    parser.add_argument('--specialdir', type=str, default=None,
+                        help="Directory or bank for RFID sounds, defaults to sounddir.")
+    parser.add_argument('--hours', type=float, default=24, help="Virtual hours to run for.")
+    parser.add_argument('--rfid-every', type=float, default=600,
+                        help="Mean virtual seconds between RFID taps, 0 for none.")
+    parser.add_argument('--seed', type=int, default=None, help="Random seed, for repeating a run.")
+    parser.add_argument('--verbose', action='store_true', help="Let run.py's printing through.")
+    return parser.parse_args()
+
+
+async def soak(sounddir, specialdir, library, beak, body, squawk, seconds, rfid_every, rng):
+    """Runs the run.py coroutines until seconds of virtual time have gone by.
+
+    Returns:
+        Scheduler: with its stats
+    """
+    sched = scheduler.Scheduler()
+    coros = [
+        sched.run(),
+        run.eyeblinking(beak, sched),
+        run.ambientMotion(body, sched),
+        run.sounds(sounddir, body, beak, library, sched, squawk),
+    ]
+    if rfid_every:
+        trigger = virtual.VirtualTrigger(rfid_every, rng)
+        coros.append(run.rfidevent(specialdir, body, beak, library, trigger, sched, squawk))
+    try:
+        await asyncio.wait_for(asyncio.gather(*coros), seconds)
+    except asyncio.TimeoutError:
+        pass
+    return sched
+
+
+def report(sched, ledger, beak, body, squawk, seconds, wall):
+    print(f"Soaked {seconds / 3600:.1f} virtual hours in {wall:.1f}s ({seconds / wall:.0f}x)")
+    print()
+    print("Commands:")
+    for kind, stats in sched.stats.items():
+        s = stats.as_dict()
+        print(f"  {kind:7} {s['submitted']:6d} submitted, wait {s['mean_wait'] * 1000:7.0f}ms mean "
+              f"{s['max_wait'] * 1000:7.0f}ms max, max queued {s['max_depth']}, {s['outcomes']}")
+    print()
+    print("Motors:")
+    for resource in ("eye_beak", "body", "audio"):
+        on = ledger.on_time(resource)
+        print(f"  {resource:8} {on:9.1f}s on, duty {on / seconds:6.1%}")
+    print(f"  {squawk.played} clips, {beak.blinks} blinks, {body.moves} body moves, {body.resets} resets")
+    print()
+    gaps = ledger.gaps()
+    lengths = sorted(length for _, length in gaps)
+    if lengths:
+        start, longest = max(gaps, key=lambda g: g[1])
+        print(f"Idle gaps: {len(lengths)}, {sum(lengths) / len(lengths):.1f}s mean, "
+              f"{lengths[len(lengths) // 2]:.1f}s median, longest {longest:.1f}s at {start / 3600:.2f}h, "
+              f"{sum(1 for g in lengths if g > LONG_GAP)} over {LONG_GAP}s")
+    print()
+    print(f"Overlapping actuation: {len(ledger.violations)}")
+    for t, resource, holder, owner in ledger.violations[:10]:
+        print(f"  {t / 3600:.3f}h {owner} drove {resource} while {holder} had it")
+
+
+if __name__ == '__main__':
+    args = parseArgs()
+    specialdir = args.specialdir or args.sounddir
+    rng = random.Random(args.seed)
+    # run.py and the planner use the random module directly
+    random.seed(args.seed)
+
+    library = startup._library([args.sounddir, specialdir], 0)
+    loop = virtual.VirtualLoop()
+    asyncio.set_event_loop(loop)
+    ledger = virtual.Ledger(loop)
+    beak = virtual.VirtualBeak(ledger)
+    body = virtual.VirtualBody(ledger)
+    squawk = virtual.VirtualSquawk(beak, body, library)
+    seconds = args.hours * 3600
+
+    logger.info(f"Soaking for {args.hours} virtual hours")
+    began = time.perf_counter()
+    chatter = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with chatter:
+            sched = loop.run_until_complete(soak(args.sounddir, specialdir, library, beak, body, squawk,
+                                                 seconds, args.rfid_every, rng))
+    finally:
+        loop.close()
+    ledger.close()
+    report(sched, ledger, beak, body, squawk, seconds, time.perf_counter() - began)
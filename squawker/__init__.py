@@ -1,5 +1,20 @@
-from . import motors
-from . import sound
-from . import actions
-from .actions import run_action, rnd_action
-from .actions import actionmap
\ No newline at end of file
+# Submodules get imported the first time something asks for them, so importing
+# squawker doesn't drag in numpy, the audio stack and the motor HAT up front.
+import importlib
+
+_submodules = {"motors", "sound", "envelope", "triggers", "library", "actions", "scheduler", "startup",
+               "lipsync", "mixer", "control"}
+_from_actions = {"run_action", "rnd_action", "run_action_async", "rnd_action_async",
+                 "plan", "run_plan", "run_plan_async", "rnd_actions_async", "actionmap"}
+
+
+def __getattr__(name):
+    if name in _submodules:
+        return importlib.import_module(f".{name}", __name__)
+    if name in _from_actions:
+        return getattr(importlib.import_module(".actions", __name__), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(globals()) | _submodules | _from_actions)
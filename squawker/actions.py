@@ -15,8 +15,10 @@ baseline at zero after a few.
 
 """
 
+import asyncio
+from itertools import permutations, product
 from time import sleep
-from random import choice
+from random import choice, sample
 
 actionmap = {
     # If the motor is moving forward from a closed switch position
@@ -27,6 +29,16 @@ actionmap = {
     "shuffle": {"start": 65, "end": 190}
 }
 
+# Pause between getting into position and running through an action
+SETTLE = 0.3
+
+# Estimated drift, in position units, at which it's worth a reset to zero
+DRIFT_THRESHOLD = 15
+# Past this many actions, trying every order takes too long, go greedy instead.
+# It's n! orders times 2^n ways in, all on the event loop: 4 is a few ms on a
+# desktop, 6 was most of a second and several on the Pi.
+MAX_EXHAUSTIVE = 4
+
 def shortestpath(body,action):
     """Shortest amount of time from current to the desired time position
 
@@ -59,6 +71,22 @@ def run_action(body, action):
     otherside = [i for i in actiontimes if i != whichside][0]
     body.setbodyPosition(actiontimes.get(otherside))
     
+async def run_action_async(body, action):
+    """Same as run_action, but awaits the body moves so the event loop
+    keeps running.
+
+    Args:
+        body (BodyController): Motor driving the body
+        action (str): named action for the body to make
+    """
+    dst = shortestpath(body, action)
+    actiontimes = actionmap.get(action)
+    await body.move_to(dst)
+    await asyncio.sleep(0.3)
+    whichside = [i for i in actiontimes if actiontimes[i] == dst ][0]
+    otherside = [i for i in actiontimes if i != whichside][0]
+    await body.move_to(actiontimes.get(otherside))
+
 def rnd_action(body):
     """Randomly selects and performs an action from the actionmap
 
@@ -68,3 +96,146 @@ def rnd_action(body):
     action = choice([x for x in actionmap.keys()])
     print(f"Running randomly selected action: {action}")
     run_action(body,action)
+
+async def rnd_action_async(body):
+    """Randomly selects and performs an action from the actionmap without
+    blocking the event loop.
+
+    Args:
+        body (BodyController): Motor driving the body
+    """
+    action = choice([x for x in actionmap.keys()])
+    print(f"Running randomly selected action: {action}")
+    await run_action_async(body, action)
+
+def _segments(body, order, start, drift, threshold):
+    """Turns an ordered list of (entry, exit) positions into motor steps.
+
+    Returns:
+        tuple: (steps, motor-on units, drift at the end)
+    """
+    steps = []
+    units = 0
+    current = start
+    for entry, exit in order:
+        if drift > threshold:
+            # A reset runs forward until the switch, and lands on zero
+            reset = (body.MAX - current) % body.MAX or body.MAX
+            steps.append(("reset", reset))
+            units += reset
+            current = 0
+            drift = 0.0
+        for n, dst in enumerate((entry, exit)):
+            if dst == current:
+                continue
+            dist, direction = body._moveparams(current, dst, body.MAX)
+            last = steps[-1] if steps else None
+            if n == 0 and last is not None and last[0] == "move" and last[2] == direction:
+                # Keep going from the last action straight into this one's
+                # start, without stopping the motor in between
+                steps[-1] = ("move", dst, direction, last[3] + dist)
+                drift += body.drift_for(dist, 0)
+            else:
+                if n == 1 and steps and steps[-1][0] == "move":
+                    steps.append(("pause", SETTLE))
+                steps.append(("move", dst, direction, dist))
+                drift += body.drift_for(dist)
+            # Going past the switch puts the position right again for free
+            to_zero = (body.MAX - current) % body.MAX or body.MAX if direction == 1 else current
+            if dist >= to_zero:
+                drift = body.drift_for(dist - to_zero, 0)
+            units += dist
+            current = dst
+    return steps, units, drift
+
+def plan(body, actions, keep_order = False, drift = None, threshold = DRIFT_THRESHOLD):
+    """Works out how to run a batch of actions with the least motor time.
+    Tries every order (unless keep_order) and both ways into each action,
+    costing the moves with the body's _moveparams. Moves that go nowhere are
+    dropped, a move out of one action that carries on the same way into the
+    next one's start becomes one motor run, and a resetbody only goes in
+    when the estimated drift gets past the threshold. Moves that go past
+    zero count as a free reset, since the body switch corrects the position.
+
+    Args:
+        body (BodyController): Motor driving the body
+        actions (list): named actions from the actionmap
+        keep_order (bool): run them in the order given
+        drift (float): estimated drift so far, defaults to the body's own estimate
+        threshold (float): drift that triggers a reset
+
+    Returns:
+        list: steps, each ("move", dst, direction, units), ("pause", seconds)
+        or ("reset", units)
+    """
+    ends = [(actionmap[a]["start"], actionmap[a]["end"]) for a in actions]
+    start = body.timeposition
+    if drift is None:
+        drift = body.drift
+    best = None
+    if keep_order or len(ends) <= MAX_EXHAUSTIVE:
+        # The same action twice makes for repeated orders, only try each once
+        orders = [ends] if keep_order else dict.fromkeys(permutations(ends))
+        for order in orders:
+            for flips in product((False, True), repeat=len(order)):
+                legs = [(b, a) if flip else (a, b) for (a, b), flip in zip(order, flips)]
+                result = _segments(body, legs, start, drift, threshold)
+                if best is None or result[1] < best[1]:
+                    best = result
+    else:
+        # Greedy: always go for whichever action end is nearest
+        legs = []
+        current = start
+        remaining = list(ends)
+        while remaining:
+            entry, exit, pick = min(((a, b, e) for e in remaining for a, b in (e, e[::-1])),
+                                    key=lambda x: body._moveparams(current, x[0], body.MAX)[0])
+            remaining.remove(pick)
+            legs.append((entry, exit))
+            current = exit
+        best = _segments(body, legs, start, drift, threshold)
+    steps, units, end_drift = best
+    print(f"Planned {len(actions)} actions: {units / 100:.2f}s of motor time")
+    return steps
+
+def run_plan(body, steps):
+    """Runs the steps from plan().
+
+    Args:
+        body (BodyController): Motor driving the body
+        steps (list): from plan()
+    """
+    for step in steps:
+        if step[0] == "reset":
+            body.resetbody()
+        elif step[0] == "pause":
+            sleep(step[1])
+        else:
+            body.setbodyPosition(step[1], step[2])
+
+async def run_plan_async(body, steps):
+    """Runs the steps from plan() without blocking the event loop.
+
+    Args:
+        body (BodyController): Motor driving the body
+        steps (list): from plan()
+    """
+    for step in steps:
+        if step[0] == "reset":
+            await body.resetbody_async()
+        elif step[0] == "pause":
+            await asyncio.sleep(step[1])
+        else:
+            await body.move_to(step[1], step[2])
+
+async def rnd_actions_async(body, count = 2):
+    """Picks a few random actions and runs them in whatever order is quickest
+    from where the body is now.
+
+    Args:
+        body (BodyController): Motor driving the body
+        count (int): how many actions
+    """
+    actions = sample(list(actionmap), min(count, len(actionmap)))
+    print(f"Running randomly selected actions: {', '.join(actions)}")
+    await run_plan_async(body, plan(body, actions))
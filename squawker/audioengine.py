@@ -0,0 +1,254 @@
+"""One audio output for the whole process.
+
+Opening PyAudio and an ALSA stream for every clip costs hundreds of
+milliseconds on a Pi, which is a very noticeable pause between an RFID tap and
+the squawk. The engine opens the device once at a fixed rate and format and
+keeps it fed with silence between clips so it stays warm. Clips that don't
+match the engine's format get converted on the way through.
+"""
+
+import atexit
+import contextlib
+import threading
+import time
+import numpy as np
+from . import metrics
+from .backend import pyaudio
+
+RATE = 44100
+CHANNELS = 2
+# Frames of silence written at a time while idle. Small, so a clip
+# never waits long for the keepalive to get out of the way.
+IDLE_FRAMES = 512
+
+
+class Converter:
+    """Converts one clip's chunks to the engine's int16 format, channel count
+    and rate. Resampling is linear and carries its position between chunks so
+    there are no clicks at the chunk boundaries.
+    """
+    def __init__(self, dtype, channels, rate, out_channels=CHANNELS, out_rate=RATE) -> None:
+        self.dtype = np.dtype(dtype)
+        self.channels = channels
+        self.rate = rate
+        self.out_channels = out_channels
+        self.out_rate = out_rate
+        self.step = rate / out_rate
+        self._pos = 0.0
+        self._prev = None
+
+    @property
+    def passthrough(self):
+        """True when the clip is already in the engine's format."""
+        return (self.dtype == np.int16 and self.channels == self.out_channels
+                and self.rate == self.out_rate)
+
+    def _to_int16(self, samples):
+        if samples.dtype == np.int16:
+            return samples
+        if samples.dtype.kind == 'f':
+            return (np.clip(samples, -1.0, 1.0) * 32767).astype(np.int16)
+        bits = samples.dtype.itemsize * 8
+        samples = samples.astype(np.int64)
+        if self.dtype.kind == 'u':
+            samples -= 1 << (bits - 1)
+        if bits > 16:
+            return (samples >> (bits - 16)).astype(np.int16)
+        return (samples << (16 - bits)).astype(np.int16)
+
+    def _remix(self, frames):
+        if self.channels == self.out_channels:
+            return frames
+        if self.out_channels == 1:
+            return frames.mean(axis=1, keepdims=True).astype(np.int16)
+        if self.channels == 1:
+            return np.repeat(frames, self.out_channels, axis=1)
+        # Anything else, keep the first channels and pad with the last one
+        picked = [min(c, self.channels - 1) for c in range(self.out_channels)]
+        return frames[:, picked]
+
+    def _resample(self, frames):
+        if self.rate == self.out_rate or len(frames) == 0:
+            return frames
+        prev = frames[:1] if self._prev is None else self._prev
+        buf = np.concatenate([prev, frames]).astype(np.float32)
+        # buf[0] is the last frame of the previous chunk, so positions run from
+        # where the last chunk left off up to the end of this one
+        if self._prev is None:
+            self._pos = 1.0
+        times = np.arange(self._pos, len(buf) - 1, self.step)
+        self._pos = (times[-1] + self.step) - len(frames) if len(times) else self._pos - len(frames)
+        self._prev = frames[-1:]
+        idx = np.arange(len(buf))
+        out = np.empty((len(times), buf.shape[1]), dtype=np.int16)
+        for c in range(buf.shape[1]):
+            out[:, c] = np.interp(times, idx, buf[:, c])
+        return out
+
+    def convert(self, samples):
+        """Converts one chunk of the clip.
+
+        Args:
+            samples (ndarray): (frames, channels) samples in the clip's format
+
+        Returns:
+            bytes: interleaved int16 samples in the engine's format
+        """
+        frames = self._to_int16(samples).reshape(-1, self.channels)
+        frames = self._resample(self._remix(frames))
+        return np.ascontiguousarray(frames).tobytes()
+
+
+class ClipStream:
+    """What Squawk writes a clip into, stands in for a PyAudio stream."""
+    def __init__(self, engine, converter, trigger=None) -> None:
+        self.engine = engine
+        self.converter = converter
+        self.trigger = trigger
+
+    def write(self, samples, raw=None):
+        """Plays one chunk.
+
+        Args:
+            samples (ndarray): (frames, channels) samples in the clip's format
+            raw (memoryview): the same chunk's bytes, written as-is when the
+                clip is already in the engine's format
+        """
+        if self.converter.passthrough and raw is not None:
+            out = raw
+        else:
+            out = self.converter.convert(samples)
+        self.engine.write(out, trigger=self.trigger)
+        self.trigger = None
+
+
+class AudioEngine:
+    """Keeps one PyAudio output stream open for the life of the process.
+
+    Args:
+        rate (int): output sample rate
+        channels (int): output channel count
+    """
+    def __init__(self, rate=RATE, channels=CHANNELS) -> None:
+        self.rate = rate
+        self.channels = channels
+        self.latency = None
+        self._pa = None
+        self._stream = None
+        self._lock = threading.Lock()
+        self._clips = 0
+        self._running = False
+        self._keepalive = None
+        self._silence = bytes(IDLE_FRAMES * channels * 2)
+
+    def open(self):
+        """Opens the output device and starts feeding it silence. Safe to call twice."""
+        if self._stream is not None:
+            return self
+        start = time.monotonic()
+        self._pa = pyaudio.PyAudio()
+        self._stream = self._pa.open(format=pyaudio.paInt16,
+                                     channels=self.channels,
+                                     rate=self.rate,
+                                     output=True)
+        self._stream.start_stream()
+        self._running = True
+        self._keepalive = threading.Thread(target=self._idle, name="audio-keepalive", daemon=True)
+        self._keepalive.start()
+        print(f"Audio engine open at {self.rate} Hz, {self.channels} channels, "
+              f"took {time.monotonic() - start:.3f}s")
+        return self
+
+    @property
+    def output_latency(self):
+        """Seconds between writing a sample and hearing it."""
+        if self._stream is None:
+            return 0.0
+        return self._stream.get_output_latency()
+
+    def close(self):
+        self._running = False
+        if self._keepalive is not None:
+            self._keepalive.join()
+            self._keepalive = None
+        with self._lock:
+            if self._stream is not None:
+                self._stream.stop_stream()
+                self._stream.close()
+                self._pa.terminate()
+                self._stream = None
+                self._pa = None
+
+    def _idle(self):
+        while self._running:
+            if self._clips:
+                time.sleep(IDLE_FRAMES / self.rate / 2)
+                continue
+            start = time.monotonic()
+            with self._lock:
+                if self._stream is not None and not self._clips:
+                    self._write(self._silence, IDLE_FRAMES)
+            # A write that didn't block means the device buffer has room,
+            # no need to spin filling it
+            time.sleep(max(0.0, IDLE_FRAMES / self.rate / 2 - (time.monotonic() - start)))
+
+    def write(self, data, trigger=None):
+        """Writes int16 frames in the engine's format, blocking like PyAudio does.
+
+        Args:
+            data (bytes): interleaved int16 samples
+            trigger (float): time.monotonic() of whatever caused this clip, to
+                report how long until its first sample comes out
+        """
+        frames = len(data) // (2 * self.channels)
+        with self._lock:
+            if trigger is not None:
+                self.latency = time.monotonic() - trigger + self._stream.get_output_latency()
+                metrics.TRIGGER_LATENCY.observe(self.latency)
+                print(f"Trigger to first sample: {self.latency * 1000:.1f}ms")
+            self._write(data, frames)
+
+    def _write(self, data, frames):
+        try:
+            self._stream.write(data, frames, exception_on_underflow=True)
+        except IOError as e:
+            # The data still got written, the error just says the card ran dry first
+            if e.errno != pyaudio.paOutputUnderflowed:
+                raise
+            metrics.UNDERRUNS.inc()
+
+    @contextlib.contextmanager
+    def clip(self, dtype, channels, rate, trigger=None):
+        """Context for playing one clip. The keepalive stays quiet while it's open.
+
+        Args:
+            dtype: numpy dtype of the clip's samples
+            channels (int): clip channel count
+            rate (int): clip sample rate
+            trigger (float): time.monotonic() of the trigger, for latency reporting
+
+        Yields:
+            ClipStream: write the clip's raw chunks into this
+        """
+        self.open()
+        self._clips += 1
+        try:
+            yield ClipStream(self, Converter(dtype, channels, rate, self.channels, self.rate), trigger)
+        finally:
+            self._clips -= 1
+
+
+_engine = None
+
+
+def get_engine():
+    """Returns the process-wide engine, opening it the first time.
+
+    Returns:
+        AudioEngine: the engine
+    """
+    global _engine
+    if _engine is None:
+        _engine = AudioEngine().open()
+        atexit.register(_engine.close)
+    return _engine
@@ -0,0 +1,73 @@
+"""Picks which hardware the rest of the package talks to.
+
+"pi" is the real thing: RPi.GPIO, the adafruit MotorKit HAT and PyAudio.
+"sim" is squawker.sim, a pretend bird that runs anywhere, so the whole control
+stack can be run and profiled on a normal computer.
+
+Nothing gets imported until it's actually used, so picking a backend has to
+happen before the first motor controller gets made. The SQUAWKER_BACKEND
+environment variable sets the default.
+"""
+
+import importlib
+import os
+
+BACKENDS = {
+    "pi": {"gpio": "RPi.GPIO", "motorkit": "adafruit_motorkit", "pyaudio": "pyaudio"},
+    "sim": {"gpio": "squawker.sim:GPIO", "motorkit": "squawker.sim", "pyaudio": "squawker.sim:pyaudio"},
+}
+
+_name = os.environ.get("SQUAWKER_BACKEND", "pi")
+_resolved = {}
+
+
+def use(name):
+    """Selects the backend.
+
+    Args:
+        name (str): pi or sim
+
+    Raises:
+        ValueError: unknown backend
+        RuntimeError: a different backend has already been used
+    """
+    global _name
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend {name}, pick one of {', '.join(BACKENDS)}")
+    if _resolved and name != _name:
+        raise RuntimeError(f"Backend {_name} is already in use, can't switch to {name}")
+    _name = name
+
+
+def current():
+    """Returns the name of the selected backend."""
+    return _name
+
+
+def _resolve(role):
+    if role not in _resolved:
+        target = BACKENDS[_name][role]
+        modname, _, attr = target.partition(':')
+        obj = importlib.import_module(modname)
+        if attr:
+            obj = getattr(obj, attr)
+        _resolved[role] = obj
+    return _resolved[role]
+
+
+class _Lazy:
+    """Stands in for a module and imports the real one on first attribute access."""
+    def __init__(self, role) -> None:
+        self._role = role
+
+    def __getattr__(self, name):
+        return getattr(_resolve(self._role), name)
+
+
+GPIO = _Lazy("gpio")
+pyaudio = _Lazy("pyaudio")
+
+
+def MotorKit(**kwargs):
+    """Makes a MotorKit from the selected backend."""
+    return _resolve("motorkit").MotorKit(**kwargs)
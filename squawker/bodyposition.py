@@ -0,0 +1,268 @@
+"""Closed-loop estimate of where the body is on its loop.
+
+BodyController used to run the motor for a calculated time and then just
+assume it got where it was going, so the position drifted and needed a
+resetbody (up to a whole 2.2s cycle) every few actions. The only sensor on the
+body is the switch at zero, but the motor goes past it all the time: every
+wingshake does. Each time it does, that edge says exactly where the body is.
+
+This timestamps those edges and uses them to:
+
+    - snap the position back to zero, so the error starts over
+    - learn how long a full cycle really takes, and how much time the motor
+      loses spinning up in each direction, and taking up the gear slop when
+      it changes direction
+
+The timing is a straight line fit of time-to-zero against distance-to-zero for
+each direction, kept separately for carrying on the same way and for turning
+around, with old samples fading out so it follows the motor as it
+warms up or wears. Moves then get timed off the fit instead of a flat
+hundredth of a second per unit.
+"""
+
+import threading
+import time
+
+MAX = 222
+# Guesses to start from until the switch says otherwise
+PERIOD = 2.22
+SPINUP = 0.03
+# Units of gear slop taken up when the motor turns around
+SLOP = 6
+# How much an old sample still counts each time a new one comes in
+FORGET = 0.9
+# How much the starting guesses count against real samples
+PRIOR_WEIGHT = 1.0
+# Keep the fit from running off somewhere silly on a bad sample
+PERIOD_RANGE = (1.5, 3.5)
+SPINUP_RANGE = (0.0, 0.3)
+# Error, in position units, where the estimate is as good as a guess
+TOLERANCE = 40
+# Don't learn timing from moves that started somewhere this unsure,
+# or that missed zero by this many units (a bounce, or a stalled motor)
+MIN_CONFIDENCE = 0.5
+MAX_MISS = 20
+# Edges this long after the motor stops are still the motor coasting
+COAST = 0.1
+
+
+class _Fit:
+    """Weighted least squares fit of y = a + b*x where older samples fade out.
+    The prior line always counts a little, so the fit is never worse than the
+    guess it started from.
+    """
+    def __init__(self, a, b) -> None:
+        self.prior = self._sums([(0, a, PRIOR_WEIGHT), (MAX, a + b * MAX, PRIOR_WEIGHT)])
+        self.sums = [0.0] * 5
+        self.samples = 0
+
+    @staticmethod
+    def _sums(points):
+        sums = [0.0] * 5
+        for x, y, w in points:
+            sums[0] += w
+            sums[1] += w * x
+            sums[2] += w * y
+            sums[3] += w * x * x
+            sums[4] += w * x * y
+        return sums
+
+    def add(self, x, y, w = 1.0):
+        new = self._sums([(x, y, w)])
+        self.sums = [s * FORGET + n for s, n in zip(self.sums, new)]
+        self.samples += 1
+
+    def params(self):
+        """Returns:
+            tuple: (a, b) of the current fit
+        """
+        w, sx, sy, sxx, sxy = [s + p for s, p in zip(self.sums, self.prior)]
+        mx, my = sx / w, sy / w
+        b = (sxy / w - mx * my) / (sxx / w - mx * mx)
+        b = min(max(b, PERIOD_RANGE[0] / MAX), PERIOD_RANGE[1] / MAX)
+        a = min(max(my - b * mx, SPINUP_RANGE[0]), SPINUP_RANGE[1])
+        return a, b
+
+
+class BodyEstimator:
+    """Tracks the body position from motor run times and body switch edges.
+
+    BodyController tells it when the motor starts and stops, and check() gets
+    called from the GPIO callback thread for every body switch edge.
+
+    Args:
+        pin (int): the body switch pin, to check edges against
+        per_move (float): position error each open-loop move adds
+        per_unit (float): position error each unit of open-loop travel adds
+    """
+    def __init__(self, pin, per_move = 3, per_unit = 0.02) -> None:
+        self.pin = pin
+        self.per_move = per_move
+        self.per_unit = per_unit
+        # Keyed by (direction, turning around), since turning around means
+        # taking up the slop in the gears first
+        self.fits = {(d, turn): _Fit(SPINUP, PERIOD / MAX) for d in (1, -1) for turn in (False, True)}
+        self.position = 0.0
+        # Nobody knows where the body is at startup
+        self.error = float(TOLERANCE)
+        self.crossings = 0
+        self.last_miss = None
+        self._lock = threading.Lock()
+        self._zero = threading.Condition(self._lock)
+        self._direction = 0
+        self._last = 0
+        self._fit = None
+        self._started = None
+        self._stopped = None
+        self._start_pos = 0.0
+        self._start_conf = 0.0
+        self._anchor = None
+
+    @property
+    def confidence(self):
+        """How much to trust the position, 1 right after an edge down to 0."""
+        return max(0.0, 1.0 - self.error / TOLERANCE)
+
+    @property
+    def period(self):
+        """Learned seconds for a full body cycle, averaged over both directions."""
+        return sum(fit.params()[1] for fit in self.fits.values()) * MAX / len(self.fits)
+
+    def _key(self, direction):
+        return (direction, self._last == -direction)
+
+    def _params(self, key):
+        """Timing for a kind of move, borrowing from the other kind going the
+        same way until there's been a sample of this one."""
+        direction, turn = key
+        fit = self.fits[key]
+        other = self.fits[(direction, not turn)]
+        if fit.samples or not other.samples:
+            return fit.params()
+        a, b = other.params()
+        # Turning around costs extra for the slop, carrying on doesn't
+        return max(0.0, a - SLOP * b) if turn is False else a + SLOP * b, b
+
+    def spinup(self, direction, turn = False):
+        """Learned seconds lost getting going in a direction.
+
+        Args:
+            direction (int): 1 forward, -1 reverse
+            turn (bool): the last move went the other way
+        """
+        return self.fits[(direction, turn)].params()[0]
+
+    def time_for(self, units, direction, turn = None):
+        """How long to run the motor to travel a distance from a standstill.
+
+        Args:
+            units (int): distance to travel
+            direction (int): 1 forward, -1 reverse
+            turn (bool): the motor turns around first, defaults to whether
+                the last move went the other way
+
+        Returns:
+            float: seconds
+        """
+        if units <= 0:
+            return 0.0
+        key = self._key(direction) if turn is None else (direction, turn)
+        a, b = self._params(key)
+        return a + b * units
+
+    def set(self, position, error = None):
+        """Overrides the estimate, for when something else knows better."""
+        with self._lock:
+            self.position = position % MAX
+            if error is not None:
+                self.error = error
+
+    def start(self, direction):
+        """The motor just started.
+
+        Args:
+            direction (int): 1 forward, -1 reverse
+        """
+        with self._lock:
+            self._fit = self._key(direction)
+            self._direction = direction
+            self._started = time.monotonic()
+            self._stopped = None
+            self._start_pos = self.position
+            self._start_conf = self.confidence
+            self._anchor = None
+
+    def stop(self):
+        """The motor just stopped. Works out where it ended up.
+
+        Returns:
+            float: the new position
+        """
+        with self._lock:
+            if self._started is None:
+                return self.position
+            now = time.monotonic()
+            self._stopped = now
+            direction = self._direction
+            a, b = self._params(self._fit)
+            if self._anchor is not None:
+                # Went past zero, only the bit since then is guesswork
+                since = (now - self._anchor) / b
+                self.position = (direction * since) % MAX
+                self.error = self.per_unit * since
+            else:
+                units = max(0.0, now - self._started - a) / b
+                self.position = (self._start_pos + direction * units) % MAX
+                self.error = min(TOLERANCE, self.error + self.per_move + self.per_unit * units)
+            self._started = None
+            self._last = direction
+            return self.position
+
+    def _to_zero(self):
+        """Units from the start of this move to the next zero crossing."""
+        if self._direction == 1:
+            return (MAX - self._start_pos) % MAX or MAX
+        return self._start_pos % MAX
+
+    def check(self, pin, level):
+        """Edge callback, see motors._EdgeWatcher. Zero is where the switch
+        closes going forward, which is where it opens going backward."""
+        if pin != self.pin:
+            return
+        now = time.monotonic()
+        with self._lock:
+            direction = self._direction
+            moving = self._started is not None
+            coasting = self._stopped is not None and now - self._stopped < COAST
+            if not direction or not (moving or coasting):
+                return
+            if level != (0 if direction == 1 else 1):
+                return
+            if moving:
+                elapsed = now - self._started
+                a, b = self._params(self._fit)
+                # Distance to this crossing. Starting right by zero it's anyone's
+                # guess whether it was a whole lap, so go with whichever number
+                # of laps fits how long it took.
+                travelled = (elapsed - a) / b
+                laps = max(0, round((travelled - self._to_zero()) / MAX))
+                units = self._to_zero() + MAX * laps
+                # How far out the position was, in units, for keeping an eye on it
+                self.last_miss = travelled - units
+                if self._start_conf >= MIN_CONFIDENCE and abs(self.last_miss) < MAX_MISS:
+                    self.fits[self._fit].add(units, elapsed, self._start_conf)
+                self._anchor = now
+            self.position = 0.0
+            self.error = 0.0
+            self.crossings += 1
+            self._zero.notify_all()
+
+    def wait_zero(self, timeout = None):
+        """Blocks until the body next goes past zero.
+
+        Returns:
+            bool: False if it timed out first
+        """
+        with self._lock:
+            seen = self.crossings
+            return self._zero.wait_for(lambda: self.crossings != seen, timeout)
@@ -0,0 +1,469 @@
+"""Scripted shows: a clip, the beak, body actions and blinks at exact times.
+
+Everything else the bird does is made up as it goes, from random sleeps, the
+actionmap and the audio amplitude. A show is written down ahead of time as a
+timeline, in seconds from the start:
+
+    {
+        "name": "avast",
+        "events": [
+            {"at": 0.0, "clip": "sounds/avastthere.wav"},
+            {"at": 0.2, "body": "wingshake"},
+            {"at": 2.0, "body": {"to": 100, "direction": -1}},
+            {"at": 3.6, "blink": true},
+            {"at": 4.2, "beak": 0.3}
+        ]
+    }
+
+A clip drives the beak from its envelope like a normal squawk ("lipsync":
+"beak", the default), or the beak and body ("all"), or nothing ("none").
+"beak" holds the beak open for that many seconds. "body" takes an action from
+the actionmap, {"to": position, "direction": 1 or -1}, or "reset".
+
+compile_timeline() works out every motor start and stop from the body cycle model (the
+learned timing in BodyEstimator), and refuses timelines that can't be
+performed: a body action that starts before the last one has finished, a blink
+while the beak is open (same motor), two clips at once. Player then fires the
+cues from one thread against one time.monotonic() start time, each at its own
+deadline, so a long show can't drift the way a chain of sleeps does, and
+records how late every cue was.
+
+    python -m squawker.choreography check show.json
+    python -m squawker.choreography play show.json --backend sim
+"""
+
+import argparse
+import json
+import os
+import threading
+import time
+from collections import namedtuple
+from . import actions, audioengine, envelope, lipsync, metrics, motors
+from .bodyposition import BodyEstimator
+from .wavfile import WavFile
+
+# Seconds a blink has the eye motor for, one turn of the eye cam and a bit
+BLINK_TIME = 0.45
+# Seconds between starting a show and its first cue, to get everything ready
+LEAD = 0.05
+
+JITTER = metrics.histogram("squawker_show_jitter_seconds", "How late each show cue fired.",
+                           ("kind",), buckets=metrics.CHUNK_BUCKETS)
+
+# One motor or clip change. t is seconds from the start of the show, event is
+# the index of the timeline event it came from.
+Cue = namedtuple("Cue", "t kind value event")
+
+
+class TimelineError(ValueError):
+    """The timeline can't be performed.
+
+    Args:
+        problems (list): everything wrong with it
+    """
+    def __init__(self, problems) -> None:
+        super().__init__("; ".join(problems))
+        self.problems = problems
+
+
+class _BodyModel:
+    """Enough of a BodyController for planning moves, without the hardware."""
+    MAX = motors.BodyController.MAX
+    DRIFT_PER_MOVE = motors.BodyController.DRIFT_PER_MOVE
+    DRIFT_PER_UNIT = motors.BodyController.DRIFT_PER_UNIT
+    _moveparams = motors.BodyController._moveparams
+    drift_for = motors.BodyController.drift_for
+
+    def __init__(self, estimator) -> None:
+        self.estimator = estimator
+
+
+class Program:
+    """A compiled timeline.
+
+    Args:
+        name (str): the show's name
+        cues (list): Cue tuples in the order they fire
+        clips (list): paths of the clips it plays
+        warnings (list): things that will work but maybe not how you meant
+    """
+    def __init__(self, name, cues, clips, warnings) -> None:
+        self.name = name
+        # Stops go before starts at the same time
+        self.cues = sorted(cues, key=lambda c: (c.t, c.value not in (0, None)))
+        self.clips = clips
+        self.warnings = warnings
+        self.duration = max((c.t for c in self.cues), default=0.0)
+
+    def describe(self):
+        """Returns:
+            str: the cues one per line, for checking a timeline by eye
+        """
+        lines = [f"{self.name}: {len(self.cues)} cues over {self.duration:.2f}s"]
+        for cue in self.cues:
+            lines.append(f"{cue.t:8.3f}  {cue.kind:5} {cue.value!s:40}  (event {cue.event})")
+        return "\n".join(lines)
+
+
+def _analysis(path, envelopes, chunk):
+    entry = envelopes.get(path) if envelopes is not None and envelopes.chunk == chunk else None
+    return entry or envelope.analyze(path, chunk)
+
+
+def _pairs(events, end):
+    """(start, stop) intervals from a sorted list of (t, on), closing any left open at end."""
+    intervals = []
+    since = None
+    for t, on in events:
+        if on and since is None:
+            since = t
+        elif not on and since is not None:
+            intervals.append((since, t))
+            since = None
+    if since is not None:
+        intervals.append((since, end))
+    return intervals
+
+
+def _body_steps(model, spec, pos, drift, problems, n):
+    """Motor steps for one body event, like actions.plan but from a known
+    position instead of the body's."""
+    if spec == "reset":
+        return [("reset", (model.MAX - pos) % model.MAX or model.MAX)], 0.0
+    if isinstance(spec, dict):
+        dst = spec.get("to")
+        if not isinstance(dst, int) or not 0 <= dst < model.MAX:
+            problems.append(f"event {n}: body position has to be 0 to {model.MAX - 1}")
+            return [], drift
+        if dst == pos:
+            return [], drift
+        units, direction = model._moveparams(pos, dst, model.MAX)
+        want = spec.get("direction", direction)
+        if want not in (1, -1):
+            problems.append(f"event {n}: body direction has to be 1 or -1")
+            return [], drift
+        if want != direction:
+            units, direction = model.MAX - units, want
+        to_zero = (model.MAX - pos) % model.MAX or model.MAX if direction == 1 else pos
+        drift = model.drift_for(units - to_zero, 0) if units >= to_zero else drift + model.drift_for(units)
+        return [("move", dst, direction, units)], drift
+    if spec not in actions.actionmap:
+        problems.append(f"event {n}: no body action called {spec!r}")
+        return [], drift
+    a, b = actions.actionmap[spec]["start"], actions.actionmap[spec]["end"]
+    options = [actions._segments(model, [leg], pos, drift, actions.DRIFT_THRESHOLD) for leg in ((a, b), (b, a))]
+    steps, _, drift = min(options, key=lambda o: o[1])
+    return steps, drift
+
+
+def compile_timeline(timeline, body=None, envelopes=None, start=0, base=None):
+    """Checks a timeline and works out all its cues.
+
+    Args:
+        timeline (dict): the parsed timeline
+        body (BodyController): whose learned timing to use, None for the defaults
+        envelopes (EnvelopeIndex): precomputed clip analysis, if there is one
+        start (int): body position the show starts from
+        base (str): directory clip paths are relative to
+
+    Returns:
+        Program: the cues
+
+    Raises:
+        TimelineError: it can't be performed
+    """
+    problems = []
+    warnings = []
+    cues = []
+    clips = []
+    # Who's using what, (start, end, event) per motor or the speaker
+    busy = {"speaker": [], "beak motor": [], "body motor": []}
+    model = _BodyModel(body.estimator if body is not None else BodyEstimator(None))
+    chunk = envelope.CHUNK
+
+    events = timeline.get("events", [])
+    order = sorted(range(len(events)), key=lambda i: events[i].get("at", 0) if isinstance(events[i], dict) else 0)
+    pos = start
+    last = 0
+    drift = body.drift if body is not None else 0.0
+    for n in order:
+        event = events[n]
+        at = event.get("at") if isinstance(event, dict) else None
+        if not isinstance(at, (int, float)) or at < 0:
+            problems.append(f"event {n}: needs an \"at\" time of 0 or more")
+            continue
+        kinds = [k for k in ("clip", "body", "blink", "beak") if k in event]
+        if len(kinds) != 1:
+            problems.append(f"event {n}: needs exactly one of clip, body, blink or beak")
+            continue
+        kind = kinds[0]
+
+        if kind == "clip":
+            path = event["clip"]
+            if base is not None and not os.path.isabs(path):
+                path = os.path.join(base, path)
+            try:
+                with WavFile(path) as wf:
+                    duration, rate = wf.duration, wf.rate
+                analysis = _analysis(path, envelopes, chunk)
+            except (OSError, ValueError) as e:
+                problems.append(f"event {n}: can't play {path}: {e}")
+                continue
+            clips.append(path)
+            cues.append(Cue(at, "clip", path, n))
+            busy["speaker"].append((at, at + duration, n))
+            mode = event.get("lipsync", "beak")
+            if mode not in ("beak", "all", "none"):
+                problems.append(f"event {n}: lipsync has to be beak, all or none")
+                continue
+            if mode == "none":
+                continue
+            schedule = lipsync.schedule(analysis["decisions"], chunk / rate, beak=analysis.get("beak"))
+            for motor in (("beak", "body") if mode == "all" else ("beak",)):
+                switches = [(at + t, on) for t, m, on in schedule if m == motor]
+                for t0, t1 in _pairs(switches, at + duration):
+                    cues.append(Cue(t0, motor, 1, n))
+                    cues.append(Cue(t1, motor, 0, n))
+                    busy["beak motor" if motor == "beak" else "body motor"].append((t0, t1, n))
+
+        elif kind == "beak":
+            hold = event["beak"]
+            if not isinstance(hold, (int, float)) or hold <= 0:
+                problems.append(f"event {n}: beak needs the seconds to hold it open")
+                continue
+            cues.append(Cue(at, "beak", 1, n))
+            cues.append(Cue(at + hold, "beak", 0, n))
+            busy["beak motor"].append((at, at + hold, n))
+
+        elif kind == "blink":
+            cues.append(Cue(at, "blink", None, n))
+            busy["beak motor"].append((at, at + BLINK_TIME, n))
+
+        else:
+            steps, drift = _body_steps(model, event["body"], pos, drift, problems, n)
+            if any(step[0] == "reset" for step in steps) and event["body"] != "reset":
+                warnings.append(f"event {n}: the body will have drifted too far, it goes back to zero first")
+            t = at
+            for step in steps:
+                if step[0] == "pause":
+                    t += step[1]
+                    continue
+                if step[0] == "reset":
+                    dst, direction, units = 0, 1, step[1]
+                else:
+                    _, dst, direction, units = step
+                seconds = model.estimator.time_for(units, direction, turn=last == -direction)
+                cues.append(Cue(t, "body", direction, n))
+                cues.append(Cue(t + seconds, "body", 0, n))
+                t += seconds
+                last = direction
+                pos = dst
+            if steps:
+                busy["body motor"].append((at, t, n))
+
+    for resource, intervals in busy.items():
+        intervals.sort()
+        clashes = set()
+        # Whatever reaches furthest so far, (end, event)
+        holder = None
+        for s, e, n in intervals:
+            if holder is not None and s < holder[0] and holder[1] != n and (holder[1], n) not in clashes:
+                clashes.add((holder[1], n))
+                problems.append(f"event {n} at {s:.2f}s needs the {resource} while event {holder[1]} "
+                                f"still has it until {holder[0]:.2f}s")
+            if holder is None or e > holder[0]:
+                holder = (e, n)
+    if problems:
+        raise TimelineError(problems)
+    return Program(timeline.get("name", "show"), cues, clips, warnings)
+
+
+def load(path, body=None, envelopes=None, start=0):
+    """Reads and compiles a timeline file. Clip paths are relative to the file.
+
+    Returns:
+        Program: the cues
+    """
+    with open(path) as f:
+        timeline = json.load(f)
+    return compile_timeline(timeline, body, envelopes, start, base=os.path.dirname(os.path.abspath(path)))
+
+
+class _BlinkWatch:
+    """Stops the eye motor once a blink's gone all the way round, from the
+    GPIO callback thread, the same way fullblink_async waits for it."""
+    def __init__(self, beak) -> None:
+        self.beak = beak
+        self.seen = False
+        self.done = threading.Event()
+
+    def check(self, pin, level):
+        if pin == self.beak.left_eye_switch and level == 1:
+            self.seen = True
+        if self.seen and not self.done.is_set() and self.beak.get_eye_state() == 'open':
+            self.beak.eye_beak_motor.throttle = 0
+            self.done.set()
+
+
+class Player:
+    """Performs a Program. play() blocks until it's over, stop() from anywhere
+    cuts it short.
+
+    Args:
+        program (Program): what to perform
+        beak (EyeBeakController): Motor attached to the beak/eyes
+        body (BodyController): Motor attached to the body
+        engine (AudioEngine): where the clips go, defaults to the process-wide one
+        library (SoundLibrary): to load clips out of RAM, if there is one
+    """
+    def __init__(self, program, beak, body, engine=None, library=None) -> None:
+        self.program = program
+        self.beak = beak
+        self.body = body
+        self.engine = engine
+        self.library = library
+        # (cue, seconds late) for every cue fired
+        self.late = []
+        self._stop = threading.Event()
+        self._audio = []
+        self._blinks = []
+        self._body_moving = False
+
+    def stop(self):
+        self._stop.set()
+
+    def _clip(self, wf):
+        engine = self.engine
+        with wf, engine.clip(wf.dtype, wf.channels, wf.rate) as stream:
+            for view in wf.chunks(envelope.CHUNK):
+                if self._stop.is_set():
+                    return
+                stream.write(wf.samples(view), wf.raw(view))
+
+    def _fire(self, cue, clip=None):
+        if cue.kind == "clip":
+            thread = threading.Thread(target=self._clip, args=(clip,), name="show-audio", daemon=True)
+            thread.start()
+            self._audio.append(thread)
+        elif cue.kind == "beak":
+            self.beak.eye_beak_motor.throttle = cue.value
+        elif cue.kind == "blink":
+            watch = _BlinkWatch(self.beak)
+            motors._watch(self.beak.left_eye_switch).add(watch)
+            motors._watch(self.beak.right_eye_switch).add(watch)
+            self._blinks.append(watch)
+            self.beak.eye_beak_motor.throttle = -1
+        elif cue.value:
+            self.body.estimator.start(cue.value)
+            self.body.body_motor.throttle = cue.value
+            self._body_moving = True
+        else:
+            self.body.body_motor.throttle = 0
+            self.body.estimator.stop()
+            self._body_moving = False
+
+    def _halt(self):
+        for watch in self._blinks:
+            motors._watch(self.beak.left_eye_switch).discard(watch)
+            motors._watch(self.beak.right_eye_switch).discard(watch)
+        self.beak.eye_beak_motor.throttle = 0
+        self.body.body_motor.throttle = 0
+        if self._body_moving:
+            self.body.estimator.stop()
+            self._body_moving = False
+
+    def play(self):
+        """Performs the show on this thread.
+
+        Returns:
+            bool: False if it got stopped
+        """
+        self.engine = self.engine or audioengine.get_engine()
+        self.engine.open()
+        # Everything gets opened before the clock starts, so a cue is just a motor write.
+        # One per clip cue, since the same clip can get played more than once
+        clips = {}
+        for i, cue in enumerate(self.program.cues):
+            if cue.kind == "clip":
+                clips[i] = self.library.load(cue.value) if self.library is not None else WavFile(cue.value)
+        # Clips go early by however long the sound card takes to play them
+        audio_lead = self.engine.output_latency
+        t0 = time.monotonic() + LEAD + audio_lead
+        try:
+            for i, cue in enumerate(self.program.cues):
+                due = t0 + cue.t - (audio_lead if cue.kind == "clip" else 0.0)
+                wait = due - time.monotonic()
+                if wait > 0 and self._stop.wait(wait):
+                    break
+                if self._stop.is_set():
+                    break
+                late = time.monotonic() - due
+                # The clip's thread closes it once it's played
+                self._fire(cue, clips.pop(i, None))
+                self.late.append((cue, late))
+                JITTER.observe(max(0.0, late), kind=cue.kind)
+            for thread in self._audio:
+                while thread.is_alive() and not self._stop.is_set():
+                    thread.join(0.1)
+            for watch in self._blinks:
+                watch.done.wait(max(0.0, t0 + self.program.duration + motors.MOVE_TIMEOUT - time.monotonic()))
+        finally:
+            self._halt()
+            # Whatever never got played
+            for wf in clips.values():
+                wf.close()
+        return not self._stop.is_set()
+
+    def report(self):
+        """How late the cues fired, per kind.
+
+        Returns:
+            dict: kind -> {"count", "mean", "p95", "max"} in seconds
+        """
+        out = {}
+        kinds = sorted({cue.kind for cue, _ in self.late})
+        for kind in kinds:
+            lates = sorted(late for cue, late in self.late if cue.kind == kind)
+            out[kind] = {
+                "count": len(lates),
+                "mean": sum(lates) / len(lates),
+                "p95": lates[min(len(lates) - 1, int(len(lates) * 0.95))],
+                "max": lates[-1],
+            }
+        return out
+
+
+if __name__ == '__main__':
+    from . import backend
+    parser = argparse.ArgumentParser(description='Check or perform a scripted show.')
+    parser.add_argument('command', choices=('check', 'play'))
+    parser.add_argument('timeline', help="Timeline JSON file.")
+    parser.add_argument('--backend', choices=sorted(backend.BACKENDS), default=backend.current(),
+                        help="Real hardware (pi) or the simulated bird (sim).")
+    parser.add_argument('--start', type=int, default=0, help="Body position to check from.")
+    args = parser.parse_args()
+
+    if args.command == 'check':
+        try:
+            program = load(args.timeline, start=args.start)
+        except TimelineError as e:
+            for problem in e.problems:
+                print(f"Problem: {problem}")
+            raise SystemExit(1)
+        print(program.describe())
+        for warning in program.warnings:
+            print(f"Warning: {warning}")
+    else:
+        import asyncio
+        backend.use(args.backend)
+        beak = motors.EyeBeakController()
+        body = motors.BodyController()
+        async def home():
+            await asyncio.gather(body.resetbody_async(), beak.fullblink_async())
+        asyncio.run(home())
+        program = load(args.timeline, body, start=body.timeposition)
+        player = Player(program, beak, body)
+        player.play()
+        for kind, s in player.report().items():
+            print(f"{kind:6} {s['count']:4d} cues, late by {s['mean'] * 1000:.2f}ms mean, "
+                  f"{s['p95'] * 1000:.2f}ms p95, {s['max'] * 1000:.2f}ms max")
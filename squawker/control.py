@@ -0,0 +1,293 @@
+"""A unix socket for telling the bird what to do.
+
+Writing a tag into /tmp/rfid only gets you a random special sound. run.py
+also listens on SOCKET_PATH, where anything local (a kiosk, a cron job, a
+shell) can ask for a particular clip or action, and find out where it got
+queued and how it went. The protocol is lines of text, one or more commands
+per line separated by ';'. Commands on the same line get queued together,
+before anything else gets a look in:
+
+    play [CLIP]         a clip from the bird's sound directories, by file
+                        name or full path, or a random one
+    action NAME...      body actions from the actionmap, in the quickest
+                        order, up to MAX_ACTIONS of them
+    blink               close and open the eyes
+    stop                drop everything queued and stop whatever's running
+    ping                check the bird's listening
+
+Every command gets a number, counting up from 1 on each connection, and the
+replies go by that number. A command gets a line when it's queued, with how
+many commands are ahead of it, and another when it's finished with, with
+its scheduler status (done, preempted, expired, cancelled or failed):
+
+    -> play holdtight.wav; action lookup headbob; blink
+    <- 1 queued 0
+    <- 2 queued 1
+    <- 3 queued 2
+    <- 1 done
+    ...
+    -> action flap
+    <- 4 error unknown action flap
+
+There's a client for shell scripts and kiosks:
+
+    python -m squawker.control "play holdtight.wav" blink
+    python -m squawker.control --no-wait stop
+"""
+
+import argparse
+import asyncio
+import os
+import socket
+import sys
+import time
+from . import actions, metrics, scheduler
+
+SOCKET_PATH = '/tmp/squawker.sock'
+# Longest line the server will take, in bytes
+LIMIT = 4096
+# Most actions one command can ask for. The planner tries every order of
+# them on the event loop, so no more than it'll do that for.
+MAX_ACTIONS = actions.MAX_EXHAUSTIVE
+
+COMMANDS = metrics.counter("squawker_control_commands_total",
+                           "Commands that came in over the control socket.", ("verb",))
+
+
+class ControlServer:
+    """Takes commands over a unix socket and hands them to the scheduler.
+
+    Args:
+        sched (Scheduler): what runs them
+        squawk (Squawk): what plays the clips, its beak and body get the actions and blinks
+        library (SoundLibrary): where the clips are
+        directories (list): where to look for clips asked for by name, the
+            first one's where random ones come from
+        deadline (float): seconds a command can wait in line, None for as long as it takes
+    """
+    def __init__(self, sched, squawk, library, directories, deadline = None) -> None:
+        self.sched = sched
+        self.squawk = squawk
+        self.library = library
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.deadline = deadline
+        # Handler tasks for the connected clients
+        self.clients = set()
+        self._server = None
+        self._path = None
+
+    def _clip(self, name):
+        """Works out which clip a play command means. Only clips the library
+        has from the directories will do, nothing else on the system gets opened.
+
+        Raises:
+            ValueError: there's no such clip
+        """
+        if not name:
+            path = self.library.choice(self.directories[0]) if self.directories else None
+            if path is None:
+                raise ValueError("no clips to pick from")
+            return path
+        if os.sep in name:
+            path = os.path.abspath(name)
+            if os.path.dirname(path) in self.directories and path in self.library.entries:
+                return path
+            raise ValueError(f"no clip at {name} in the sound directories")
+        for directory in self.directories:
+            for file in (name, name + '.wav'):
+                path = os.path.join(directory, file)
+                if path in self.library.entries:
+                    return path
+        raise ValueError(f"unknown clip {name}")
+
+    def command(self, line, trigger = None):
+        """Turns one command into something for the scheduler.
+
+        Args:
+            line (str): the command, like "play holdtight.wav"
+            trigger (float): time.monotonic() it came in, for latency reporting
+
+        Returns:
+            Command: ready to submit, or None for the ones that don't queue
+            anything (stop and ping)
+
+        Raises:
+            ValueError: it isn't a command this understands
+        """
+        verb, _, rest = line.strip().partition(' ')
+        rest = rest.strip()
+        if verb == "play":
+            # Asked for from outside, like an RFID tap, so it jumps the queue
+            return scheduler.PlaySound(self.squawk, self._clip(rest), trigger, scheduler.RFID, self.deadline)
+        if verb == "action":
+            names = rest.split()
+            if not names:
+                raise ValueError("action needs at least one action name")
+            if len(names) > MAX_ACTIONS:
+                raise ValueError(f"too many actions, {MAX_ACTIONS} at most")
+            for name in names:
+                if name not in actions.actionmap:
+                    raise ValueError(f"unknown action {name}")
+            return scheduler.BodyMotion(self.squawk.body, names, self.deadline)
+        if verb == "blink":
+            return scheduler.Blink(self.squawk.beak, self.deadline)
+        if verb in ("stop", "ping"):
+            return None
+        raise ValueError(f"unknown command {verb or '(blank)'}")
+
+    def _connected(self, reader, writer):
+        # A task of our own rather than handing asyncio.start_unix_server a
+        # coroutine, which would log the CancelledError when close() stops it
+        task = asyncio.ensure_future(self._client(reader, writer))
+        self.clients.add(task)
+        task.add_done_callback(self.clients.discard)
+
+    async def _client(self, reader, writer):
+        count = 0
+        pending = set()
+
+        def reply(text):
+            if not writer.is_closing():
+                writer.write(f"{text}\n".encode())
+
+        async def finished(n, command):
+            await command.future
+            if command.status == scheduler.FAILED:
+                reply(f"{n} {command.status} {command.error}")
+            else:
+                reply(f"{n} {command.status}")
+
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    reply(f"{count + 1} error line too long")
+                    break
+                if not line:
+                    break
+                trigger = time.monotonic()
+                # The whole line gets queued before anything gets a chance to run
+                for text in line.decode(errors='replace').split(';'):
+                    if not text.strip():
+                        continue
+                    count += 1
+                    try:
+                        command = self.command(text, trigger)
+                    except ValueError as e:
+                        reply(f"{count} error {e}")
+                        continue
+                    verb = text.split()[0]
+                    COMMANDS.inc(verb=verb)
+                    if verb == "stop":
+                        reply(f"{count} stopped {self.sched.clear()}")
+                    elif command is None:
+                        reply(f"{count} pong")
+                    else:
+                        self.sched.submit(command)
+                        reply(f"{count} queued {self.sched.position(command)}")
+                        task = asyncio.ensure_future(finished(count, command))
+                        pending.add(task)
+                        task.add_done_callback(pending.discard)
+                await writer.drain()
+            # Hang around for the results of anything still going
+            if pending:
+                await asyncio.gather(*pending)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        except asyncio.CancelledError:
+            # The server's shutting down
+            writer.close()
+            raise
+        finally:
+            for task in pending:
+                task.cancel()
+            writer.close()
+
+    async def serve(self, path = SOCKET_PATH):
+        """Listens on a unix socket. Runs forever.
+
+        Args:
+            path (str): where the socket goes
+        """
+        if os.path.exists(path):
+            os.unlink(path)
+        self._path = path
+        self._server = await asyncio.start_unix_server(self._connected, path, limit=LIMIT)
+        print(f"Taking commands on {path}")
+        try:
+            await self._server.serve_forever()
+        finally:
+            await self.close()
+
+    async def close(self):
+        """Stops listening, and waits for the client handlers to wind up."""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+        clients = list(self.clients)
+        for task in clients:
+            task.cancel()
+        await asyncio.gather(*clients, return_exceptions=True)
+        if self._path is not None and os.path.exists(self._path):
+            os.unlink(self._path)
+            self._path = None
+
+
+def send(commands, path = SOCKET_PATH, wait = True, out = None):
+    """Sends a batch of commands and prints the replies.
+
+    Args:
+        commands (list): commands, like "play holdtight.wav"
+        path (str): the bird's control socket
+        wait (bool): wait for them to finish, not just to be queued
+        out (file): where the replies go, defaults to stdout
+
+    Returns:
+        bool: True if everything went through (and, waiting, finished with done)
+    """
+    out = out or sys.stdout
+    commands = [c.strip() for line in commands for c in line.split(';') if c.strip()]
+    if not commands:
+        return True
+    ok = True
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        sock.sendall(("; ".join(commands) + "\n").encode())
+        # Replies still to come: one per command, and a second for the queued ones
+        left = len(commands)
+        with sock.makefile('r') as replies:
+            while left:
+                line = replies.readline()
+                if not line:
+                    print("Connection closed early", file=out)
+                    return False
+                out.write(line)
+                out.flush()
+                n, status, *_ = line.split() + [""]
+                if status == "queued":
+                    if wait:
+                        left += 1
+                elif status not in ("done", "stopped", "pong"):
+                    ok = False
+                left -= 1
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Tell a running bird what to do.")
+    parser.add_argument('commands', nargs='*',
+                        help="Commands like 'play holdtight.wav', 'action lookup', 'blink', 'stop'. "
+                             "Read from stdin, one per line, if there aren't any.")
+    parser.add_argument('--socket', default=SOCKET_PATH, help="The bird's control socket.")
+    parser.add_argument('--no-wait', action='store_true', help="Just wait for them to be queued.")
+    args = parser.parse_args()
+
+    commands = args.commands or sys.stdin.read().splitlines()
+    try:
+        ok = send(commands, args.socket, not args.no_wait)
+    except OSError as e:
+        print(f"Can't reach the bird on {args.socket}: {e}")
+        sys.exit(2)
+    sys.exit(0 if ok else 1)
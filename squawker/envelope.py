@@ -0,0 +1,274 @@
+"""Offline amplitude analysis of the wav files.
+
+Squawk used to work out the average amplitude of every CHUNK while the clip was
+playing, which is a pile of numpy work in the middle of the audio loop on a Pi Zero.
+This module does that work once per file and keeps the results in a json index
+on disk, keyed by the file's path, size and mtime so an edited file gets
+re-analyzed. Playback then just looks up the motor decision for each chunk,
+and the beak goes by the syllable track from squawker.syllables when the
+lookahead schedule is on. New files get analyzed in a pool of worker
+processes, see analyze_all().
+
+The index can be built ahead of time with:
+
+    python -m squawker.envelope sounds specialsounds
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from . import metrics, syllables
+from .wavfile import WavFile, WavError
+
+CHUNK = 2048
+INDEX_PATH = os.path.expanduser("~/.cache/squawker/envelopes.json")
+
+# Converted amplitude (mean(abs(chunk)) / 50) needed to open the beak,
+# and to also run the body motor.
+BEAK_THRESHOLD = 15
+BODY_THRESHOLD = 20
+
+# Motor decisions stored per chunk
+CLOSED = 0
+BEAK = 1
+BEAK_BODY = 2
+
+
+def amplitude(np_data):
+    """Average converted amplitude of one chunk of wav data.
+
+    Args:
+        np_data (ndarray): one of the wav chunks
+
+    Returns:
+        float: mean absolute amplitude / 50
+    """
+    start = time.perf_counter()
+    avg = float(np.mean(np.absolute(np_data))) / 50
+    metrics.ENVELOPE_CHUNK.observe(time.perf_counter() - start)
+    return avg
+
+
+def decide(avg):
+    """Which motors should be running for a chunk of the given amplitude.
+
+    Args:
+        avg (float): converted amplitude from amplitude()
+
+    Returns:
+        int: CLOSED, BEAK or BEAK_BODY
+    """
+    if avg > BEAK_THRESHOLD:
+        if avg > BODY_THRESHOLD:
+            return BEAK_BODY
+        return BEAK
+    return CLOSED
+
+
+def analyze(filename, chunk=CHUNK):
+    """Reads the whole wav file and calculates the amplitude envelope
+    the same way playback chunks it.
+
+    Args:
+        filename (str): Path to the wave file
+        chunk (int): Wave data chunk size, in frames
+
+    Returns:
+        dict: chunk size, per-chunk envelope and decisions, peak and mean
+        amplitude, and the beak track ([open, close] milliseconds)
+    """
+    with WavFile(filename) as wf:
+        envelope = []
+        peak = 0
+        for view in wf.chunks(chunk):
+            levels = wf.levels(view)
+            envelope.append(amplitude(levels))
+            peak = max(peak, int(np.max(np.absolute(levels.astype(np.int32)))))
+        beak = syllables.track(wf.levels(wf.frames), wf.rate)
+
+    return {
+        "chunk": chunk,
+        "envelope": envelope,
+        "decisions": [decide(avg) for avg in envelope],
+        "peak": peak,
+        "mean": float(np.mean(envelope)) if envelope else 0.0,
+        "beak": beak,
+    }
+
+
+def analyze_all(filenames, chunk=CHUNK, workers=None):
+    """Runs analyze() over a batch of files in worker processes, so the FFTs
+    use every core and stay out of the way of the event loop.
+
+    Args:
+        filenames (list): paths to wave files
+        chunk (int): Wave data chunk size, in frames
+        workers (int): processes to use, None for one per core
+
+    Yields:
+        tuple: (filename, analyze() result or the exception it raised),
+        in whatever order they finish
+    """
+    if len(filenames) < 2 or workers == 1:
+        # Not worth starting processes for
+        for filename in filenames:
+            try:
+                yield filename, analyze(filename, chunk)
+            except (OSError, WavError) as e:
+                yield filename, e
+        return
+    # Not forked, this can get called with the motor threads running
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver")) as pool:
+        futures = {pool.submit(analyze, filename, chunk): filename for filename in filenames}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result()
+            except (OSError, WavError) as e:
+                yield futures[future], e
+
+
+class EnvelopeIndex:
+    """On-disk cache of analyze() results.
+
+    Entries are keyed by absolute path and remember the size and mtime
+    of the file they were built from, so stale entries are ignored.
+    """
+    def __init__(self, path=INDEX_PATH, chunk=CHUNK) -> None:
+        self.path = path
+        self.chunk = chunk
+        self.entries = {}
+        self._dirty = False
+
+    @classmethod
+    def load(cls, path=INDEX_PATH, chunk=CHUNK):
+        """Loads the index from disk. A missing or broken index just starts empty.
+
+        Args:
+            path (str): json file the index lives in
+            chunk (int): chunk size playback will use
+
+        Returns:
+            EnvelopeIndex: the loaded index
+        """
+        index = cls(path, chunk)
+        try:
+            with open(path, 'r') as f:
+                index.entries = json.load(f)
+        except (OSError, ValueError):
+            print(f"No usable envelope index at {path}, starting a new one.")
+        return index
+
+    def save(self):
+        """Writes the index back to disk if anything changed."""
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f)
+        os.replace(tmp, self.path)
+        self._dirty = False
+
+    def _stamp(self, filename):
+        st = os.stat(filename)
+        return st.st_size, st.st_mtime
+
+    def get(self, filename):
+        """Returns the cached analysis for a file, or None if there isn't
+        a current one.
+
+        Args:
+            filename (str): Path to the wave file
+
+        Returns:
+            dict: the analyze() result, or None
+        """
+        key = os.path.abspath(filename)
+        entry = self.entries.get(key)
+        # Entries from before the beak track get redone
+        if entry is None or entry.get("chunk") != self.chunk or "beak" not in entry:
+            return None
+        try:
+            size, mtime = self._stamp(filename)
+        except OSError:
+            return None
+        if entry.get("size") != size or entry.get("mtime") != mtime:
+            return None
+        return entry
+
+    def add(self, filename, entry=None):
+        """Analyzes a file and stores the result in the index.
+
+        Args:
+            filename (str): Path to the wave file
+            entry (dict): analyze() result if it's already been worked out
+
+        Returns:
+            dict: the new entry
+        """
+        size, mtime = self._stamp(filename)
+        if entry is None:
+            entry = analyze(filename, self.chunk)
+        entry["size"] = size
+        entry["mtime"] = mtime
+        self.entries[os.path.abspath(filename)] = entry
+        self._dirty = True
+        return entry
+
+    def update(self, filenames, workers=None):
+        """Analyzes whichever of the files don't have a current entry, all at
+        once in worker processes.
+
+        Args:
+            filenames (list): paths to wave files
+            workers (int): processes to use, None for one per core
+
+        Returns:
+            int: number of files that had to be analyzed
+        """
+        stale = [f for f in filenames if f.lower().endswith('.wav') and self.get(f) is None]
+        count = 0
+        for filename, result in analyze_all(stale, self.chunk, workers):
+            if isinstance(result, Exception):
+                print(f"Skipping {filename}: {result}")
+                continue
+            try:
+                self.add(filename, result)
+            except OSError as e:
+                print(f"Skipping {filename}: {e}")
+                continue
+            count += 1
+        return count
+
+    def build(self, directories, workers=None):
+        """Makes sure every wav file in the directories has a current entry.
+
+        Args:
+            directories (list): directories full of wav files
+            workers (int): processes to use, None for one per core
+
+        Returns:
+            int: number of files that had to be analyzed
+        """
+        filenames = []
+        for directory in directories:
+            filenames += [os.path.join(directory, file) for file in sorted(os.listdir(directory))]
+        return self.update(filenames, workers)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Precompute amplitude envelopes for directories of wav files.')
+    parser.add_argument('dirs', nargs='+', help="Directories with wav files.")
+    parser.add_argument('--index', default=INDEX_PATH, help="Where to store the index.")
+    parser.add_argument('--workers', type=int, default=None, help="Processes to analyze with, default one per core.")
+    args = parser.parse_args()
+
+    index = EnvelopeIndex.load(args.index)
+    built = index.build(args.dirs, args.workers)
+    index.save()
+    print(f"Analyzed {built} files, {len(index.entries)} in index.")
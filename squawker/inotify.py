@@ -0,0 +1,121 @@
+"""Just enough of Linux inotify (through ctypes, no extra packages) to let
+a coroutine sleep until a file or directory changes instead of polling it."""
+
+import asyncio
+import ctypes
+import ctypes.util
+import os
+import struct
+
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+_EVENT = struct.Struct('iIII')
+
+_libc = None
+
+
+def _load():
+    global _libc
+    if _libc is None:
+        name = ctypes.util.find_library('c')
+        libc = ctypes.CDLL(name, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify isn't available on this system")
+        _libc = libc
+    return _libc
+
+
+def available():
+    """Whether inotify can be used here.
+
+    Returns:
+        bool: True on Linux with a libc that has inotify
+    """
+    try:
+        _load()
+    except OSError:
+        return False
+    return True
+
+
+class Inotify:
+    """A non-blocking inotify file descriptor.
+
+    Raises:
+        OSError: inotify isn't available or the kernel said no
+    """
+    def __init__(self) -> None:
+        self._libc = _load()
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+    def fileno(self):
+        return self.fd
+
+    def add_watch(self, path, mask):
+        """Starts watching a path.
+
+        Args:
+            path (str): file or directory to watch
+            mask (int): IN_* flags for the events wanted
+
+        Returns:
+            int: watch descriptor
+        """
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        return wd
+
+    def read(self):
+        """Reads whatever events are waiting without blocking.
+
+        Returns:
+            list: (watch descriptor, mask, name) tuples
+        """
+        try:
+            buf = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos + _EVENT.size <= len(buf):
+            wd, mask, cookie, length = _EVENT.unpack_from(buf, pos)
+            pos += _EVENT.size
+            name = buf[pos:pos + length].rstrip(b'\0').decode(errors='replace')
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+    async def wait(self):
+        """Suspends until events arrive, then returns them.
+
+        Returns:
+            list: (watch descriptor, mask, name) tuples
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            events = self.read()
+            if events:
+                return events
+            ready = loop.create_future()
+            loop.add_reader(self.fd, lambda: ready.done() or ready.set_result(None))
+            try:
+                await ready
+            finally:
+                loop.remove_reader(self.fd)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
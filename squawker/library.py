@@ -0,0 +1,221 @@
+"""Index of the sound directories, with hot reload and a RAM cache of clips.
+
+run.py used to os.listdir() the sound directories once at startup, so a stray
+non-wav file crashed playback and adding a sound meant a restart. The library
+only lists files that actually open as wav files, keeps their metadata
+(duration, rate, channels, peak, envelope), and watches the directories with
+inotify so new, changed and deleted files are picked up while running.
+
+Recently played clips are kept decoded in RAM, up to a byte budget, so playing
+them again doesn't touch the SD card. The least recently played go first.
+"""
+
+import asyncio
+import os
+import random
+import threading
+from collections import OrderedDict
+import numpy as np
+from . import inotify
+from .envelope import EnvelopeIndex
+from .wavfile import WavFile, WavError
+
+BUDGET = 32 * 1024 * 1024
+# How often to rescan the directories when inotify isn't there
+RESCAN = 30
+
+
+class Clip(WavFile):
+    """A wav file decoded into RAM. Works anywhere a WavFile does.
+
+    Args:
+        wf (WavFile): open file to copy the samples out of
+    """
+    def __init__(self, wf) -> None:
+        self.path = wf.path
+        self.channels = wf.channels
+        self.rate = wf.rate
+        self.sampwidth = wf.sampwidth
+        self.bits = wf.bits
+        self.format = wf.format
+        self.nframes = wf.nframes
+        self.data_offset = wf.data_offset
+        self._raw = wf._raw
+        self.frames = np.array(wf.frames)
+
+    @property
+    def nbytes(self):
+        return self.frames.nbytes
+
+    def close(self):
+        # Stays in the cache, nothing to let go of
+        pass
+
+
+class SoundLibrary:
+    """Keeps track of the wav files in some directories.
+
+    Args:
+        directories (list): directories full of wav files
+        envelopes (EnvelopeIndex): where the amplitude analysis lives
+        budget (int): bytes of decoded clips to keep in RAM
+    """
+    def __init__(self, directories, envelopes=None, budget=BUDGET) -> None:
+        self.directories = [os.path.abspath(d) for d in directories]
+        self.envelopes = envelopes if envelopes is not None else EnvelopeIndex.load()
+        self.budget = budget
+        self.entries = {}
+        self.cached = OrderedDict()
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        # Clips get loaded on the playback thread and indexed on executor threads,
+        # while the event loop picks from entries. Every change to entries or
+        # cached holds this, and anything going through entries takes a copy.
+        self._lock = threading.Lock()
+
+    def _index(self, path):
+        """Adds or refreshes one file. Anything that isn't a playable wav is left out.
+
+        Returns:
+            bool: True if the file is in the index now
+        """
+        if not path.lower().endswith('.wav'):
+            self._forget(path)
+            return False
+        try:
+            with WavFile(path) as wf:
+                meta = {"duration": wf.duration, "rate": wf.rate, "channels": wf.channels}
+            analysis = self.envelopes.get(path) or self.envelopes.add(path)
+        except (OSError, WavError) as e:
+            print(f"Leaving {path} out of the sound library: {e}")
+            self._forget(path)
+            return False
+        meta["peak"] = analysis["peak"]
+        meta["envelope"] = analysis["envelope"]
+        # Swapped in in one go, so nobody sees the file missing while it's redone
+        with self._lock:
+            self.entries[path] = meta
+            self._uncache(path)
+        return True
+
+    def _forget(self, path):
+        with self._lock:
+            self.entries.pop(path, None)
+            self._uncache(path)
+
+    def _uncache(self, path):
+        # Only with _lock held
+        clip = self.cached.pop(path, None)
+        if clip is not None:
+            self.cached_bytes -= clip.nbytes
+
+    def scan(self):
+        """Indexes everything in the directories from scratch.
+
+        Returns:
+            int: number of clips in the library
+        """
+        present = []
+        for directory in self.directories:
+            present += [os.path.join(directory, file) for file in sorted(os.listdir(directory))]
+        # Anything new gets analyzed in one go, in worker processes
+        self.envelopes.update(present)
+        for path in present:
+            if path not in self.entries or self.envelopes.get(path) is None:
+                self._index(path)
+        with self._lock:
+            gone = set(self.entries) - set(present)
+        for path in gone:
+            self._forget(path)
+        self.envelopes.save()
+        return len(self.entries)
+
+    def files(self, directory=None):
+        """Paths of the indexed clips.
+
+        Args:
+            directory (str): only list clips in this directory
+
+        Returns:
+            list: paths
+        """
+        with self._lock:
+            paths = list(self.entries)
+        if directory is None:
+            return paths
+        directory = os.path.abspath(directory)
+        return [p for p in paths if os.path.dirname(p) == directory]
+
+    def choice(self, directory=None):
+        """A random clip, or None if there aren't any.
+
+        Args:
+            directory (str): only pick from this directory
+
+        Returns:
+            str: path of the clip
+        """
+        files = self.files(directory)
+        return random.choice(files) if files else None
+
+    def load(self, path):
+        """Gets a clip decoded in RAM, from the cache if it's there.
+        Clips bigger than the whole budget just get played from the file.
+
+        Args:
+            path (str): path of the clip
+
+        Returns:
+            WavFile: a Clip, or an open WavFile for clips too big to cache
+        """
+        path = os.path.abspath(path)
+        with self._lock:
+            clip = self.cached.get(path)
+            if clip is not None:
+                self.hits += 1
+                self.cached.move_to_end(path)
+                return clip
+            self.misses += 1
+        wf = WavFile(path)
+        if wf.nframes * wf.channels * wf.sampwidth > self.budget:
+            return wf
+        with wf:
+            clip = Clip(wf)
+        with self._lock:
+            self.cached[path] = clip
+            self.cached_bytes += clip.nbytes
+            while self.cached_bytes > self.budget:
+                old, evicted = self.cached.popitem(last=False)
+                self.cached_bytes -= evicted.nbytes
+        return clip
+
+    async def watch(self):
+        """Keeps the index up to date as files come and go. Runs forever."""
+        loop = asyncio.get_running_loop()
+        if not inotify.available():
+            while True:
+                await asyncio.sleep(RESCAN)
+                await loop.run_in_executor(None, self.scan)
+        watcher = inotify.Inotify()
+        dirs = {}
+        for directory in self.directories:
+            wd = watcher.add_watch(directory, inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO |
+                                   inotify.IN_MOVED_FROM | inotify.IN_DELETE)
+            dirs[wd] = directory
+        try:
+            while True:
+                for wd, mask, name in await watcher.wait():
+                    if wd not in dirs or not name:
+                        continue
+                    path = os.path.join(dirs[wd], name)
+                    if mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                        if path in self.entries:
+                            print(f"Sound removed: {path}")
+                        self._forget(path)
+                    # Analysis is numpy work, keep it off the event loop
+                    elif await loop.run_in_executor(None, self._index, path):
+                        print(f"Sound added: {path}")
+                self.envelopes.save()
+        finally:
+            watcher.close()
@@ -0,0 +1,124 @@
+"""Lookahead scheduling for the beak and body motors.
+
+Turning the beak motor on for the chunk that's playing right now is already
+too late: the motor takes tens of milliseconds to spin up and the gears have to
+take up their slop, so the beak visibly trails the audio. With the envelope
+worked out ahead of time we can see what's coming and start each motor early by
+its actuation latency. Minimum on and off times stop the motor getting
+switched every 46ms chunk, which it can't keep up with anyway.
+
+When the analysis has a syllable track (see squawker.syllables) the beak goes
+by that instead of the chunk decisions, which already has its hold times
+worked in.
+"""
+
+import threading
+import time
+from . import envelope
+
+# Seconds between telling a motor to move and it visibly moving
+BEAK_LATENCY = 0.06
+BODY_LATENCY = 0.1
+# Once switched, leave a motor alone for at least this long
+MIN_ON = 0.09
+MIN_OFF = 0.07
+
+
+def _track(states, chunk_seconds, min_on, min_off):
+    """Turns per-chunk on/off states into switch times, honoring hold times.
+
+    Args:
+        states (list): bool per chunk
+        chunk_seconds (float): length of a chunk
+        min_on (float): shortest time to stay on
+        min_off (float): shortest time to stay off
+
+    Returns:
+        list: (seconds, on) for every change
+    """
+    changes = []
+    state = False
+    since = -min_off
+    for i, want in enumerate(states):
+        t = i * chunk_seconds
+        hold = min_on if state else min_off
+        if want != state and t - since >= hold:
+            state = want
+            since = t
+            changes.append((t, state))
+    return changes
+
+
+def schedule(decisions, chunk_seconds, beak_latency=BEAK_LATENCY, body_latency=BODY_LATENCY,
+             min_on=MIN_ON, min_off=MIN_OFF, beak=None):
+    """Works out when to switch each motor for a clip.
+
+    Args:
+        decisions (list): per-chunk envelope decisions for the clip
+        chunk_seconds (float): length of a chunk
+        beak_latency (float): how early to switch the beak motor
+        body_latency (float): how early to switch the body motor
+        min_on (float): shortest time to leave a motor on
+        min_off (float): shortest time to leave a motor off
+        beak (list): [open, close] milliseconds from the analysis, None to
+            run the beak off the decisions too
+
+    Returns:
+        list: (seconds from the first sample, motor, on) sorted by time,
+        where motor is "beak" or "body"
+    """
+    tracks = [("body", [d == envelope.BEAK_BODY for d in decisions], body_latency)]
+    events = []
+    if beak is None:
+        tracks.append(("beak", [d in (envelope.BEAK, envelope.BEAK_BODY) for d in decisions], beak_latency))
+    else:
+        for start, end in beak:
+            events.append((max(0.0, float(start) / 1000 - beak_latency), "beak", True))
+            events.append((max(0.0, float(end) / 1000 - beak_latency), "beak", False))
+    for motor, states, latency in tracks:
+        for t, on in _track(states, chunk_seconds, min_on, min_off):
+            events.append((max(0.0, t - latency), motor, on))
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+class LipSync:
+    """Fires a clip's scheduled motor events on their own thread, timed from
+    when the first sample is heard.
+
+    Args:
+        events (list): from schedule()
+        send (function): called with (motor, on) at each event's time
+    """
+    def __init__(self, events, send) -> None:
+        self.events = events
+        self.send = send
+        self.fired = 0
+        self.max_late = 0.0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, t0):
+        """Starts firing events.
+
+        Args:
+            t0 (float): time.monotonic() when the first sample comes out of the speaker
+        """
+        self._thread = threading.Thread(target=self._run, args=(t0,), name="lipsync", daemon=True)
+        self._thread.start()
+
+    def _run(self, t0):
+        for t, motor, on in self.events:
+            wait = t0 + t - time.monotonic()
+            if wait > 0 and self._stop.wait(wait):
+                return
+            if self._stop.is_set():
+                return
+            self.max_late = max(self.max_late, time.monotonic() - (t0 + t))
+            self.send(motor, on)
+            self.fired += 1
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
@@ -0,0 +1,350 @@
+"""Counters and histograms for seeing where the time goes on a running bird.
+
+Everything registers itself in REGISTRY when its module is imported, and the
+whole lot comes out in the Prometheus text format, either as a textfile for
+node_exporter's textfile collector or from a little HTTP endpoint on a TCP
+port or a unix socket:
+
+    curl http://127.0.0.1:9101/metrics
+    curl --unix-socket /tmp/squawker-metrics.sock http://bird/metrics
+
+Updates come from the event loop, the audio threads and the GPIO callback
+thread, so each metric has its own lock.
+"""
+
+import asyncio
+import os
+import threading
+import time
+from . import trace
+
+# Seconds, for latencies that matter to a person watching the bird
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+# Seconds, for bits of work done once per audio chunk
+CHUNK_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+
+START = time.monotonic()
+
+
+def _labelstr(names, values, extra = None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def _num(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = None
+
+    def __init__(self, name, help, labels = ()) -> None:
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError(f"{self.name} takes labels {self.labels}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labels)
+
+    def samples(self):
+        """Returns:
+            list: (name suffix, label values, extra label, value)
+        """
+        with self._lock:
+            return [("", key, None, value) for key, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        for suffix, key, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}{_labelstr(self.labels, key, extra)} {_num(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """Something that only goes up."""
+    kind = "counter"
+
+    def __init__(self, name, help, labels = ()) -> None:
+        super().__init__(name, help, labels)
+        if not self.labels:
+            # Show up as 0 rather than not at all
+            self._values[()] = 0
+
+    def inc(self, amount = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Gauge(_Metric):
+    """A value that goes up and down. With fn, it's worked out when the
+    metrics are read instead, fn returning {label values tuple: value}.
+    """
+    kind = "gauge"
+
+    def __init__(self, name, help, labels = (), fn = None) -> None:
+        super().__init__(name, help, labels)
+        self.fn = fn
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def samples(self):
+        if self.fn is None:
+            return super().samples()
+        return [("", tuple(str(v) for v in key), None, value) for key, value in sorted(self.fn().items())]
+
+
+class Histogram(_Metric):
+    """Counts observations into buckets, for latencies and durations."""
+    kind = "histogram"
+
+    def __init__(self, name, help, labels = (), buckets = LATENCY_BUCKETS) -> None:
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+                    break
+            entry[1] += value
+            entry[2] += 1
+
+    def count(self, **labels):
+        with self._lock:
+            entry = self._values.get(self._key(labels))
+            return entry[2] if entry else 0
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._values.items()):
+                running = 0
+                for bound, n in zip(self.buckets, counts):
+                    running += n
+                    out.append(("_bucket", key, ("le", _num(bound)), running))
+                out.append(("_sum", key, None, total))
+                out.append(("_count", key, None, count))
+        return out
+
+
+class Registry:
+    """All the metrics, in the order they were made."""
+    def __init__(self) -> None:
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f"{name} is already a {metric.kind}")
+            return metric
+
+    def counter(self, name, help, labels = ()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels = (), fn = None):
+        return self._get(Gauge, name, help, labels, fn)
+
+    def histogram(self, name, help, labels = (), buckets = LATENCY_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets)
+
+    def render(self):
+        """Returns:
+            str: every metric in the Prometheus text format
+        """
+        with self._lock:
+            metrics = list(self.metrics.values())
+        return "\n".join(m.render() for m in metrics) + "\n"
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+UPTIME = gauge("squawker_uptime_seconds", "Seconds since the process started.",
+               fn=lambda: {(): time.monotonic() - START})
+TRIGGER_LATENCY = histogram("squawker_trigger_latency_seconds",
+                            "RFID detect (or sound start) to the first sample coming out of the speaker.")
+LOOP_LAG = histogram("squawker_loop_lag_seconds",
+                     "How late the asyncio event loop wakes up a sleeping coroutine.")
+UNDERRUNS = counter("squawker_audio_underruns_total",
+                    "PortAudio output underflows, the speaker ran out of samples.")
+ENVELOPE_CHUNK = histogram("squawker_envelope_chunk_seconds",
+                           "Time to work out the amplitude of one chunk.", buckets=CHUNK_BUCKETS)
+MOTOR_WRITES = counter("squawker_i2c_writes_total",
+                       "Throttle writes asked for, before the motor driver drops repeats and merges bursts.",
+                       ("motor",))
+MOTOR_ON = counter("squawker_motor_on_seconds_total",
+                   "Seconds each motor has spent running, counted when it stops.", ("motor",))
+
+_motors = {}
+
+
+def _duty():
+    uptime = time.monotonic() - START
+    return {(name,): motor.on_time / uptime for name, motor in _motors.items()}
+
+
+MOTOR_DUTY = gauge("squawker_motor_duty_ratio",
+                   "Fraction of the uptime each motor has been running.", ("motor",), fn=_duty)
+
+
+class MeteredMotor:
+    """Wraps a MotorKit motor to count throttle writes and time spent running.
+    Anything other than throttle goes straight through to the real motor.
+
+    Args:
+        motor: adafruit_motor DCMotor, or the sim's
+        name (str): label for the metrics
+    """
+    def __init__(self, motor, name) -> None:
+        object.__setattr__(self, "_motor", motor)
+        object.__setattr__(self, "name", name)
+        object.__setattr__(self, "_on_since", None)
+        object.__setattr__(self, "_done", 0.0)
+        _motors[name] = self
+
+    @property
+    def throttle(self):
+        return self._motor.throttle
+
+    @throttle.setter
+    def throttle(self, value):
+        self._motor.throttle = value
+        trace.throttle(self.name, value)
+        MOTOR_WRITES.inc(motor=self.name)
+        now = time.monotonic()
+        if value:
+            if self._on_since is None:
+                object.__setattr__(self, "_on_since", now)
+        elif self._on_since is not None:
+            ran = now - self._on_since
+            object.__setattr__(self, "_on_since", None)
+            object.__setattr__(self, "_done", self._done + ran)
+            MOTOR_ON.inc(ran, motor=self.name)
+
+    @property
+    def on_time(self):
+        """Seconds spent running, including the current run."""
+        since = self._on_since
+        return self._done + (time.monotonic() - since if since is not None else 0.0)
+
+    def __getattr__(self, attr):
+        return getattr(self._motor, attr)
+
+    def __setattr__(self, attr, value):
+        if attr == "throttle":
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self._motor, attr, value)
+
+
+def write_textfile(path):
+    """Writes the metrics for node_exporter's textfile collector. Goes
+    through a temp file so the collector never sees half a file.
+
+    Args:
+        path (str): where to write, should end in .prom
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        f.write(REGISTRY.render())
+    os.replace(tmp, path)
+
+
+async def textfile(path, interval = 15):
+    """Rewrites the textfile every interval seconds. Runs forever.
+
+    Args:
+        path (str): where to write
+        interval (float): seconds between writes
+    """
+    while True:
+        try:
+            write_textfile(path)
+        except OSError as e:
+            print(f"Couldn't write metrics to {path}: {e}")
+        await asyncio.sleep(interval)
+
+
+async def loop_lag(interval = 0.25):
+    """Measures how late the event loop is waking things up. Runs forever.
+
+    Args:
+        interval (float): seconds to sleep between measurements
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        LOOP_LAG.observe(max(0.0, loop.time() - expected))
+
+
+async def _http(reader, writer):
+    try:
+        request = await asyncio.wait_for(reader.readline(), 5)
+        # Skip the headers, nothing in them matters here
+        while True:
+            line = await asyncio.wait_for(reader.readline(), 5)
+            if line in (b'\r\n', b'\n', b''):
+                break
+        parts = request.decode('latin-1').split()
+        path = parts[1] if len(parts) > 1 else "/"
+        if path in ("/", "/metrics"):
+            status, body = "200 OK", REGISTRY.render()
+        else:
+            status, body = "404 Not Found", "Try /metrics\n"
+        data = body.encode()
+        writer.write(f"HTTP/1.0 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(data)}\r\nConnection: close\r\n\r\n".encode() + data)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def serve(address):
+    """Serves the metrics over HTTP. Runs forever.
+
+    Args:
+        address (str): host:port, :port for localhost, or unix:/path/to/socket
+    """
+    if address.startswith("unix:"):
+        path = address[len("unix:"):]
+        if os.path.exists(path):
+            os.unlink(path)
+        server = await asyncio.start_unix_server(_http, path)
+    else:
+        host, _, port = address.rpartition(':')
+        server = await asyncio.start_server(_http, host or '127.0.0.1', int(port))
+    print(f"Serving metrics on {address}")
+    async with server:
+        await server.serve_forever()
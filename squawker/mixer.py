@@ -0,0 +1,404 @@
+"""Several clips at once through the one audio output.
+
+The audio engine plays one clip at a time: whoever has it open writes straight
+to the sound card. That's fine for a bird that says one thing then stops, but
+there's no way to keep some ship ambience going underneath while it talks.
+
+The Mixer sits between the clips and the engine. It owns the engine's output
+on a thread of its own and, one block at a time, adds up every source playing
+into a float buffer, each with its own gain, fade in/out and ducking, then
+soft clips the sum and writes it out. All the buffers are made up front, so
+mixing a block doesn't allocate anything except the bytes PyAudio wants.
+
+Two kinds of source:
+
+    - ClipSource plays a clip (or loops it), from mixer.play()
+    - StreamSource gets written to chunk by chunk, from mixer.clip(), which
+      works like AudioEngine.clip() so a Squawk can use the mixer as its
+      engine without knowing the difference
+
+A source can be the voice. While any voice is playing every other source
+ducks down, and since Squawk works the beak out from its own clip's chunks,
+the beak only ever follows the voice, never the mix.
+"""
+
+import contextlib
+import threading
+import time
+from collections import deque
+import numpy as np
+from . import audioengine, metrics
+from .audioengine import ClipStream, Converter
+from .wavfile import WavFile
+
+# Frames mixed and written at a time
+BLOCK = 1024
+# Gain everything else drops to while the voice is playing, about -10dB
+DUCK = 0.3
+# Seconds to duck down, and to come back up afterwards
+DUCK_ATTACK = 0.05
+DUCK_RELEASE = 0.5
+# Fraction of full scale past which the sum gets squashed instead of clipped
+KNEE = 0.8
+# Blocks a StreamSource can have queued before its writer waits, like a sound card buffer
+QUEUE_BLOCKS = 4
+
+MIX_TIME = metrics.histogram("squawker_mixer_block_seconds", "Time taken mixing each block.",
+                             buckets=metrics.CHUNK_BUCKETS)
+
+
+class Source:
+    """Something the mixer plays. Subclasses fill in frames().
+
+    Args:
+        gain (float): level to play at, 1 is as recorded
+        fade_in (float): seconds to fade in over
+        voice (bool): everything else ducks under this one
+        name (str): what to call it in messages
+    """
+    def __init__(self, gain = 1.0, fade_in = 0.0, voice = False, name = None) -> None:
+        self.gain = gain
+        self.voice = voice
+        self.name = name or type(self).__name__
+        self.done = False
+        self.fade = 0.0 if fade_in else 1.0
+        self.rate = 0.0
+        self._fade_in = fade_in
+        self._stopping = False
+        self._duck = 1.0
+        # Gain the last block ended on, where the next one starts from
+        self._level = None
+
+    def _start(self, rate):
+        self.rate = rate
+        self._fade_step = 1.0 / (self._fade_in * rate) if self._fade_in else 0.0
+
+    def stop(self, fade = 0.0):
+        """Fades out over fade seconds, then goes away.
+
+        Args:
+            fade (float): seconds to fade out over, 0 to stop at the next block
+        """
+        if fade <= 0 or not self.rate:
+            self.done = True
+            return
+        self._stopping = True
+        self._fade_step = -1.0 / (fade * self.rate)
+
+    @property
+    def active(self):
+        """Still has something to play."""
+        return not self.done
+
+    def frames(self, n):
+        """Yields the next n frames at most, in pieces.
+
+        Yields:
+            tuple: (offset in the block, (frames, channels) int16 array)
+        """
+        raise NotImplementedError
+
+    def _advance(self, n, target, duck_step):
+        """Works out the gain at the end of the next n frames.
+
+        Args:
+            n (int): frames in the block
+            target (float): duck level to head for, 1 for not ducked
+            duck_step (tuple): (down, up) duck change per frame
+
+        Returns:
+            tuple: (gain at the start, gain at the end)
+        """
+        self.fade = min(1.0, max(0.0, self.fade + self._fade_step * n))
+        if self._fade_step > 0 and self.fade >= 1.0:
+            self._fade_step = 0.0
+        if self._stopping and self.fade <= 0.0:
+            self.done = True
+        if self._duck > target:
+            self._duck = max(target, self._duck - duck_step[0] * n)
+        else:
+            self._duck = min(target, self._duck + duck_step[1] * n)
+        end = self.gain * self.fade * self._duck
+        start = end if self._level is None else self._level
+        self._level = end
+        return start, end
+
+
+class ClipSource(Source):
+    """Plays a clip, or loops it.
+
+    Args:
+        clip (WavFile): the clip, a Clip out of the library or a bank works too
+        channels (int): the mixer's channel count
+        rate (int): the mixer's sample rate
+        loop (bool): go back to the start at the end, until stopped
+        fade_out (float): seconds to fade out over at the end, when not looping
+        (and the rest as Source)
+    """
+    def __init__(self, clip, channels, rate, gain = 1.0, loop = False, fade_in = 0.0, fade_out = 0.0,
+                 voice = False, name = None) -> None:
+        super().__init__(gain, fade_in, voice, name or getattr(clip, "path", None))
+        converter = Converter(clip.dtype, clip.channels, clip.rate, channels, rate)
+        if converter.passthrough:
+            # Straight out of the mapping
+            self.data = clip.frames
+        else:
+            # Converted once here, rather than a chunk at a time on the mixer thread
+            self.data = np.frombuffer(converter.convert(clip.samples(clip.frames)),
+                                      dtype=np.int16).reshape(-1, channels)
+        self.loop = loop
+        self.fade_out = fade_out
+        self.pos = 0
+
+    def frames(self, n):
+        offset = 0
+        total = len(self.data)
+        while offset < n and total:
+            if self.pos >= total:
+                if not self.loop:
+                    self.done = True
+                    return
+                self.pos = 0
+            take = min(n - offset, total - self.pos)
+            yield offset, self.data[self.pos:self.pos + take]
+            self.pos += take
+            offset += take
+        if not total:
+            self.done = True
+
+    def _advance(self, n, target, duck_step):
+        if (not self.loop and self.fade_out and not self._stopping
+                and len(self.data) - self.pos <= self.fade_out * self.rate):
+            self.stop(self.fade_out)
+        return super()._advance(n, target, duck_step)
+
+
+class StreamSource(Source):
+    """Plays whatever gets written into it, already in the mixer's format.
+    write() blocks once a few blocks are queued, the way a sound card does.
+
+    Args:
+        mixer (Mixer): what plays it
+        (and the rest as Source)
+    """
+    def __init__(self, mixer, gain = 1.0, voice = True, name = None) -> None:
+        super().__init__(gain, 0.0, voice, name)
+        self.mixer = mixer
+        self.channels = mixer.channels
+        self.queue = deque()
+        self.queued = 0
+        self.closed = False
+        self._head = 0
+        self._room = threading.Condition()
+
+    @property
+    def output_latency(self):
+        """Seconds from write() to hearing it, with nothing queued yet."""
+        return self.mixer.output_latency
+
+    def write(self, data, trigger = None):
+        """Queues interleaved int16 frames, same as AudioEngine.write()."""
+        frames = np.frombuffer(data, dtype=np.int16).reshape(-1, self.channels)
+        if trigger is not None:
+            latency = time.monotonic() - trigger + self.output_latency + self.queued / self.mixer.rate
+            metrics.TRIGGER_LATENCY.observe(latency)
+            print(f"Trigger to first sample: {latency * 1000:.1f}ms")
+        with self._room:
+            while self.queued > QUEUE_BLOCKS * self.mixer.block and not self.done:
+                self._room.wait()
+            self.queue.append(frames)
+            self.queued += len(frames)
+
+    def close(self):
+        """No more writes coming, goes away once what's queued has played."""
+        with self._room:
+            self.closed = True
+            if not self.queue:
+                self.done = True
+
+    def stop(self, fade = 0.0):
+        super().stop(fade)
+        with self._room:
+            self._room.notify_all()
+
+    @property
+    def active(self):
+        # Ducks the rest for as long as it's open, even between chunks
+        return not self.done
+
+    def frames(self, n):
+        offset = 0
+        with self._room:
+            while offset < n and self.queue:
+                chunk = self.queue[0]
+                take = min(n - offset, len(chunk) - self._head)
+                yield offset, chunk[self._head:self._head + take]
+                self._head += take
+                self.queued -= take
+                offset += take
+                if self._head >= len(chunk):
+                    self.queue.popleft()
+                    self._head = 0
+            if self.closed and not self.queue:
+                self.done = True
+            self._room.notify_all()
+
+
+class Mixer:
+    """Owns the audio output and mixes every source into it.
+
+    Args:
+        engine (AudioEngine): where the mix goes, defaults to the process-wide one
+        block (int): frames per block
+        duck (float): gain everything else drops to under the voice
+    """
+    def __init__(self, engine = None, block = BLOCK, duck = DUCK) -> None:
+        self.engine = engine
+        self.block = block
+        self.duck = duck
+        self.channels = audioengine.CHANNELS
+        self.rate = audioengine.RATE
+        self.sources = []
+        self.saturated = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+    def _buffers(self):
+        shape = (self.block, self.channels)
+        self._mix = np.zeros(shape, dtype=np.float32)
+        self._scratch = np.zeros(shape, dtype=np.float32)
+        self._over = np.zeros(shape, dtype=np.float32)
+        self._out = np.zeros(shape, dtype=np.int16)
+        self._gains = np.zeros((self.block, 1), dtype=np.float32)
+        self._ramp = (np.arange(self.block, dtype=np.float32) / self.block).reshape(-1, 1)
+
+    def open(self):
+        """Starts mixing. Safe to call twice.
+
+        Returns:
+            Mixer: itself
+        """
+        if self._thread is not None:
+            return self
+        self.engine = self.engine or audioengine.get_engine()
+        self.engine.open()
+        self.channels = self.engine.channels
+        self.rate = self.engine.rate
+        self._buffers()
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name="audio-mixer", daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    @property
+    def output_latency(self):
+        """Seconds between a source's next frame going in and hearing it."""
+        engine = self.engine or audioengine.get_engine()
+        return engine.output_latency + self.block / self.rate
+
+    def add(self, source):
+        """Starts playing a source.
+
+        Returns:
+            Source: the same source
+        """
+        self.open()
+        source._start(self.rate)
+        with self._lock:
+            self.sources.append(source)
+        return source
+
+    def play(self, clip, gain = 1.0, loop = False, fade_in = 0.0, fade_out = 0.0, voice = False):
+        """Plays a clip alongside whatever else is playing.
+
+        Args:
+            clip: path of a wav file, or an open WavFile or Clip
+            gain (float): level to play at, 1 is as recorded
+            loop (bool): keep going round until stopped
+            fade_in (float): seconds to fade in over
+            fade_out (float): seconds to fade out over at the end
+            voice (bool): duck everything else under it
+
+        Returns:
+            ClipSource: stop() it to stop it
+        """
+        if isinstance(clip, str):
+            clip = WavFile(clip)
+        self.open()
+        return self.add(ClipSource(clip, self.channels, self.rate, gain, loop, fade_in, fade_out, voice))
+
+    @contextlib.contextmanager
+    def clip(self, dtype, channels, rate, trigger=None, voice=True, gain=1.0):
+        """Same as AudioEngine.clip(), but playing into the mix as a voice.
+
+        Yields:
+            ClipStream: write the clip's raw chunks into this
+        """
+        self.open()
+        source = self.add(StreamSource(self, gain, voice))
+        try:
+            yield ClipStream(source, Converter(dtype, channels, rate, self.channels, self.rate), trigger)
+        finally:
+            source.close()
+
+    def mix(self):
+        """Mixes the next block into the output buffer.
+
+        Returns:
+            ndarray: (block, channels) int16, only good until the next call
+        """
+        n = self.block
+        mix, scratch, over, gains = self._mix, self._scratch, self._over, self._gains
+        mix.fill(0.0)
+        with self._lock:
+            self.sources = [s for s in self.sources if not s.done]
+            sources = list(self.sources)
+        ducked = any(s.voice and s.active for s in sources)
+        duck_step = ((1.0 - self.duck) / (DUCK_ATTACK * self.rate), (1.0 - self.duck) / (DUCK_RELEASE * self.rate))
+        for source in sources:
+            target = self.duck if ducked and not source.voice else 1.0
+            start, end = source._advance(n, target, duck_step)
+            # The gain slides from where the last block left it, no zipper noise
+            np.multiply(self._ramp, end - start, out=gains)
+            gains += start
+            for offset, frames in source.frames(n):
+                m = len(frames)
+                np.multiply(frames, gains[offset:offset + m], out=scratch[:m])
+                np.add(mix[offset:offset + m], scratch[:m], out=mix[offset:offset + m])
+        mix *= 1.0 / 32768
+        self._saturate(mix, scratch, over)
+        mix *= 32767
+        np.copyto(self._out, mix, casting='unsafe')
+        return self._out
+
+    def _saturate(self, mix, mag, over):
+        """Soft clips in place: untouched up to KNEE, squashed smoothly towards
+        full scale above it, so a loud mix distorts a bit rather than wrapping."""
+        if mix.max() <= KNEE and mix.min() >= -KNEE:
+            return
+        self.saturated += 1
+        np.abs(mix, out=mag)
+        np.subtract(mag, KNEE, out=over)
+        np.maximum(over, 0.0, out=over)
+        over *= 1.0 / (1.0 - KNEE)
+        np.tanh(over, out=over)
+        over *= 1.0 - KNEE
+        np.minimum(mag, KNEE, out=mag)
+        mag += over
+        np.copysign(mag, mix, out=mix)
+
+    def _run(self):
+        with self.engine.clip(np.int16, self.channels, self.rate) as stream:
+            while self._running:
+                began = time.perf_counter()
+                out = self.mix()
+                MIX_TIME.observe(time.perf_counter() - began)
+                # PyAudio only takes bytes
+                stream.write(None, out.tobytes())
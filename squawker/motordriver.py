@@ -0,0 +1,325 @@
+"""Keeps motor writes off the I2C bus unless they change something.
+
+Every throttle write on the MotorKit HAT is I2C traffic to its PCA9685. A DC
+motor throttle is two PWM channels, so two transactions. The audio loop writes
+the beak and often the body throttle every chunk, mostly to the value they
+already had, and open_beak spins reading the throttle back. This sits between
+the controllers and the adafruit motors and:
+
+    - remembers what was last written, so reads never touch the bus and
+      writing the same value again does nothing
+    - rate limits, so a burst of writes inside MIN_INTERVAL goes out as one
+      write of the last value, a little later
+    - batches: writes inside a `with driver.batch():` block go out together
+      at the end, and when both motors are on the same PCA9685 that's a
+      single auto-increment write covering all their channels
+
+Stopping a motor never waits for the rate limit, so a stop can't get stuck
+behind a timer when the process is on its way out.
+
+On the sim backend, or anything that isn't a MotorKit, the writes go to the
+motors one at a time through their throttle, with the same caching and rate
+limiting.
+"""
+
+import atexit
+import struct
+import threading
+import time
+from . import metrics
+
+# Writes closer together than this get merged into one
+MIN_INTERVAL = 0.002
+
+# PCA9685 register for LED0_ON_L, each channel after it takes 4 bytes
+LED0_ON_L = 0x06
+
+TRANSACTIONS = metrics.counter("squawker_i2c_transactions_total",
+                               "I2C transactions that actually went out to the motor HAT.")
+SKIPPED = metrics.counter("squawker_motor_writes_skipped_total",
+                          "Throttle writes that never reached the bus, by why.", ("motor", "reason"))
+
+
+def _duties(value, decay):
+    """The two PWM duty cycles for a throttle, the same as adafruit_motor's DCMotor.
+
+    Args:
+        value (float): throttle from -1 to 1, None to coast
+        decay (int): 0 fast decay, 1 slow decay
+
+    Returns:
+        tuple: (positive, negative) 16 bit duty cycles
+    """
+    if value is None:
+        return 0, 0
+    if value == 0:
+        return 0xFFFF, 0xFFFF
+    duty = int(0xFFFF * abs(value))
+    if decay == 1:
+        if value < 0:
+            return 0xFFFF - duty, 0xFFFF
+        return 0xFFFF, 0xFFFF - duty
+    if value < 0:
+        return 0, duty
+    return duty, 0
+
+
+def _registers(duty):
+    """(on, off) register values for a 16 bit duty cycle, same as adafruit_pca9685."""
+    if duty == 0xFFFF:
+        return 0x1000, 0
+    if duty < 0x0010:
+        return 0, 0x1000
+    return 0, duty >> 4
+
+
+def _channels(motor):
+    """The PCA9685 and channel numbers behind an adafruit DCMotor.
+
+    Returns:
+        tuple: (pca, positive channel, negative channel), or None if it isn't one
+    """
+    try:
+        positive, negative = motor._positive, motor._negative
+        pca = positive._pca
+        if negative._pca is not pca or not hasattr(pca, "i2c_device"):
+            return None
+        return pca, positive._index, negative._index
+    except AttributeError:
+        return None
+
+
+class _MotorBus:
+    """Writes each motor through its own throttle, two transactions apiece."""
+    def __init__(self, motors) -> None:
+        self.motors = motors
+
+    def write(self, values):
+        for name, value in values.items():
+            self.motors[name].throttle = value
+        return 2 * len(values)
+
+
+class _PCABus:
+    """Writes every motor's channels straight to the PCA9685 registers, one
+    auto-increment write per run of neighbouring channels. MotorKit puts
+    motor1 on channels 9 and 10 and motor2 on 11 and 12, so both motors go
+    in one transaction.
+
+    Args:
+        pca: the PCA9685 all the motors are on
+        motors (dict): name to adafruit DCMotor
+    """
+    def __init__(self, pca, motors) -> None:
+        self.pca = pca
+        self.motors = motors
+        self.channels = {name: _channels(motor)[1:] for name, motor in motors.items()}
+
+    def write(self, values):
+        regs = {}
+        for name, value in values.items():
+            motor = self.motors[name]
+            duties = _duties(value, getattr(motor, "decay_mode", 0))
+            for channel, duty in zip(self.channels[name], duties):
+                regs[channel] = _registers(duty)
+            # So the motor reads back right if anything asks it directly
+            motor._throttle = value
+        transactions = 0
+        channels = sorted(regs)
+        with self.pca.i2c_device as i2c:
+            while channels:
+                run = [channels.pop(0)]
+                while channels and channels[0] == run[-1] + 1:
+                    run.append(channels.pop(0))
+                data = bytearray([LED0_ON_L + 4 * run[0]])
+                for channel in run:
+                    data += struct.pack('<HH', *regs[channel])
+                i2c.write(data)
+                transactions += 1
+        return transactions
+
+
+class DriverMotor:
+    """One motor as seen through the driver. Has a throttle like a DCMotor,
+    and anything else goes through to the real motor.
+
+    Args:
+        driver (MotorDriver): what does the writing
+        name (str): which motor
+    """
+    def __init__(self, driver, name) -> None:
+        object.__setattr__(self, "_driver", driver)
+        object.__setattr__(self, "name", name)
+
+    @property
+    def throttle(self):
+        return self._driver.get(self.name)
+
+    @throttle.setter
+    def throttle(self, value):
+        self._driver.set(self.name, value)
+
+    def flush(self):
+        """Writes anything held back for the rate limit now."""
+        self._driver.flush()
+
+    def __getattr__(self, attr):
+        return getattr(self._driver.motors[self.name], attr)
+
+    def __setattr__(self, attr, value):
+        if attr == "throttle":
+            object.__setattr__(self, attr, value)
+        else:
+            setattr(self._driver.motors[self.name], attr, value)
+
+
+class MotorDriver:
+    """Caches, rate limits and batches the throttle writes for some motors.
+    Writes come from the event loop, the audio threads and the GPIO callback
+    thread, so it's all under one lock.
+
+    Args:
+        min_interval (float): seconds to leave between bus writes
+    """
+    def __init__(self, min_interval = MIN_INTERVAL) -> None:
+        self.min_interval = min_interval
+        self.motors = {}
+        self.written = {}
+        self.pending = {}
+        self.transactions = 0
+        self._bus = _MotorBus(self.motors)
+        self._last = float("-inf")
+        self._due = None
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._flusher = None
+        self._local = threading.local()
+
+    def add(self, motor, name):
+        """Takes over the writes for a motor.
+
+        Args:
+            motor: adafruit_motor DCMotor, or the sim's
+            name (str): what to call it
+
+        Returns:
+            DriverMotor: use this instead of the motor from now on
+        """
+        with self._lock:
+            self.motors[name] = motor
+            self.written[name] = motor.throttle
+            self._bus = self._pick_bus()
+        return DriverMotor(self, name)
+
+    def _pick_bus(self):
+        found = [_channels(motor) for motor in self.motors.values()]
+        if all(found) and len({id(pca) for pca, _, _ in found}) == 1:
+            return _PCABus(found[0][0], self.motors)
+        return _MotorBus(self.motors)
+
+    def get(self, name):
+        """The throttle last asked for, whether or not it's gone out yet."""
+        with self._lock:
+            return self.pending.get(name, self.written[name])
+
+    def set(self, name, value):
+        """Asks for a throttle. Goes out now, or once the rate limit or the
+        current batch allows."""
+        if value is not None and not -1.0 <= value <= 1.0:
+            raise ValueError("Throttle must be None or between -1.0 and +1.0")
+        with self._lock:
+            if value == self.pending.get(name, self.written[name]):
+                SKIPPED.inc(motor=name, reason="unchanged")
+                return
+            if name in self.pending:
+                SKIPPED.inc(motor=name, reason="coalesced")
+            self.pending[name] = value
+            if getattr(self._local, "depth", 0):
+                return
+            due = self._last + self.min_interval
+            if not value or due <= time.monotonic():
+                self._flush()
+            elif self._due is None:
+                self._due = due
+                if self._flusher is None:
+                    self._flusher = threading.Thread(target=self._flushing, name="motor-flush", daemon=True)
+                    self._flusher.start()
+                self._wake.notify()
+
+    def _flushing(self):
+        """Writes out whatever the rate limit held back, once it's due."""
+        with self._lock:
+            while True:
+                if self._due is None:
+                    self._wake.wait()
+                    continue
+                wait = self._due - time.monotonic()
+                if wait > 0:
+                    self._wake.wait(wait)
+                    continue
+                self._flush()
+
+    def _flush(self):
+        values = {}
+        for name, value in self.pending.items():
+            if value == self.written[name]:
+                # Went somewhere and back again before it got written
+                SKIPPED.inc(motor=name, reason="coalesced")
+            else:
+                values[name] = value
+        self.pending.clear()
+        self._due = None
+        if not values:
+            return
+        count = self._bus.write(values)
+        self.written.update(values)
+        self.transactions += count
+        TRANSACTIONS.inc(count)
+        self._last = time.monotonic()
+
+    def flush(self):
+        """Writes anything still waiting."""
+        with self._lock:
+            self._flush()
+
+    def batch(self):
+        """Holds this thread's writes until the end of the with block, then
+        writes them all at once.
+
+        Returns:
+            context manager
+        """
+        return _Batch(self)
+
+
+class _Batch:
+    def __init__(self, driver) -> None:
+        self.driver = driver
+
+    def __enter__(self):
+        local = self.driver._local
+        local.depth = getattr(local, "depth", 0) + 1
+        return self.driver
+
+    def __exit__(self, *exc):
+        local = self.driver._local
+        local.depth -= 1
+        if not local.depth:
+            self.driver.flush()
+        return False
+
+
+_driver = None
+
+
+def get_driver():
+    """Returns the process-wide driver, making it the first time.
+
+    Returns:
+        MotorDriver: the driver
+    """
+    global _driver
+    if _driver is None:
+        _driver = MotorDriver()
+        atexit.register(_driver.flush)
+    return _driver
@@ -1,13 +1,138 @@
 #squawker.py
 # Classes for controlling the stupid bird robot's motors
 
-from adafruit_motorkit import MotorKit
-import RPi.GPIO as GPIO
-from time import sleep
+import asyncio
+import threading
 from signal import signal, SIGINT, SIGTERM
+from . import backend
+from . import metrics
+from . import motordriver
+from . import pulse
+from . import trace
+from .bodyposition import BodyEstimator
+from .backend import GPIO
 
-kit = MotorKit()
-GPIO.setmode(GPIO.BCM) # BCM = Use logical pin numbering
+# The MotorKit and GPIO get set up the first time a controller needs them,
+# so importing this doesn't need a Pi (see backend.py)
+kit = None
+_gpio_ready = False
+
+def get_kit():
+    """Returns the shared MotorKit, creating it on first use.
+
+    Returns:
+        MotorKit: the motor HAT from the selected backend
+    """
+    global kit
+    if kit is None:
+        kit = backend.MotorKit()
+    return kit
+
+def setup_gpio():
+    """Sets the pin numbering mode once, before any pins get set up."""
+    global _gpio_ready
+    if not _gpio_ready:
+        GPIO.setmode(GPIO.BCM) # BCM = Use logical pin numbering
+        _gpio_ready = True
+
+# Give up on a blink or a body reset that takes longer than this,
+# rather than leaving a motor running forever if a switch dies.
+MOVE_TIMEOUT = 5
+
+class _EdgeWatcher:
+    """RPi.GPIO only allows one add_event_detect per pin, so this registers
+    for both edges once and passes each edge to whatever coroutines are
+    waiting on that pin. GPIO callbacks come from RPi.GPIO's own thread, so
+    results get handed back to the event loop with call_soon_threadsafe.
+    That also means once a pin is being watched, the blocking wait_for_edge
+    methods can't be used on it any more, so stick to the async ones.
+    """
+    def __init__(self, pin) -> None:
+        self.pin = pin
+        self.waiters = []
+        self.lock = threading.Lock()
+        GPIO.add_event_detect(pin, GPIO.BOTH, callback=self._edge)
+
+    def _edge(self, channel):
+        level = GPIO.input(self.pin)
+        trace.record(trace.EDGE, self.pin, level)
+        with self.lock:
+            waiters = list(self.waiters)
+        for waiter in waiters:
+            waiter.check(self.pin, level)
+
+    def add(self, waiter):
+        with self.lock:
+            self.waiters.append(waiter)
+
+    def discard(self, waiter):
+        with self.lock:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+_watchers = {}
+
+def _watch(pin):
+    if pin not in _watchers:
+        _watchers[pin] = _EdgeWatcher(pin)
+    return _watchers[pin]
+
+class _Waiter:
+    """A future that gets resolved from the GPIO callback thread once test(pin, level)
+    comes back True."""
+    def __init__(self, test) -> None:
+        self.loop = asyncio.get_running_loop()
+        self.future = self.loop.create_future()
+        self.test = test
+
+    def check(self, pin, level):
+        if self.test(pin, level):
+            self.loop.call_soon_threadsafe(self._resolve)
+
+    def _resolve(self):
+        if not self.future.done():
+            self.future.set_result(None)
+
+async def _wait(pins, test, now=None):
+    """Suspends until an edge on one of the pins passes test(pin, level).
+
+    Args:
+        pins (list): GPIO pins to watch
+        test (function): called with (pin, level) for every edge
+        now (function): if given and already true, don't wait at all
+    """
+    waiter = _Waiter(test)
+    watchers = [_watch(pin) for pin in pins]
+    for watcher in watchers:
+        watcher.add(waiter)
+    try:
+        # Check after registering so an edge in between can't be missed
+        if now is None or not now():
+            await waiter.future
+    finally:
+        for watcher in watchers:
+            watcher.discard(waiter)
+
+async def wait_for_edge_async(pin, edge):
+    """Awaitable GPIO.wait_for_edge.
+
+    Args:
+        pin (int): GPIO pin
+        edge (int): GPIO.RISING or GPIO.FALLING
+    """
+    want = 1 if edge == GPIO.RISING else 0
+    await _wait([pin], lambda p, level: level == want)
+
+async def wait_for_input(levels):
+    """Suspends until every pin reads the level it's mapped to, instead of
+    spinning on GPIO.input.
+
+    Args:
+        levels (dict): pin -> 0 or 1
+    """
+    def ready(*args):
+        return all(GPIO.input(pin) == level for pin, level in levels.items())
+    await _wait(list(levels), ready, now=ready)
 
 class EyeBeakController:
     """The eyes and beak are controlled by the same motor running in opposite
@@ -23,17 +148,36 @@ class EyeBeakController:
     actions the bird can perform.
     """
     def __init__(self, reset = True, left_eye_switch = 12, 
-                 right_eye_switch = 5, eye_beak_motor = kit.motor1):
+                 right_eye_switch = 5, eye_beak_motor = None):
         """The switches and motors are defaulted to where I happened to solder them onto the board.
         Motor1 is just coincidentally the one that's connected to the eyebeak."""
+        if eye_beak_motor is None:
+            eye_beak_motor = get_kit().motor1
+        setup_gpio()
         self.left_eye_switch = left_eye_switch
         self.right_eye_switch = right_eye_switch
-        self.eye_beak_motor = eye_beak_motor
+        # Repeat writes and bursts get dropped before they reach the I2C bus
+        driven = motordriver.get_driver().add(eye_beak_motor, "eye_beak")
+        self.eye_beak_motor = metrics.MeteredMotor(driven, "eye_beak")
         self.eye_beak_motor.FAST_DECAY = 0
         self.eye_beak_motor.SLOW_DECAY = 1
         self.eye_beak_motor.throttle = 0
         GPIO.setup(right_eye_switch, GPIO.IN, pull_up_down=GPIO.PUD_UP)
         GPIO.setup(left_eye_switch, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        self._lock = None
+
+    @property
+    def motor_lock(self):
+        """asyncio.Lock held while an async eye movement owns the motor.
+        Made on first use so it belongs to the running event loop."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def idle(self):
+        """Suspends until no async eye movement is using the motor."""
+        async with self.motor_lock:
+            pass
             
     def get_eye_state(self):
         """Returns whether eyes are open or closed based on the switch positions.
@@ -100,6 +244,73 @@ class EyeBeakController:
             self.halfblink()
         return self.get_eye_state()
             
+    async def fullblink_async(self, timeout = MOVE_TIMEOUT):
+        """Awaitable fullblink that doesn't tie up the event loop.
+
+        Args:
+            timeout (float): seconds before giving up and stopping the motor
+
+        Returns:
+            str: Should always return open
+        """
+        async with self.motor_lock:
+            print("Cycling one full blink.")
+            self.eye_beak_motor.throttle = -1
+            try:
+                await asyncio.wait_for(self._fullblink(), timeout)
+            finally:
+                self.eye_beak_motor.throttle = 0
+        return self.get_eye_state()
+
+    async def _fullblink(self):
+        await wait_for_edge_async(self.left_eye_switch, GPIO.RISING)
+        await wait_for_input({self.right_eye_switch: 0, self.left_eye_switch: 1})
+
+    async def halfblink_async(self, timeout = MOVE_TIMEOUT):
+        """Awaitable halfblink that doesn't tie up the event loop.
+
+        Args:
+            timeout (float): seconds before giving up and stopping the motor
+
+        Returns:
+            str: state of the eyes after the motor stops.
+        """
+        async with self.motor_lock:
+            print("Toggling blink state.")
+            _eyestate = self.get_eye_state()
+            if _eyestate == 'closed':
+                switch = self.right_eye_switch
+            else:
+                switch = self.left_eye_switch
+            self.eye_beak_motor.throttle = -1
+            try:
+                await asyncio.wait_for(self._halfblink(switch), timeout)
+            finally:
+                self.eye_beak_motor.throttle = 0
+        return self.get_eye_state()
+
+    async def _halfblink(self, switch):
+        await wait_for_edge_async(switch, GPIO.RISING)
+        await wait_for_input({switch: 0})
+
+    async def set_eyes_async(self, state):
+        """Awaitable set_eyes.
+
+        Args:
+            state (str): open or closed
+
+        Returns:
+            str: state of the eyes after the motor stops.
+        """
+        while self.get_eye_state() != state:
+            await self.halfblink_async()
+        return self.get_eye_state()
+
+    async def open_beak_async(self):
+        """Waits for any async blink to finish, without spinning, then opens the beak."""
+        await self.idle()
+        self.eye_beak_motor.throttle = 1
+
     def open_beak(self):
         """Since eyes and beak can'e move simultaneously, this waits till any other 
         motor functions have stopped and then runs forward to open the beak.
@@ -125,24 +336,98 @@ class BodyController():
     This class sets up the GPIO and motors to handle that, with some general 
     actions the bird can perform.
     """
-    def __init__(self, body_switch = 6, body_motor = kit.motor2):
+    # Positions per full cycle, see _moveparams
+    MAX = 222
+    # Rough guess at how far the calculated position wanders from the real one:
+    # every motor start/stop loses a bit to spin up and slop, and so does distance.
+    DRIFT_PER_MOVE = 3
+    DRIFT_PER_UNIT = 0.02
+
+    def __init__(self, body_switch = 6, body_motor = None):
+        if body_motor is None:
+            body_motor = get_kit().motor2
+        setup_gpio()
         self.body_switch = body_switch
-        self.body_motor = body_motor
+        driven = motordriver.get_driver().add(body_motor, "body")
+        self.body_motor = metrics.MeteredMotor(driven, "body")
         self.body_motor.FAST_DECAY = 0
         self.body_motor.SLOW_DECAY = 1
         self.body_motor.throttle = 0
-        self.timeposition = 0
         GPIO.setup(body_switch, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+        # Watches the switch edges for the position, see bodyposition.py.
+        # That takes the pin's one add_event_detect, so no wait_for_edge on it.
+        self.estimator = BodyEstimator(body_switch, self.DRIFT_PER_MOVE, self.DRIFT_PER_UNIT)
+        _watch(body_switch).add(self.estimator)
+        self._lock = None
+
+    @property
+    def timeposition(self):
+        """Best guess at the current position, 0 - 221."""
+        return int(round(self.estimator.position)) % self.MAX
+
+    @timeposition.setter
+    def timeposition(self, value):
+        self.estimator.set(value)
+
+    @property
+    def drift(self):
+        """Estimated position error in units, back to 0 every time the body passes zero."""
+        return self.estimator.error
+
+    @property
+    def confidence(self):
+        """How far to trust timeposition, from 1 down to 0."""
+        return self.estimator.confidence
+
+    def drift_for(self, units, starts = 1):
+        """Estimated position error a move adds.
+
+        Args:
+            units (int): distance moved
+            starts (int): number of motor start/stops
+
+        Returns:
+            float: estimated drift in position units
+        """
+        return starts * self.DRIFT_PER_MOVE + units * self.DRIFT_PER_UNIT
+
+    @property
+    def motor_lock(self):
+        """asyncio.Lock held while an async body movement owns the motor.
+        Made on first use so it belongs to the running event loop."""
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def idle(self):
+        """Suspends until no async body movement is using the motor."""
+        async with self.motor_lock:
+            pass
         
     def resetbody(self):
         """Runs the body motor forward until the cycle sensor switch closes.
         """
+        self.estimator.start(1)
         self.body_motor.throttle = 1
-        GPIO.wait_for_edge(self.body_switch, GPIO.RISING)
-        while GPIO.input(self.body_switch) != 0:
-            continue
+        self.estimator.wait_zero()
         self.body_motor.throttle = 0
-        self.timeposition = 0
+        self.estimator.stop()
+
+    async def resetbody_async(self, timeout = MOVE_TIMEOUT):
+        """Awaitable resetbody that doesn't tie up the event loop.
+
+        Args:
+            timeout (float): seconds before giving up and stopping the motor
+        """
+        async with self.motor_lock:
+            self.estimator.start(1)
+            self.body_motor.throttle = 1
+            try:
+                # Going forward, the switch closing is zero
+                await asyncio.wait_for(wait_for_edge_async(self.body_switch, GPIO.FALLING), timeout)
+            finally:
+                self.body_motor.throttle = 0
+                self.estimator.stop()
 
     def _moveparams(self, current, dst, mx = 222):
         """A full cycle of the mechanical body takes approximately 2.22 seconds.
@@ -199,32 +484,73 @@ class BodyController():
             t (float): The time index to set the motor to
             d (int): The direction to run the motor.
         """   
+        move = self._planmove(dst, d, mx)
+        if move is None:
+            return
+        motortime, direction = move
+        self._pulse(motortime, direction).wait()
+        # Calculated from how long it really ran, and put right if it went past zero
+        self._landed(dst)
+
+    async def move_to(self, dst = 0, d = None, mx = 222):
+        """Awaitable setbodyPosition, sleeps with asyncio instead of blocking.
+
+        Args:
+            dst (int): The time index to set the motor to
+            d (int): The direction to run the motor.
+        """
+        async with self.motor_lock:
+            move = self._planmove(dst, d, mx)
+            if move is None:
+                return
+            motortime, direction = move
+            running = self._pulse(motortime, direction)
+            try:
+                await running
+            except asyncio.CancelledError:
+                # Stopping takes the pulse thread a few microseconds
+                running.cancel()
+                running.wait()
+                raise
+            finally:
+                self._landed(dst)
+
+    def _pulse(self, motortime, direction):
+        """Runs the motor for motortime on the pulse thread, which tells the
+        estimator right as the motor starts and stops."""
+        return pulse.get_engine().submit(self.body_motor, direction, motortime,
+                                         on_start=lambda: self.estimator.start(direction),
+                                         on_stop=self.estimator.stop)
+
+    def _landed(self, dst):
+        position = self.estimator.position
+        print(f"Body at {position:.0f} (wanted {dst}), confidence {self.confidence:.2f}")
+
+    def _planmove(self, dst, d, mx):
+        """Works out how long and which way to run the motor to get to dst.
+
+        Returns:
+            tuple: (seconds, direction), or None if it's already there
+        """
         current = self.timeposition
         
         if dst == current:
             print("Body position matches request. Not moving.")
-            pass
+            return None
         
+        units, direction = self._moveparams(current, dst, mx)
+        if d != None and d != direction:
+            # Made to go the long way round
+            units, direction = mx - units, d
+        # Timed off what the switch edges have shown the motor really does
+        motortime = round(self.estimator.time_for(units, direction), 3)
+            
+        if direction == 1:
+            print(f"moving {motortime} forward to position {dst}")
         else:
-            action = self._moveparams(current, dst, mx)
-            motortime = action[0] / 100
-            if d == None:
-                direction = action[1]
-            else:
-                direction = d
-                
-            if direction == 1:
-                print(f"moving {motortime} forward to position {dst}")
-            else:
-                print(f"moving {motortime} reverse to position {dst}")
-                
-            # if motortime < 0.20:
-            #     pass
-            # else:
-            self.body_motor.throttle = direction
-            sleep(motortime)
-            self.body_motor.throttle = 0
-            #This new position is calculated, and unreliable because of motor and gear slop. 
-            # Occasional resets to zero will help.
-            self.timeposition = dst
-            
\ No newline at end of file
+            print(f"moving {motortime} reverse to position {dst}")
+            
+        # if motortime < 0.20:
+        #     pass
+        # else:
+        return motortime, direction
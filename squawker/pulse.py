@@ -0,0 +1,258 @@
+"""Short motor pulses timed to the millisecond.
+
+setbodyPosition works out a run time, often somewhere between 0.03 and 0.3s,
+and used to do throttle on, sleep, throttle off. A sleep wakes up whenever
+the scheduler gets round to it, and on a busy Pi that's a few milliseconds
+late, different every time, on top of however long the I2C writes take. At
+about a hundredth of a second per position unit a wingshake could come out
+noticeably different each time.
+
+Pulses run on one thread of their own, at real-time priority if the process
+is allowed it. Each one:
+
+    - sleeps until just before the deadline, then spins on
+      time.perf_counter_ns() for the last bit, so the scheduler waking up late
+      doesn't matter
+    - times the throttle writes themselves, so the on-time that gets measured
+      is from the motor really starting to the motor really stopping
+    - learns how far off the last pulses came out, for each direction and
+      rough length, and ends the next one that much earlier or later
+
+Whatever's left after that is the motor, which BodyEstimator already learns.
+"""
+
+import asyncio
+import bisect
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from . import metrics
+
+# Nanoseconds before a deadline to stop sleeping and start spinning. At
+# real-time priority a sleep comes back well inside this. Spinning holds the
+# GIL, so any longer and the audio threads start to notice.
+SPIN_NS = 500000
+# SCHED_FIFO priority for the pulse thread, if the process may have it
+PRIORITY = 50
+# Pulse lengths in seconds the corrections get kept separately for. The write
+# latency is the same for all of them, sleeping isn't.
+BUCKETS = (0.05, 0.1, 0.2, 0.4)
+# How much each new measurement moves the correction
+RATE = 0.2
+# Never correct by more than this, a measurement that far out is a hiccup
+MAX_CORRECTION = 0.02
+
+ERROR = metrics.histogram("squawker_pulse_error_seconds",
+                          "How far each motor pulse's measured on-time was from what was asked for.",
+                          ("direction",), buckets=metrics.CHUNK_BUCKETS)
+
+
+def _ns():
+    return time.perf_counter_ns()
+
+
+def realtime(priority = PRIORITY):
+    """Puts the calling thread on SCHED_FIFO, on Linux when allowed.
+
+    Returns:
+        bool: whether it worked
+    """
+    try:
+        os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(priority))
+    except (AttributeError, OSError):
+        # Not Linux, or not root and no CAP_SYS_NICE
+        return False
+    return True
+
+
+class Pulse:
+    """One motor pulse, queued or done. Wait on it with wait() or await it.
+
+    Args:
+        motor: what to write the throttle to
+        value (float): throttle while it's on
+        seconds (float): how long it should be on
+        on_start (function): called right after the motor starts
+        on_stop (function): called right after the motor stops, early or not
+    """
+    def __init__(self, motor, value, seconds, on_start = None, on_stop = None) -> None:
+        self.motor = motor
+        self.value = value
+        self.seconds = seconds
+        self.on_start = on_start
+        self.on_stop = on_stop
+        # Filled in once it's run, all in seconds
+        self.target = None
+        self.measured = None
+        self.late = None
+        self.cancelled = threading.Event()
+        self.done = Future()
+
+    def cancel(self):
+        """Stops the motor now if it's running, or before it starts."""
+        self.cancelled.set()
+
+    def wait(self, timeout = None):
+        """Blocks until the motor's stopped.
+
+        Returns:
+            Pulse: itself
+        """
+        return self.done.result(timeout)
+
+    def __await__(self):
+        # Shielded, cancelling the await mustn't cancel the future the
+        # pulse thread still has to finish. Call cancel() for that.
+        return asyncio.shield(asyncio.wrap_future(self.done)).__await__()
+
+
+class PulseEngine:
+    """Runs motor pulses one after another on a dedicated thread, and learns
+    a per-direction correction for each length of pulse.
+
+    Args:
+        spin_ns (int): nanoseconds to spin for at the end of each pulse
+        priority (int): SCHED_FIFO priority to ask for, None to not bother
+    """
+    def __init__(self, spin_ns = SPIN_NS, priority = PRIORITY) -> None:
+        self.spin_ns = spin_ns
+        self.priority = priority
+        self.realtime = False
+        # (direction, bucket) -> seconds the pulse comes out longer than it's timed for
+        self.corrections = {}
+        self.pulses = 0
+        self._queue = queue.Queue()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def _key(self, value, seconds):
+        return (1 if value > 0 else -1, bisect.bisect(BUCKETS, seconds))
+
+    def correction(self, value, seconds):
+        """Seconds a pulse like this has been coming out too long."""
+        return self.corrections.get(self._key(value, seconds), 0.0)
+
+    def learn(self, value, seconds, error):
+        """Folds a measurement into the corrections.
+
+        Args:
+            value (float): throttle of the pulse
+            seconds (float): on-time asked for
+            error (float): measured minus asked for, with the correction
+                that was applied already taken off
+        """
+        key = self._key(value, seconds)
+        old = self.corrections.get(key, 0.0)
+        new = old + RATE * (error - old)
+        self.corrections[key] = min(max(new, -MAX_CORRECTION), MAX_CORRECTION)
+
+    def submit(self, motor, value, seconds, on_start = None, on_stop = None):
+        """Queues a pulse.
+
+        Args:
+            motor: what to write the throttle to
+            value (float): throttle while it's on
+            seconds (float): how long it should be on
+            on_start (function): called right after the motor starts
+            on_stop (function): called right after the motor stops, early or not
+
+        Returns:
+            Pulse: to wait on
+        """
+        pulse = Pulse(motor, value, seconds, on_start, on_stop)
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="motor-pulse", daemon=True)
+                self._thread.start()
+        self._queue.put(pulse)
+        return pulse
+
+    def pulse(self, motor, value, seconds, on_start = None, on_stop = None):
+        """Runs a pulse and waits for it. Same arguments as submit().
+
+        Returns:
+            Pulse: the finished pulse, with its measurements
+        """
+        return self.submit(motor, value, seconds, on_start, on_stop).wait()
+
+    def _wait_until(self, deadline, cancelled):
+        """Sleeps then spins until perf_counter_ns() reaches deadline.
+
+        Returns:
+            bool: False if cancelled first
+        """
+        while True:
+            left = deadline - _ns()
+            if left <= self.spin_ns:
+                break
+            if cancelled.wait((left - self.spin_ns) / 1e9):
+                return False
+        while _ns() < deadline:
+            if cancelled.is_set():
+                return False
+        return True
+
+    def _write(self, motor, value):
+        motor.throttle = value
+        # Through the MotorDriver a start could sit out its rate limit
+        flush = getattr(motor, "flush", None)
+        if flush is not None:
+            flush()
+
+    def _run(self):
+        if self.priority is not None:
+            self.realtime = realtime(self.priority)
+            if not self.realtime:
+                print("Motor pulses running at normal priority, no permission for real-time")
+        while True:
+            pulse = self._queue.get()
+            try:
+                self._fire(pulse)
+            except Exception as e:
+                pulse.done.set_exception(e)
+            else:
+                pulse.done.set_result(pulse)
+
+    def _fire(self, pulse):
+        if pulse.cancelled.is_set() or pulse.seconds <= 0:
+            return
+        correction = self.correction(pulse.value, pulse.seconds)
+        pulse.target = max(0.0, pulse.seconds - correction)
+        try:
+            self._write(pulse.motor, pulse.value)
+            on = _ns()
+            if pulse.on_start is not None:
+                pulse.on_start()
+            # The clock starts once the start write has gone out
+            finished = self._wait_until(on + int(pulse.target * 1e9), pulse.cancelled)
+        finally:
+            stopping = _ns()
+            self._write(pulse.motor, 0)
+            off = _ns()
+            if pulse.on_stop is not None:
+                pulse.on_stop()
+        # The motor's on from the end of one write to the end of the other
+        pulse.measured = (off - on) / 1e9
+        pulse.late = (stopping - on) / 1e9 - pulse.target
+        self.pulses += 1
+        if finished:
+            error = pulse.measured - pulse.seconds
+            ERROR.observe(abs(error), direction=str(self._key(pulse.value, pulse.seconds)[0]))
+            self.learn(pulse.value, pulse.seconds, error + correction)
+
+
+_engine = None
+
+
+def get_engine():
+    """Returns the process-wide pulse engine, making it the first time.
+
+    Returns:
+        PulseEngine: the engine
+    """
+    global _engine
+    if _engine is None:
+        _engine = PulseEngine()
+    return _engine
@@ -0,0 +1,373 @@
+"""One place that decides what the bird does next.
+
+run.py used to pass dicts around an asyncio.Queue, with whoever put something
+in also running it, and the blink and body coroutines waiting on q.join(). An
+RFID tap couldn't cut off an ambient sound, and anything that wasn't a sound
+got quietly dropped.
+
+Now everything the bird does is a Command with a priority. Producers submit()
+commands and a single consumer, Scheduler.run(), runs them one at a time,
+most important first:
+
+    RFID sound > scheduled sound > ambient motion > blink
+
+A command can have a deadline, after which it isn't worth starting any more,
+and a more important command cuts off a less important one that's running, as
+long as it's preemptible (a sound or a body move, not a half-done blink).
+"""
+
+import asyncio
+import heapq
+import itertools
+import time
+from . import actions
+from . import metrics
+
+# Priorities, lower runs first
+RFID = 0
+SOUND = 1
+MOTION = 2
+BLINK = 3
+PRIORITY_NAMES = {RFID: "rfid", SOUND: "sound", MOTION: "motion", BLINK: "blink"}
+
+WAIT = metrics.histogram("squawker_command_wait_seconds",
+                         "Time commands spend queued before they start.", ("kind",))
+OUTCOMES = metrics.counter("squawker_commands_total", "Commands finished with, by outcome.",
+                           ("kind", "status"))
+
+# What happened to a command
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+PREEMPTED = "preempted"
+CANCELLED = "cancelled"
+EXPIRED = "expired"
+FAILED = "failed"
+
+
+def _now():
+    """The event loop's clock, which is time.monotonic() unless something
+    like the soak test has swapped in a virtual one."""
+    try:
+        return asyncio.get_running_loop().time()
+    except RuntimeError:
+        return time.monotonic()
+
+
+class Command:
+    """Something for the bird to do. Subclasses fill in run().
+
+    Args:
+        priority (int): RFID, SOUND, MOTION or BLINK
+        deadline (float): seconds from now after which it's not worth starting,
+            None to wait as long as it takes
+    """
+    preemptible = True
+
+    def __init__(self, priority, deadline = None) -> None:
+        if priority not in PRIORITY_NAMES:
+            raise ValueError(f"Unknown priority {priority}")
+        self.priority = priority
+        self.deadline = None if deadline is None else _now() + deadline
+        self.submitted = None
+        self.started = None
+        self.finished = None
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.future = None
+
+    @property
+    def kind(self):
+        return PRIORITY_NAMES[self.priority]
+
+    @property
+    def expired(self):
+        return self.deadline is not None and _now() > self.deadline
+
+    async def run(self):
+        raise NotImplementedError
+
+    def __repr__(self):
+        return f"<{type(self).__name__} {self.kind} {self.status}>"
+
+
+class PlaySound(Command):
+    """Plays a clip through a Squawk, with the beak and body going along.
+
+    Args:
+        squawk (Squawk): what plays it
+        filename (str): path of the clip
+        trigger (float): time.monotonic() of what caused it, for latency reporting
+        priority (int): RFID for tag sounds, SOUND for the ambient ones
+        deadline (float): seconds to start by
+    """
+    def __init__(self, squawk, filename, trigger = None, priority = SOUND, deadline = None) -> None:
+        super().__init__(priority, deadline)
+        self.squawk = squawk
+        self.filename = filename
+        self.trigger = trigger
+        self.playback = None
+
+    async def run(self):
+        # Nothing else runs while this does, but a body move could still be
+        # winding down from being preempted
+        await asyncio.gather(self.squawk.body.idle(), self.squawk.beak.idle())
+        self.playback = self.squawk.play(self.filename, self.trigger)
+        # Cancelling this stops the clip too, see Playback
+        return await self.playback
+
+
+class Show(Command):
+    """Performs a compiled choreography timeline.
+
+    Args:
+        player (choreography.Player): the show, ready to play
+        priority (int): RFID or SOUND, like a clip
+        deadline (float): seconds to start by
+    """
+    def __init__(self, player, priority = SOUND, deadline = None) -> None:
+        super().__init__(priority, deadline)
+        self.player = player
+
+    async def run(self):
+        beak, body = self.player.beak, self.player.body
+        await asyncio.gather(body.idle(), beak.idle())
+        loop = asyncio.get_running_loop()
+        # The player has both motors to itself until it's done
+        async with body.motor_lock, beak.motor_lock:
+            playing = loop.run_in_executor(None, self.player.play)
+            try:
+                return await asyncio.shield(playing)
+            except asyncio.CancelledError:
+                # Hang on to the motors until the player has stopped them
+                self.player.stop()
+                await playing
+                raise
+
+
+class BodyMotion(Command):
+    """Runs some body actions, in whatever order the planner likes.
+
+    Args:
+        body (BodyController): Motor driving the body
+        names (list): actions from the actionmap, None for a random couple
+        deadline (float): seconds to start by
+    """
+    def __init__(self, body, names = None, deadline = None) -> None:
+        super().__init__(MOTION, deadline)
+        self.body = body
+        self.names = names
+
+    async def run(self):
+        # Cancelled mid-move, move_to stops the motor and works out where it got to
+        if self.names is None:
+            await actions.rnd_actions_async(self.body)
+        else:
+            await actions.run_plan_async(self.body, actions.plan(self.body, self.names))
+
+
+class Blink(Command):
+    """Closes and opens the eyes.
+
+    Args:
+        beak (EyeBeakController): Motor attached to the beak/eyes
+        deadline (float): seconds to start by
+    """
+    # A blink is over in a fraction of a second, and stopping halfway leaves the eyes shut
+    preemptible = False
+
+    def __init__(self, beak, deadline = None) -> None:
+        super().__init__(BLINK, deadline)
+        self.beak = beak
+
+    async def run(self):
+        await self.beak.set_eyes_async('closed')
+        await asyncio.sleep(0.1)
+        return await self.beak.set_eyes_async('open')
+
+
+class _Stats:
+    """Queue depth and wait times for one priority class."""
+    def __init__(self) -> None:
+        self.depth = 0
+        self.max_depth = 0
+        self.submitted = 0
+        self.started = 0
+        self.waited = 0.0
+        self.max_wait = 0.0
+        self.outcomes = {}
+
+    def as_dict(self):
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "submitted": self.submitted,
+            "started": self.started,
+            "mean_wait": self.waited / self.started if self.started else 0.0,
+            "max_wait": self.max_wait,
+            "outcomes": dict(self.outcomes),
+        }
+
+
+class Scheduler:
+    """Runs submitted commands one at a time, most important first."""
+    def __init__(self) -> None:
+        self.current = None
+        self.stats = {kind: _Stats() for kind in PRIORITY_NAMES.values()}
+        self._queue = []
+        self._order = itertools.count()
+        self._task = None
+        self._wake = None
+        # The newest scheduler is the one that's running
+        metrics.gauge("squawker_queue_depth", "Commands waiting to run.", ("kind",)).fn = \
+            lambda: {(kind,): s.depth for kind, s in self.stats.items()}
+
+    @property
+    def wake(self):
+        """asyncio.Event for the consumer. Made on first use so it belongs
+        to the running event loop."""
+        if self._wake is None:
+            self._wake = asyncio.Event()
+        return self._wake
+
+    def submit(self, command):
+        """Queues a command, cutting off whatever's running if it's less important.
+
+        Args:
+            command (Command): what to do
+
+        Returns:
+            asyncio.Future: resolves to the command once it's finished with,
+            whatever happened to it. Check command.status.
+
+        Raises:
+            TypeError: it isn't a Command
+        """
+        if not isinstance(command, Command):
+            raise TypeError(f"Can't schedule {command!r}, it isn't a Command")
+        command.submitted = _now()
+        command.future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (command.priority, next(self._order), command))
+        stats = self.stats[command.kind]
+        stats.submitted += 1
+        stats.depth += 1
+        stats.max_depth = max(stats.max_depth, stats.depth)
+        running = self.current
+        if (running is not None and running.preemptible and command.priority < running.priority
+                and self._task is not None):
+            print(f"Preempting {running.kind} for {command.kind}")
+            running.status = PREEMPTED
+            self._task.cancel()
+        self.wake.set()
+        return command.future
+
+    def cancel(self, command):
+        """Drops a queued command, or stops it if it's running.
+
+        Returns:
+            bool: False if it was already finished with
+        """
+        if command is self.current and self._task is not None:
+            command.status = CANCELLED
+            self._task.cancel()
+            return True
+        for i, (_, _, queued) in enumerate(self._queue):
+            if queued is command:
+                self._queue.pop(i)
+                heapq.heapify(self._queue)
+                self.stats[command.kind].depth -= 1
+                self._finish(command, CANCELLED)
+                return True
+        return False
+
+    def clear(self):
+        """Drops everything queued and stops whatever's running, unless it
+        can't be cut off, like a half-done blink.
+
+        Returns:
+            int: how many commands that got rid of
+        """
+        count = 0
+        while self._queue:
+            _, _, command = heapq.heappop(self._queue)
+            self.stats[command.kind].depth -= 1
+            self._finish(command, CANCELLED)
+            count += 1
+        running = self.current
+        if running is not None and running.preemptible and running.status == RUNNING:
+            count += self.cancel(running)
+        return count
+
+    def position(self, command):
+        """How many commands will run before a queued one, counting whatever's
+        running now unless it's about to be cut off.
+
+        Returns:
+            int: 0 if it's next, None if it isn't queued
+        """
+        key = next(((p, o) for p, o, queued in self._queue if queued is command), None)
+        if key is None:
+            return None
+        ahead = sum(1 for p, o, _ in self._queue if (p, o) < key)
+        if self.current is not None and self.current.status == RUNNING:
+            ahead += 1
+        return ahead
+
+    def _finish(self, command, status):
+        command.status = status
+        command.finished = _now()
+        outcomes = self.stats[command.kind].outcomes
+        outcomes[status] = outcomes.get(status, 0) + 1
+        OUTCOMES.inc(kind=command.kind, status=status)
+        if not command.future.done():
+            command.future.set_result(command)
+
+    async def run(self):
+        """The consumer. Runs forever."""
+        while True:
+            while not self._queue:
+                self.wake.clear()
+                await self.wake.wait()
+            _, _, command = heapq.heappop(self._queue)
+            stats = self.stats[command.kind]
+            stats.depth -= 1
+            if command.expired:
+                print(f"Dropping {command.kind} command, missed its deadline")
+                self._finish(command, EXPIRED)
+                continue
+            command.started = _now()
+            wait = command.started - command.submitted
+            stats.started += 1
+            stats.waited += wait
+            stats.max_wait = max(stats.max_wait, wait)
+            WAIT.observe(wait, kind=command.kind)
+            command.status = RUNNING
+            self.current = command
+            self._task = asyncio.ensure_future(command.run())
+            status = DONE
+            try:
+                command.result = await self._task
+            except asyncio.CancelledError:
+                if command.status == RUNNING:
+                    # Not preempted or cancelled through here, so the scheduler
+                    # itself is being shut down
+                    self._finish(command, CANCELLED)
+                    raise
+                status = command.status
+            except Exception as e:
+                print(f"{command.kind} command failed: {e}")
+                command.error = e
+                status = FAILED
+            finally:
+                self.current = None
+                self._task = None
+            self._finish(command, status)
+
+    def report(self):
+        """Prints the per-class stats."""
+        for kind, stats in self.stats.items():
+            s = stats.as_dict()
+            print(f"{kind}: {s['submitted']} submitted, {s['depth']} queued (max {s['max_depth']}), "
+                  f"wait {s['mean_wait'] * 1000:.0f}ms mean {s['max_wait'] * 1000:.0f}ms max, "
+                  f"{s['outcomes']}")
@@ -0,0 +1,249 @@
+"""Decoded clips and their envelopes in shared memory, for fleet.py.
+
+Every bird used to be its own run.py with its own copy of every clip and its
+analysis in RAM, so memory went up with birds x clips. Here the fleet
+supervisor decodes each unique clip once into one shared memory block, along
+with its per-chunk decisions and envelope, and the bird processes attach to
+it and read numpy views straight out of it. Birds with their own copies of
+the same files share one copy, since clips are matched by their contents.
+
+The layout travels to the birds as a small dict of offsets (the index), so
+attaching is just mapping the block, nothing gets copied or decoded.
+"""
+
+import hashlib
+import os
+from multiprocessing import shared_memory
+import numpy as np
+from .envelope import EnvelopeIndex
+from .library import SoundLibrary, Clip
+from .wavfile import WavFile, WavError
+
+# Start every array on a cache line
+ALIGN = 64
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+class SharedClip(Clip):
+    """A clip whose samples live in the shared block. Works anywhere a WavFile does.
+
+    Args:
+        buf (memoryview): the shared block
+        path (str): the clip's path, for this bird
+        meta (dict): the clip's entry in the bank index
+    """
+    def __init__(self, buf, path, meta) -> None:
+        self.path = path
+        self.channels = meta["channels"]
+        self.rate = meta["rate"]
+        self.sampwidth = meta["sampwidth"]
+        self.bits = meta["bits"]
+        self.format = meta["format"]
+        self.nframes = meta["nframes"]
+        self.data_offset = 0
+        self._raw = meta["raw"]
+        self.frames = np.ndarray((self.nframes, self.channels), dtype=self._raw,
+                                 buffer=buf, offset=meta["frames"])
+
+
+class SharedBank:
+    """The shared block and its index. Also stands in for the EnvelopeIndex,
+    handing out the analysis from the block.
+
+    Use build() in the supervisor and attach() in the birds.
+
+    Args:
+        shm (SharedMemory): the block
+        index (dict): {"chunk": frames per chunk, "clips": {key: meta}, "paths": {path: key}}
+    """
+    def __init__(self, shm, index) -> None:
+        self.shm = shm
+        self.index = index
+        self.chunk = index["chunk"]
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def nbytes(self):
+        """Size of the shared block."""
+        return self.shm.size
+
+    def unshared_bytes(self, directories):
+        """What a bird would take keeping its own copy of its clips.
+
+        Args:
+            directories (list): the bird's directories
+        """
+        directories = [os.path.abspath(d) for d in directories]
+        clips = self.index["clips"]
+        return sum(clips[key]["size"] for path, key in self.index["paths"].items()
+                   if os.path.dirname(path) in directories)
+
+    @classmethod
+    def build(cls, directories, envelopes=None):
+        """Decodes the clips in some directories into a new shared block.
+
+        Args:
+            directories (list): directories full of wav files
+            envelopes (EnvelopeIndex): where the amplitude analysis lives,
+                new or changed files get analyzed and saved
+
+        Returns:
+            SharedBank: the owner's side, unlink() it when done
+        """
+        envelopes = envelopes if envelopes is not None else EnvelopeIndex.load()
+        # Anything new gets analyzed up front, in worker processes
+        envelopes.build(directories)
+        clips = {}
+        paths = {}
+        size = 0
+        for directory in directories:
+            directory = os.path.abspath(directory)
+            for file in sorted(os.listdir(directory)):
+                path = os.path.join(directory, file)
+                if not file.lower().endswith('.wav'):
+                    continue
+                try:
+                    with WavFile(path) as wf:
+                        data = wf.raw(wf.frames)
+                        key = hashlib.sha1(data).hexdigest()
+                        meta = {"channels": wf.channels, "rate": wf.rate, "sampwidth": wf.sampwidth,
+                                "bits": wf.bits, "format": wf.format, "nframes": wf.nframes,
+                                "raw": wf._raw, "size": len(data)}
+                        del data
+                    analysis = envelopes.get(path) or envelopes.add(path)
+                except (OSError, WavError) as e:
+                    print(f"Leaving {path} out of the sound bank: {e}")
+                    continue
+                paths[path] = key
+                if key in clips:
+                    continue
+                meta["source"] = path
+                meta["peak"] = analysis["peak"]
+                meta["mean"] = analysis["mean"]
+                # Only a few dozen numbers, it can ride along in the index
+                meta["beak"] = analysis["beak"]
+                meta["chunks"] = len(analysis["decisions"])
+                meta["frames"] = size
+                size = _align(size + meta["size"])
+                meta["decisions"] = size
+                size = _align(size + meta["chunks"])
+                meta["envelope"] = size
+                size = _align(size + meta["chunks"] * 4)
+                meta["_analysis"] = analysis
+                clips[key] = meta
+        envelopes.save()
+
+        # SharedMemory won't make an empty block
+        shm = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        bank = cls(shm, {"chunk": envelopes.chunk, "clips": clips, "paths": paths})
+        for meta in clips.values():
+            analysis = meta.pop("_analysis")
+            with WavFile(meta["source"]) as wf:
+                bank._array(meta["frames"], np.uint8, meta["size"])[:] = np.frombuffer(wf.raw(wf.frames), np.uint8)
+            bank._array(meta["decisions"], np.uint8, meta["chunks"])[:] = analysis["decisions"]
+            bank._array(meta["envelope"], np.float32, meta["chunks"])[:] = analysis["envelope"]
+        return bank
+
+    @classmethod
+    def attach(cls, name, index):
+        """Maps a block the supervisor built.
+
+        Args:
+            name (str): SharedBank.name from the supervisor
+            index (dict): SharedBank.index from the supervisor
+
+        Returns:
+            SharedBank: the bird's side
+        """
+        return cls(shared_memory.SharedMemory(name=name), index)
+
+    def _array(self, offset, dtype, count):
+        return np.ndarray((count,), dtype=dtype, buffer=self.shm.buf, offset=offset)
+
+    def clip(self, path):
+        """The clip at a path, as a view into the block.
+
+        Returns:
+            SharedClip: the clip, or None if it isn't in the bank
+        """
+        key = self.index["paths"].get(os.path.abspath(path))
+        if key is None:
+            return None
+        return SharedClip(self.shm.buf, path, self.index["clips"][key])
+
+    def get(self, filename):
+        """Same as EnvelopeIndex.get(), but with views into the block.
+
+        Returns:
+            dict: chunk, envelope, decisions, peak, mean and beak, or None
+        """
+        key = self.index["paths"].get(os.path.abspath(filename))
+        if key is None:
+            return None
+        meta = self.index["clips"][key]
+        return {
+            "chunk": self.chunk,
+            "envelope": self._array(meta["envelope"], np.float32, meta["chunks"]),
+            "decisions": self._array(meta["decisions"], np.uint8, meta["chunks"]),
+            "peak": meta["peak"],
+            "mean": meta["mean"],
+            "beak": meta["beak"],
+        }
+
+    def save(self):
+        # Nothing to save, the supervisor already saved the EnvelopeIndex
+        pass
+
+    def close(self):
+        self.shm.close()
+
+    def unlink(self):
+        """Frees the block. Only the supervisor should."""
+        self.shm.unlink()
+
+
+class SharedLibrary(SoundLibrary):
+    """A SoundLibrary that plays clips out of a SharedBank instead of the files.
+    The bank is fixed for as long as the fleet runs, so restart the fleet to
+    pick up new sounds.
+
+    Args:
+        bank (SharedBank): attached bank
+        directories (list): this bird's directories
+    """
+    def __init__(self, bank, directories) -> None:
+        super().__init__(directories, bank, budget=0)
+        self.bank = bank
+        self.scan()
+
+    def scan(self):
+        entries = {}
+        for path in self.bank.index["paths"]:
+            if os.path.dirname(path) not in self.directories:
+                continue
+            clip = self.bank.clip(path)
+            analysis = self.bank.get(path)
+            entries[path] = {"duration": clip.duration, "rate": clip.rate, "channels": clip.channels,
+                             "peak": analysis["peak"], "envelope": analysis["envelope"]}
+        with self._lock:
+            self.entries = entries
+        return len(entries)
+
+    def load(self, path):
+        clip = self.bank.clip(path)
+        if clip is None:
+            # Not in the bank, play it from the file
+            self.misses += 1
+            return WavFile(path)
+        self.hits += 1
+        return clip
+
+    async def watch(self):
+        # The bank doesn't change, nothing to watch
+        return
@@ -0,0 +1,420 @@
+"""A pretend Squawkers McCaw for running the control code off the Pi.
+
+Stands in for adafruit_motorkit, RPi.GPIO and pyaudio (see squawker.backend).
+The motors spin up and down instead of starting instantly, the gears have
+slop, the body goes around its loop in about 2.22 seconds and the eye and body
+switches change state (and fire edges) where the mechanism puts them.
+
+Positions use the same units as BodyController: hundredths of a second of
+full-speed motor travel, 222 to a full body cycle.
+"""
+
+import threading
+import time
+from collections import deque
+
+# Motor model
+TICK = 0.001            # physics step, seconds
+SPIN_UP = 0.04          # time constants for speeding up/slowing down, seconds
+SPIN_DOWN = 0.015
+SLOP = 3                # gear backlash, units
+CYCLE = 2.22            # seconds for one full body loop at full throttle
+
+# Mechanism layout
+BODY_MAX = 222
+BODY_OPEN = 8           # body switch is open for this many units before zero
+EYE_CYCLE = 40
+# (phase, right switch, left switch) going around the eye cam in reverse
+EYE_TRACK = [(0, 0, 1), (8, 0, 0), (11, 1, 1), (14, 1, 0), (26, 0, 0), (29, 1, 1), (32, 0, 1)]
+BEAK_TRAVEL = 10        # units of forward travel to fully open the beak
+BEAK_CLOSE = 0.05       # seconds for the spring to close the beak
+
+# Where motors.py wires things up by default
+LEFT_EYE_PIN = 12
+RIGHT_EYE_PIN = 5
+BODY_PIN = 6
+
+
+class _Gear:
+    """One motor and its gearbox. Throttle is what was asked for, speed is what
+    the motor is actually doing."""
+    def __init__(self) -> None:
+        self.target = 0
+        self.speed = 0.0
+        self.backlash = 0.0
+        self.ontime = 0.0
+        self.writes = 0
+
+    def step(self, dt, rate):
+        tau = SPIN_UP if abs(self.target) > abs(self.speed) else SPIN_DOWN
+        self.speed += (self.target - self.speed) * min(1.0, dt / tau)
+        if self.target != 0:
+            self.ontime += dt
+        travel = self.speed * dt * rate
+        # The motor has to take up the slop before the output moves
+        backlash = min(SLOP, max(-SLOP, self.backlash + travel))
+        out = travel - (backlash - self.backlash)
+        self.backlash = backlash
+        return out
+
+    def idle(self):
+        return self.target == 0 and abs(self.speed) < 1e-4
+
+
+class Rig:
+    """The whole pretend bird: both motors, the mechanisms and the switches.
+
+    Time only moves forward when something looks at the rig (or the ticker
+    thread is running for edge callbacks), so an idle rig costs nothing.
+    """
+    def __init__(self, clock=time.monotonic) -> None:
+        self.clock = clock
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.t = clock()
+        self.rate = BODY_MAX / CYCLE
+        self.eye_gear = _Gear()
+        self.body_gear = _Gear()
+        self.body = 0.0
+        self.eyes = 34.0
+        self.beak = 0.0
+        self.edgelog = deque(maxlen=256)
+        self.wire()
+        self.edgecount = 0
+        self.callbacks = {}
+        self._wake = threading.Event()
+        self._ticker = None
+
+    def wire(self, left_eye=LEFT_EYE_PIN, right_eye=RIGHT_EYE_PIN, body=BODY_PIN):
+        """Puts the switches on other GPIO pins, for a bird that isn't wired
+        up the way motors.py expects. Has to happen before anything watches them.
+
+        Args:
+            left_eye (int): left eye switch pin
+            right_eye (int): right eye switch pin
+            body (int): body switch pin
+        """
+        with self.lock:
+            self.pins = {left_eye: self._left, right_eye: self._right, body: self._body_switch}
+            self.levels = {pin: read() for pin, read in self.pins.items()}
+            self.edges = {pin: 0 for pin in self.pins}
+
+    def _eye_levels(self):
+        phase = self.eyes % EYE_CYCLE
+        levels = EYE_TRACK[0]
+        for mark in EYE_TRACK:
+            if phase >= mark[0]:
+                levels = mark
+        return levels
+
+    def _left(self):
+        return self._eye_levels()[2]
+
+    def _right(self):
+        return self._eye_levels()[1]
+
+    def _body_switch(self):
+        return 1 if self.body % BODY_MAX >= BODY_MAX - BODY_OPEN else 0
+
+    def advance(self):
+        """Runs the physics up to the current time and fires any edge callbacks."""
+        fired = []
+        with self.lock:
+            now = self.clock()
+            if self.eye_gear.idle() and self.body_gear.idle():
+                # Nothing moves, skip straight to now
+                self.t = max(self.t, now)
+                return
+            while self.t + TICK <= now:
+                self.t += TICK
+                out = self.eye_gear.step(TICK, self.rate)
+                if out < 0:
+                    self.eyes -= out
+                if out > 0:
+                    self.beak = min(1.0, self.beak + out / BEAK_TRAVEL)
+                else:
+                    self.beak = max(0.0, self.beak - TICK / BEAK_CLOSE)
+                self.body = (self.body + self.body_gear.step(TICK, self.rate)) % BODY_MAX
+                for pin, read in self.pins.items():
+                    level = read()
+                    if level != self.levels[pin]:
+                        self.levels[pin] = level
+                        self.edges[pin] += 1
+                        self.edgelog.append((self.t, pin, level))
+                        self.edgecount += 1
+                        for edge, callback in self.callbacks.get(pin, []):
+                            if _matches(edge, level):
+                                fired.append((callback, pin))
+            if fired:
+                self.changed.notify_all()
+        for callback, pin in fired:
+            callback(pin)
+
+    def set_throttle(self, gear, value):
+        with self.lock:
+            self.advance()
+            gear.target = 0 if value is None else value
+            gear.writes += 1
+        self._wake.set()
+
+    def _tick(self):
+        while True:
+            self.advance()
+            with self.lock:
+                idle = self.eye_gear.idle() and self.body_gear.idle()
+            if idle:
+                self._wake.wait(0.1)
+                self._wake.clear()
+            else:
+                time.sleep(TICK)
+
+    def start_ticker(self):
+        """Keeps time moving in the background so edge callbacks fire on their own."""
+        with self.lock:
+            if self._ticker is None:
+                self._ticker = threading.Thread(target=self._tick, name="sim-ticker", daemon=True)
+                self._ticker.start()
+
+    def stats(self):
+        """Motor on-times, throttle writes and switch edges so far.
+
+        Returns:
+            dict: counters for benchmarking
+        """
+        with self.lock:
+            self.advance()
+            return {
+                "eye_beak_ontime": self.eye_gear.ontime,
+                "body_ontime": self.body_gear.ontime,
+                "eye_beak_writes": self.eye_gear.writes,
+                "body_writes": self.body_gear.writes,
+                "edges": dict(self.edges),
+            }
+
+
+def _matches(edge, level):
+    if edge == GPIO.BOTH:
+        return True
+    return (edge == GPIO.RISING) == (level == 1)
+
+
+rig = Rig()
+
+
+class DCMotor:
+    """Looks enough like adafruit_motor.motor.DCMotor for motors.py"""
+    FAST_DECAY = 0
+    SLOW_DECAY = 1
+
+    def __init__(self, gear) -> None:
+        self._gear = gear
+        self._throttle = 0
+        self.decay_mode = self.FAST_DECAY
+
+    @property
+    def throttle(self):
+        return self._throttle
+
+    @throttle.setter
+    def throttle(self, value):
+        if value is not None and not -1.0 <= value <= 1.0:
+            raise ValueError("Throttle must be None or between -1.0 and +1.0")
+        self._throttle = value
+        rig.set_throttle(self._gear, value)
+
+
+class MotorKit:
+    """Only motor1 (eyes/beak) and motor2 (body) are hooked up to anything."""
+    def __init__(self, i2c=None, address=0x60, **kwargs) -> None:
+        self.address = address
+        self.motor1 = DCMotor(rig.eye_gear)
+        self.motor2 = DCMotor(rig.body_gear)
+        self.motor3 = DCMotor(_Gear())
+        self.motor4 = DCMotor(_Gear())
+
+
+class _GPIO:
+    """The bits of RPi.GPIO that motors.py uses."""
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    HIGH = 1
+    LOW = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self) -> None:
+        self.mode = None
+        self._detect = {}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, channel, direction, pull_up_down=None, initial=None):
+        if self.mode is None:
+            raise RuntimeError("Please set pin numbering mode using GPIO.setmode(GPIO.BOARD) or GPIO.setmode(GPIO.BCM)")
+
+    def input(self, channel):
+        rig.advance()
+        with rig.lock:
+            return rig.levels.get(channel, 1)
+
+    def wait_for_edge(self, channel, edge, bouncetime=None, timeout=None):
+        if channel in self._detect:
+            raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+        deadline = None if timeout is None else time.monotonic() + timeout / 1000
+        with rig.lock:
+            rig.advance()
+            seen = rig.edgecount
+            while True:
+                rig.changed.wait(TICK)
+                rig.advance()
+                new = rig.edgecount - seen
+                seen = rig.edgecount
+                for t, pin, level in list(rig.edgelog)[-new:] if new else []:
+                    if pin == channel and _matches(edge, level):
+                        return channel
+                if deadline is not None and time.monotonic() >= deadline:
+                    return None
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        if channel in self._detect:
+            raise RuntimeError("Conflicting edge detection already enabled for this GPIO channel")
+        self._detect[channel] = edge
+        with rig.lock:
+            rig.callbacks[channel] = []
+        if callback is not None:
+            self.add_event_callback(channel, callback)
+        rig.start_ticker()
+
+    def add_event_callback(self, channel, callback):
+        if channel not in self._detect:
+            raise RuntimeError("Add event detection using add_event_detect first before adding a callback")
+        with rig.lock:
+            rig.callbacks[channel].append((self._detect[channel], callback))
+
+    def remove_event_detect(self, channel):
+        self._detect.pop(channel, None)
+        with rig.lock:
+            rig.callbacks.pop(channel, None)
+
+    def cleanup(self, channel=None):
+        self._detect.clear()
+        with rig.lock:
+            rig.callbacks.clear()
+            rig.eye_gear.target = 0
+            rig.body_gear.target = 0
+
+
+GPIO = _GPIO()
+
+
+class _Stream:
+    """An output stream that throws the audio away, taking as long to do it
+    as a real sound card would, unless pacing is turned off."""
+    def __init__(self, owner, rate, channels, format) -> None:
+        self.owner = owner
+        self.rate = rate
+        self.channels = channels
+        self.format = format
+        self.frames = 0
+        self.underflows = 0
+        self._ahead = time.monotonic()
+        self._active = False
+
+    def start_stream(self):
+        self._active = True
+        self._ahead = time.monotonic()
+
+    def stop_stream(self):
+        self._active = False
+
+    def close(self):
+        self._active = False
+
+    def is_active(self):
+        return self._active
+
+    def get_output_latency(self):
+        return self.owner.latency
+
+    def get_write_available(self):
+        return 4096
+
+    def write(self, frames, num_frames=None, exception_on_underflow=False):
+        if num_frames is None:
+            num_frames = len(frames) // (self.channels * self.owner.get_sample_size(self.format))
+        first = self.frames == 0
+        self.frames += num_frames
+        if not self.owner.realtime:
+            return
+        # Like a sound card, let writes get one buffer ahead and then block
+        now = time.monotonic()
+        underflow = not first and now > self._ahead
+        self._ahead = max(self._ahead, now) + num_frames / self.rate
+        wait = self._ahead - now - self.owner.latency
+        if wait > 0:
+            time.sleep(wait)
+        if underflow:
+            self.underflows += 1
+            if exception_on_underflow:
+                raise IOError(self.owner.paOutputUnderflowed, "Output underflowed")
+
+
+class _PyAudio:
+    def __init__(self, module) -> None:
+        self._module = module
+
+    def open(self, format, channels, rate, output=True, **kwargs):
+        return _Stream(self._module, rate, channels, format)
+
+    def get_format_from_width(self, width, unsigned=True):
+        return self._module.get_format_from_width(width, unsigned)
+
+    def get_sample_size(self, format):
+        return self._module.get_sample_size(format)
+
+    def terminate(self):
+        pass
+
+
+class _PyAudioModule:
+    """The bits of the pyaudio module that sound.py uses."""
+    paFloat32 = 1
+    paInt32 = 2
+    paInt24 = 4
+    paInt16 = 8
+    paInt8 = 16
+    paUInt8 = 32
+    paOutputUnderflowed = -9980
+
+    def __init__(self) -> None:
+        # Set realtime to False to make playback run as fast as it can
+        self.realtime = True
+        self.latency = 0.05
+
+    def PyAudio(self):
+        return _PyAudio(self)
+
+    def get_format_from_width(self, width, unsigned=True):
+        if width == 1:
+            return self.paUInt8 if unsigned else self.paInt8
+        formats = {2: self.paInt16, 3: self.paInt24, 4: self.paFloat32}
+        if width not in formats:
+            raise ValueError(f"Invalid width: {width}")
+        return formats[width]
+
+    def get_sample_size(self, format):
+        sizes = {self.paFloat32: 4, self.paInt32: 4, self.paInt24: 3,
+                 self.paInt16: 2, self.paInt8: 1, self.paUInt8: 1}
+        return sizes[format]
+
+
+pyaudio = _PyAudioModule()
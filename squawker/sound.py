@@ -1,12 +1,112 @@
+import asyncio
 import contextlib
-import wave
+import threading
+import time
 import numpy as np
-import pyaudio
+from . import envelope, audioengine, lipsync, motordriver, trace
+from .wavfile import WavFile
 
 """I'm not smart enough for this, I modified it from internet tutorials involving
 driving LED lights. I just s/LED/Motor, played with the variables, and bob's your uncle.
 """
 
+class Playback:
+    """Handle for a clip that Squawk.play() is playing on its own thread.
+
+    Await it to wait for the clip to finish (the result is the mean converted
+    amplitude). Cancelling the awaiting task, or calling cancel(), stops the
+    clip at the next chunk. Motor commands from the audio thread are sent back
+    to the event loop with the time they were decided, so the lag can be seen.
+    """
+    def __init__(self, squawk, filename, loop, trigger=None) -> None:
+        self.squawk = squawk
+        self.filename = filename
+        self.loop = loop
+        self.trigger = trigger
+        self.frames = 0
+        self.total = 0
+        self.rate = 0
+        self.commands = 0
+        self.max_lag = 0.0
+        # The clip's LipSync, while the lookahead schedule is driving the motors
+        self.sync = None
+        self._cancel = threading.Event()
+        self._future = loop.create_future()
+        self._thread = threading.Thread(target=self._worker, name="squawk-playback", daemon=True)
+
+    @property
+    def progress(self):
+        """Fraction of the clip that has been played, 0 to 1."""
+        if not self.total:
+            return 0.0
+        return min(1.0, self.frames / self.total)
+
+    @property
+    def position(self):
+        """Seconds of the clip that have been played."""
+        return self.frames / self.rate if self.rate else 0.0
+
+    @property
+    def cancelled(self):
+        return self._cancel.is_set()
+
+    def cancel(self):
+        """Stops the clip at the next chunk."""
+        self._cancel.set()
+
+    def done(self):
+        return self._future.done()
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def send(self, decision):
+        """Called on the audio threads, hands a motor command to the event loop."""
+        try:
+            self.loop.call_soon_threadsafe(self._apply, time.monotonic(), decision)
+        except RuntimeError:
+            # The event loop is already gone, nobody's left to drive the motors
+            self.cancel()
+            if self.sync is not None:
+                self.sync.stop()
+
+    def _apply(self, stamp, decision):
+        self.commands += 1
+        self.max_lag = max(self.max_lag, time.monotonic() - stamp)
+        # Never spin on the event loop, a blink will just eat this chunk's beak
+        self.squawk._apply(decision, wait=False)
+
+    def _finish(self, result, error):
+        if self._future.done():
+            return
+        if error is not None:
+            self._future.set_exception(error)
+        else:
+            self._future.set_result(result)
+
+    def _worker(self):
+        result = error = None
+        try:
+            result = self.squawk.run(self.filename, self, self.trigger)
+        except Exception as e:
+            error = e
+        try:
+            self.loop.call_soon_threadsafe(self._finish, result, error)
+        except RuntimeError:
+            # The event loop is already gone
+            pass
+
+    async def wait(self):
+        try:
+            return await asyncio.shield(self._future)
+        except asyncio.CancelledError:
+            self.cancel()
+            raise
+
+    def __await__(self):
+        return self.wait().__await__()
+
 class Squawk:
     """The functions in this class play a wav file through the raspberry Pi's
     audio system, and perform some analysis of the wav data to determine when
@@ -14,13 +114,29 @@ class Squawk:
     file's amplitude. This avoids needing to volume-normalize or otherwise 
     dick around with wav files.
     """
-    def __init__(self, beak, body) -> None:
+    def __init__(self, beak, body, envelopes=None, engine=None, library=None) -> None:
         # I don't think there's any reason to change CHUNK.
         # A bigger value *might* give an average that works better
         # with the sloppy gearing, but it doesn't seem to matter.
-        self.CHUNK = 2048
+        # benchmarks/bench.py --sweep measures it: CPU roughly halves every
+        # time CHUNK doubles, but each chunk is one beak decision (46ms at
+        # 2048), and the motors can't do much better than that anyway.
+        self.CHUNK = envelope.CHUNK
         self.beak = beak
         self.body = body
+        # Optional envelope.EnvelopeIndex with precomputed motor decisions
+        self.envelopes = envelopes
+        # Shared audio output, defaults to the process-wide one
+        self.engine = engine
+        # Optional library.SoundLibrary to play clips out of RAM
+        self.library = library
+        # When the envelope is known ahead of time, switch the motors early
+        # by how long they take to respond (see lipsync.py)
+        self.lookahead = True
+        self.beak_latency = lipsync.BEAK_LATENCY
+        self.body_latency = lipsync.BODY_LATENCY
+        self.min_on = lipsync.MIN_ON
+        self.min_off = lipsync.MIN_OFF
         
         
 # I really don't understand decorators
@@ -28,99 +144,202 @@ class Squawk:
 # as a generator. I haven't the slightest clue how I'd know 
 # to do this without stealing internet code.
     @contextlib.contextmanager
-    def _audio_stream(self, wf):
-        """Passes the wave data from the object to a pyaudio stream
-        resulting in audio output
+    def _audio_stream(self, wf, width, trigger=None):
+        """Passes the wave data from the object to the audio engine
+        resulting in audio output. The engine keeps the sound card open
+        between clips, so this doesn't have to start PyAudio every time.
 
         Args:
-            wf (wave): An open wave file
+            wf (WavFile): An open wave file
+            width: numpy dtype of the wave data
+            trigger (float): time.monotonic() of what caused this clip, for latency reporting
 
         Yields:
-            pyaudio: The wave file data output as an audio stream
+            ClipStream: The wave file data output as an audio stream
         """
-        p = pyaudio.PyAudio()
-
-        stream = p.open(format=p.get_format_from_width(wf.getsampwidth()),
-                        channels=wf.getnchannels(),
-                        rate=wf.getframerate(),
-                        output=True
-                        )
-        try:
+        engine = self.engine or audioengine.get_engine()
+        with engine.clip(width, wf.channels, wf.rate, trigger) as stream:
             yield stream
-        finally:
-            stream.stop_stream()
-            stream.close()
-            p.terminate()
 
     def _getwavefmt(self, wf):
         """PyAudio needs to know how the wav data is formatted in order 
         to play each chunk. It also allows numpy to process the data 
-        for the amplitude calculation. It seems like this "width" is the
-        key thing they need for wav data, but idk.
+        for the amplitude calculation. WavFile reads the header properly,
+        so this is just the numpy type of its samples now.
 
         Args:
-            wf (wave): A PyAudio opened Wave object 
+            wf (WavFile): An opened wav file
 
         Returns:
-            int: Format width of the wave object.
+            numpy.dtype: type of the samples WavFile hands out
         """
-        pyaudio_format = pyaudio.get_format_from_width(wf.getsampwidth())
-        print(f"format: {pyaudio_format}")
-        if pyaudio_format == pyaudio.paInt16:
-            return np.int16
-        else:
-            print("For the moment, only support 16 bit format")
-            #Not entirely clear on what this means, but it doesn't work
-            # if the width doesn't match the format.
-            return np.int8
+        print(f"format: {wf.format} {wf.bits} bit, {wf.channels} channels at {wf.rate} Hz")
+        return wf.dtype
         
-    def _squawk_io(self, np_data):
+    def _squawk_io(self, np_data, playback=None):
         """Analyzes the CHUNK of the wav file to determine
         the average amplitude of the audio. If above a 
         threshhold, activate the relevant motors.
 
         Args:
             np_data (wave data): one of the wav chunks
+            playback (Playback): if playing on a thread, where to send motor commands
 
         Returns:
             float: the calculated average amplitude of the chunk
         """
-        mean = np.mean(np.absolute(np_data))
-        avg = float(mean) / 50
+        avg = envelope.amplitude(np_data)
         #print(avg)
-        if avg > 15:
-            self.beak.open_beak()
-            if avg > 20:
-                self.body.body_motor.throttle = 1
+        self._command(envelope.decide(avg), playback, avg)
+        return avg
+
+    def _command(self, command, playback=None, amplitude=float('nan')):
+        """Runs a motor command here, or sends it to the event loop when
+        playing on a thread.
+
+        Args:
+            command: an envelope decision, or a (motor, on) tuple from lipsync
+            playback (Playback): if playing on a thread, where to send it
+            amplitude (float): the chunk's amplitude, for the trace, if it was worked out live
+        """
+        if isinstance(command, tuple):
+            motor = "body" if command[0] == "body" else "eye_beak"
+            trace.record(trace.LIPSYNC, trace.MOTORS[motor], int(command[1]))
         else:
+            trace.record(trace.DECISION, 0, command, amplitude)
+        if playback is None:
+            self._apply(command)
+        else:
+            playback.send(command)
+
+    def _apply(self, command, wait=True):
+        # Beak and body changes go out to the HAT together
+        with motordriver.get_driver().batch():
+            if isinstance(command, tuple):
+                self._set_motor(*command, wait=wait)
+            else:
+                self._actuate(command, wait)
+
+    def _set_motor(self, motor, on, wait=True):
+        """Switches just one motor, for the lookahead schedule.
+
+        Args:
+            motor (str): beak or body
+            on (bool): run or stop it
+            wait (bool): wait for a blink to finish before opening the beak,
+                otherwise skip opening it
+        """
+        if motor == "body":
+            self.body.body_motor.throttle = 1 if on else 0
+        elif not on:
+            self.beak.close_beak()
+        elif wait or self.beak.eye_beak_motor.throttle >= 0:
+            self.beak.open_beak()
+
+    def _actuate(self, decision, wait=True):
+        """Runs the motors for one chunk's decision.
+
+        Args:
+            decision (int): envelope.CLOSED, BEAK or BEAK_BODY
+            wait (bool): wait for a blink to finish before opening the beak,
+                otherwise skip opening it
+        """
+        if decision == envelope.CLOSED:
             self.beak.close_beak()
             self.body.body_motor.throttle = 0
-        return avg
+        else:
+            if wait or self.beak.eye_beak_motor.throttle >= 0:
+                self.beak.open_beak()
+            if decision == envelope.BEAK_BODY:
+                self.body.body_motor.throttle = 1
+
+    def _lookup(self, filename):
+        """Precomputed analysis for the file, if there's a current one.
+
+        Args:
+            filename (string): Path to the wave file
+
+        Returns:
+            dict: envelope index entry, or None
+        """
+        if self.envelopes is None or self.envelopes.chunk != self.CHUNK:
+            return None
+        return self.envelopes.get(filename)
+
+    def play(self, filename, trigger=None):
+        """Starts playing the wave file on its own thread so the event loop
+        keeps running. Has to be called from a coroutine.
+
+        Args:
+            filename (string): Path to the wave file
+            trigger (float): time.monotonic() of what caused this clip
 
-    def run(self, filename):
+        Returns:
+            Playback: awaitable handle for the clip
+        """
+        return Playback(self, filename, asyncio.get_running_loop(), trigger).start()
+
+    def run(self, filename, playback=None, trigger=None):
         """Plays the wave file and sends it to the motor IO function.
+        This blocks until the clip is done, see play() for the threaded version.
 
         Args:
             filename (string): Path to the wave file
-            chunk (int): Wave data chunk size
+            playback (Playback): handle to report progress to and take cancels from
+            trigger (float): time.monotonic() of what caused this clip
+
+        Returns:
+            float: mean converted amplitude of the clip
         """
-        wf = wave.open(filename, 'rb')
-        #wf: PyAudio Wave file
+        if trigger is None:
+            trigger = time.monotonic()
+        if self.library is not None:
+            wf = self.library.load(filename)
+        else:
+            wf = WavFile(filename)
         chunk = self.CHUNK
         width = self._getwavefmt(wf)
+        cached = self._lookup(filename)
+        if playback is not None:
+            playback.total = wf.nframes
+            playback.rate = wf.rate
+        sync = None
+        if cached is not None and self.lookahead:
+            events = lipsync.schedule(cached["decisions"], chunk / wf.rate,
+                                      self.beak_latency, self.body_latency,
+                                      self.min_on, self.min_off, cached.get("beak"))
+            sync = lipsync.LipSync(events, lambda motor, on: self._command((motor, on), playback))
+            if playback is not None:
+                playback.sync = sync
         
         # Ok, so using the contextlib data yield allows the stream to be read
         # chunk by chunk and then does the appropriate file handling? 
-        with self._audio_stream(wf) as stream:
-            data = wf.readframes(chunk)
+        with wf, self._audio_stream(wf, width, trigger) as stream:
             arr = []
-            stream.start_stream()
-            while len(data) > 0:
-                stream.write(data, chunk)
-                arr.append(self._squawk_io(np.frombuffer(data, dtype=width)))
-                data = wf.readframes(chunk)
-            self.beak.close_beak()
-            self.body.body_motor.throttle = 0
-            nparr = np.array([arr])
-            mn = np.mean(nparr)
+            if sync is not None:
+                # The first sample is heard once what's already buffered has played
+                sync.start(time.monotonic() + stream.engine.output_latency)
+            # Each chunk is a view straight into the mapped file, nothing gets copied
+            for i, view in enumerate(wf.chunks(chunk)):
+                if playback is not None and playback.cancelled:
+                    print("Playback cancelled.")
+                    break
+                stream.write(wf.samples(view), wf.raw(view))
+                # With lookahead, the lipsync thread is driving the motors
+                if sync is None:
+                    if cached is not None and i < len(cached["decisions"]):
+                        # No numpy in the audio loop, the analysis was done offline
+                        self._command(cached["decisions"][i], playback)
+                    else:
+                        arr.append(self._squawk_io(wf.levels(view), playback))
+                if playback is not None:
+                    playback.frames += len(view)
+            if sync is not None:
+                sync.stop()
+            self._command(envelope.CLOSED, playback)
+            if cached is not None:
+                mn = cached["mean"]
+            else:
+                mn = np.mean(np.array([arr])) if arr else 0.0
             print(f"Mean converted amplitude is: {mn}.")
+        return float(mn)
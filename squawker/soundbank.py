@@ -0,0 +1,362 @@
+"""Packs a directory of wav files into one bank file.
+
+Playing a loose wav file means finding it on the SD card, opening it, mapping
+it and parsing its header, then converting it to the sound card's format chunk
+by chunk as it plays. A bank does all of that once, at build time:
+
+    python -m squawker.soundbank build sounds          # writes sounds.bank
+    python -m squawker.soundbank list sounds.bank
+
+and run.py takes the bank wherever it takes a sound directory. The bank gets
+mapped once, and starting a clip is a hash lookup and a numpy view, no
+filesystem lookups and no header parsing.
+
+Layout, all little endian, every section starting on a 64 byte boundary:
+
+    header      magic, version, output format, chunk size, section offsets
+    entries     one per clip: where its samples and tracks are, frames, peak,
+                beak movements
+    slots       open addressing hash table of clip names, FNV-1a
+    names       clip names, utf-8
+    clips       each clip's samples, int16 interleaved in the audio engine's
+                rate and channels, then its per-chunk decisions (uint8),
+                envelope (float32) and beak track (uint32 open, close
+                milliseconds, see squawker.syllables) worked out from those
+                samples
+"""
+
+import argparse
+import mmap
+import os
+import struct
+import numpy as np
+from . import audioengine, envelope, syllables
+from .library import SoundLibrary, Clip, BUDGET
+from .wavfile import WavFile, WavError
+
+MAGIC = b'SQBK'
+VERSION = 2
+ALIGN = 64
+EXTENSION = '.bank'
+
+HEADER = struct.Struct('<4sHHIIIIQQQQ')
+ENTRY = struct.Struct('<QQQQIIIIfIQ')
+SLOT = struct.Struct('<QI4x')
+
+
+class BankError(ValueError):
+    """The file isn't a bank this can read."""
+
+
+def _align(n):
+    return (n + ALIGN - 1) // ALIGN * ALIGN
+
+
+def _hash(name):
+    """64 bit FNV-1a of a name's bytes."""
+    h = 0xcbf29ce484222325
+    for b in name:
+        h = ((h ^ b) * 0x100000001b3) & 0xFFFFFFFFFFFFFFFF
+    return h
+
+
+def _tracks(samples, chunk, rate):
+    """Per-chunk envelope and decisions for int16 samples, chunked the same
+    way playback will chunk them, and the beak track."""
+    env = [envelope.amplitude(samples[start:start + chunk]) for start in range(0, len(samples), chunk)]
+    return env, [envelope.decide(avg) for avg in env], syllables.track(samples, rate)
+
+
+def build(directory, path=None, chunk=envelope.CHUNK, rate=audioengine.RATE, channels=audioengine.CHANNELS):
+    """Packs every playable wav file in a directory into a bank.
+
+    Args:
+        directory (str): directory full of wav files
+        path (str): where to write the bank, defaults to the directory name + .bank
+        chunk (int): frames per chunk for the envelope tracks
+        rate (int): sample rate to convert everything to
+        channels (int): channel count to convert everything to
+
+    Returns:
+        str: path of the bank
+    """
+    directory = os.path.abspath(directory)
+    path = path or directory.rstrip(os.sep) + EXTENSION
+    clips = []
+    for file in sorted(os.listdir(directory)):
+        if not file.lower().endswith('.wav'):
+            continue
+        try:
+            with WavFile(os.path.join(directory, file)) as wf:
+                converter = audioengine.Converter(wf.dtype, wf.channels, wf.rate, channels, rate)
+                pcm = np.frombuffer(converter.convert(wf.samples(wf.frames)), dtype='<i2')
+        except (OSError, WavError) as e:
+            print(f"Leaving {file} out of the bank: {e}")
+            continue
+        frames = pcm.reshape(-1, channels)
+        env, decisions, beak = _tracks(frames, chunk, rate)
+        peak = int(np.max(np.absolute(pcm.astype(np.int32)))) if len(pcm) else 0
+        clips.append((file.encode(), frames, env, decisions, beak, peak))
+
+    nslots = 1
+    while nslots < 2 * len(clips):
+        nslots *= 2
+    entries_at = _align(HEADER.size)
+    slots_at = _align(entries_at + ENTRY.size * len(clips))
+    names_at = _align(slots_at + SLOT.size * nslots)
+    pos = _align(names_at + sum(len(c[0]) for c in clips))
+
+    entries = bytearray()
+    slots = [(0, 0)] * nslots
+    names = bytearray()
+    layout = []
+    for i, (name, frames, env, decisions, beak, peak) in enumerate(clips):
+        data = pos
+        decisions_at = _align(data + frames.nbytes)
+        envelope_at = _align(decisions_at + len(decisions))
+        beak_at = _align(envelope_at + 4 * len(env))
+        pos = _align(beak_at + 8 * len(beak))
+        mean = float(np.mean(env)) if env else 0.0
+        entries += ENTRY.pack(data, len(frames), decisions_at, envelope_at, len(env),
+                              names_at + len(names), len(name), peak, mean, len(beak), beak_at)
+        layout.append((data, decisions_at, envelope_at, beak_at))
+        names += name
+        h = _hash(name)
+        slot = h & (nslots - 1)
+        while slots[slot][1]:
+            slot = (slot + 1) & (nslots - 1)
+        slots[slot] = (h, i + 1)
+
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'wb') as f:
+        def put(offset, data):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(data)
+        put(0, HEADER.pack(MAGIC, VERSION, channels, rate, chunk, len(clips), nslots,
+                           entries_at, slots_at, names_at, pos))
+        put(entries_at, entries)
+        put(slots_at, b''.join(SLOT.pack(*s) for s in slots))
+        put(names_at, names)
+        for (name, frames, env, decisions, beak, peak), (data, decisions_at, envelope_at, beak_at) \
+                in zip(clips, layout):
+            put(data, frames.tobytes())
+            put(decisions_at, bytes(decisions))
+            put(envelope_at, np.asarray(env, dtype='<f4').tobytes())
+            put(beak_at, np.asarray(beak, dtype='<u4').tobytes())
+        put(pos, b'')
+    os.replace(tmp, path)
+    return path
+
+
+def is_bank(path):
+    """True if path is a bank file rather than a directory."""
+    if not os.path.isfile(path):
+        return False
+    with open(path, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+class BankClip(Clip):
+    """A clip straight out of the bank's mapping. Works anywhere a WavFile does,
+    and is already in the audio engine's format so it plays without converting.
+    """
+    def __init__(self, bank, path, data, nframes) -> None:
+        self.path = path
+        self.channels = bank.channels
+        self.rate = bank.rate
+        self.sampwidth = 2
+        self.bits = 16
+        self.format = 'pcm'
+        self.nframes = nframes
+        self.data_offset = data
+        self._raw = np.dtype('<i2')
+        self.frames = np.frombuffer(bank._map, dtype=self._raw, count=nframes * bank.channels,
+                                    offset=data).reshape(nframes, bank.channels)
+
+
+class SoundBank:
+    """An open bank file.
+
+    Args:
+        path (str): the bank
+
+    Raises:
+        BankError: not a bank, or one from a different version
+    """
+    def __init__(self, path) -> None:
+        self.path = os.path.abspath(path)
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < HEADER.size:
+            raise BankError(f"{path} is too short to be a bank")
+        (magic, version, self.channels, self.rate, self.chunk, self.count, self._slots,
+         self._entries, self._table, self._names, size) = HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            raise BankError(f"{path} is not a sound bank")
+        if version != VERSION:
+            raise BankError(f"{path} is a version {version} bank, this reads version {VERSION}")
+        if size > len(self._map):
+            raise BankError(f"{path} is cut short")
+
+    def _entry(self, i):
+        return ENTRY.unpack_from(self._map, self._entries + ENTRY.size * i)
+
+    def _name(self, entry):
+        return bytes(self._map[entry[5]:entry[5] + entry[6]])
+
+    def _find(self, name):
+        """The entry for a clip name, or None."""
+        key = name.encode()
+        h = _hash(key)
+        mask = self._slots - 1
+        slot = h & mask
+        while True:
+            stored, index = SLOT.unpack_from(self._map, self._table + SLOT.size * slot)
+            if not index:
+                return None
+            if stored == h:
+                entry = self._entry(index - 1)
+                if self._name(entry) == key:
+                    return entry
+            slot = (slot + 1) & mask
+
+    def names(self):
+        """Names of every clip, in the order they were packed."""
+        return [self._name(self._entry(i)).decode() for i in range(self.count)]
+
+    def path_of(self, name):
+        """Path a clip goes by, as if the bank were a directory."""
+        return os.path.join(self.path, name)
+
+    def clip(self, name):
+        """Args:
+            name (str): the clip's file name when it was packed
+
+        Returns:
+            BankClip: the clip, or None if it isn't in the bank
+        """
+        entry = self._find(name)
+        if entry is None:
+            return None
+        return BankClip(self, self.path_of(name), entry[0], entry[1])
+
+    def get(self, name):
+        """Same as EnvelopeIndex.get(), with views into the bank.
+
+        Returns:
+            dict: chunk, envelope, decisions, peak, mean and beak, or None
+        """
+        entry = self._find(name)
+        if entry is None:
+            return None
+        data, nframes, decisions, env, nchunks, _, _, peak, mean, nbeak, beak = entry
+        return {
+            "chunk": self.chunk,
+            "envelope": np.frombuffer(self._map, dtype='<f4', count=nchunks, offset=env),
+            "decisions": np.frombuffer(self._map, dtype=np.uint8, count=nchunks, offset=decisions),
+            "peak": peak,
+            "mean": mean,
+            "beak": np.frombuffer(self._map, dtype='<u4', count=2 * nbeak, offset=beak).reshape(nbeak, 2),
+        }
+
+    def close(self):
+        try:
+            self._map.close()
+        except BufferError:
+            # A clip is still out there, the mapping goes when it does
+            pass
+
+
+class _Envelopes:
+    """Looks up the analysis in the banks for clips in them, and in the
+    EnvelopeIndex for everything else."""
+    def __init__(self, banks, index) -> None:
+        self.banks = banks
+        self.index = index
+        self.chunk = index.chunk
+
+    def _bank(self, filename):
+        path = os.path.abspath(filename)
+        return self.banks.get(os.path.dirname(path)), os.path.basename(path)
+
+    def get(self, filename):
+        bank, name = self._bank(filename)
+        if bank is None:
+            return self.index.get(filename)
+        if bank.chunk != self.chunk:
+            return None
+        return bank.get(name)
+
+    def add(self, filename):
+        return self.index.add(filename)
+
+    def update(self, filenames, workers=None):
+        return self.index.update(filenames, workers)
+
+    def save(self):
+        self.index.save()
+
+
+class BankLibrary(SoundLibrary):
+    """A SoundLibrary where any of the directories can be a bank file instead.
+    Clips in a bank go by the bank's path plus their name, as if the bank were
+    a directory. Banks don't change while running, the directories still get
+    watched.
+
+    Args:
+        directories (list): directories full of wav files, or bank files
+        envelopes (EnvelopeIndex): where the amplitude analysis lives
+        budget (int): bytes of decoded clips from directories to keep in RAM
+    """
+    def __init__(self, directories, envelopes=None, budget=BUDGET) -> None:
+        banks = [d for d in directories if is_bank(d)]
+        super().__init__([d for d in directories if d not in banks], envelopes, budget)
+        self.banks = {}
+        for path in banks:
+            bank = SoundBank(path)
+            self.banks[bank.path] = bank
+        self.envelopes = _Envelopes(self.banks, self.envelopes)
+
+    def scan(self):
+        super().scan()
+        for bank in self.banks.values():
+            for name in bank.names():
+                analysis = bank.get(name)
+                meta = {"duration": bank.clip(name).duration, "rate": bank.rate, "channels": bank.channels,
+                        "peak": analysis["peak"], "envelope": analysis["envelope"]}
+                with self._lock:
+                    self.entries[bank.path_of(name)] = meta
+        return len(self.entries)
+
+    def load(self, path):
+        path = os.path.abspath(path)
+        bank = self.banks.get(os.path.dirname(path))
+        if bank is None:
+            return super().load(path)
+        clip = bank.clip(os.path.basename(path))
+        if clip is None:
+            raise FileNotFoundError(f"{path} isn't in the bank")
+        self.hits += 1
+        return clip
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and inspect sound banks.')
+    sub = parser.add_subparsers(dest='command', required=True)
+    make = sub.add_parser('build', help="Pack a directory of wav files into a bank.")
+    make.add_argument('directory', help="Directory with wav files.")
+    make.add_argument('-o', '--output', default=None, help="Bank to write, defaults to DIRECTORY.bank.")
+    show = sub.add_parser('list', help="List the clips in a bank.")
+    show.add_argument('bank', help="Bank file.")
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        path = build(args.directory, args.output)
+        bank = SoundBank(path)
+        print(f"Packed {bank.count} clips into {path}, {os.path.getsize(path) / 1e6:.1f} MB")
+    else:
+        bank = SoundBank(args.bank)
+        print(f"{bank.count} clips, {bank.rate} Hz, {bank.channels} channels, chunk {bank.chunk}")
+        for name in bank.names():
+            clip = bank.clip(name)
+            print(f"{name:40} {clip.duration:7.2f}s {len(bank.get(name)['decisions']):6d} chunks")
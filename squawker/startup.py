@@ -0,0 +1,155 @@
+"""Getting the bird from power on to doing stuff as quickly as possible.
+
+run.py used to do everything one thing after another: open the sound index,
+scan the sounds, make the motors, sleep a second, home the body (up to a whole
+2.2s cycle), then blink, sleep another second, then open the sound card. The
+eye/beak and body are separate motor channels with separate switches, so they
+can home at the same time, and the sound scan and sound card don't need the
+motors at all, so they run on threads while the motors move.
+
+Each phase gets timed from when the process started, and the total gets
+checked against a budget so a slow startup shows up in the logs and metrics:
+
+    squawker_startup_seconds{phase="home"} 2.31
+"""
+
+import asyncio
+import os
+import time
+from . import metrics
+
+# Seconds from the process starting to the bird being ready, past which it's
+# worth a warning. A body reset is most of it.
+BUDGET = 4.0
+
+PHASES = metrics.gauge("squawker_startup_seconds",
+                       "Seconds each startup phase took, total is process start to ready.", ("phase",))
+
+
+def process_start():
+    """When this process started, on the time.monotonic() clock, so imports
+    and the interpreter starting count too. Falls back to when the metrics
+    module got imported off Linux.
+
+    Returns:
+        float: time.monotonic() of the process starting
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name can have spaces in it, so count from after it
+            fields = f.read().rpartition(')')[2].split()
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        ticks = os.sysconf('SC_CLK_TCK')
+        age = uptime - int(fields[19]) / ticks
+        return time.monotonic() - age
+    except (OSError, ValueError, IndexError):
+        return metrics.START
+
+
+class Timer:
+    """Times the startup phases.
+
+    Args:
+        start (float): time.monotonic() to count the total from
+    """
+    def __init__(self, start = None) -> None:
+        self.start = process_start() if start is None else start
+        self.phases = {}
+
+    async def timed(self, name, awaitable):
+        """Awaits something, recording how long it took under name."""
+        began = time.monotonic()
+        try:
+            return await awaitable
+        finally:
+            self.phases[name] = time.monotonic() - began
+            PHASES.set(self.phases[name], phase=name)
+
+    def done(self, budget = BUDGET):
+        """Records the total and complains if it's over budget.
+
+        Args:
+            budget (float): seconds the whole startup should fit in
+
+        Returns:
+            float: seconds from the process starting until now
+        """
+        total = time.monotonic() - self.start
+        PHASES.set(total, phase="total")
+        parts = ", ".join(f"{name} {took:.2f}s" for name, took in self.phases.items())
+        print(f"Ready {total:.2f}s after starting ({parts})")
+        if total > budget:
+            print(f"Startup took {total:.2f}s, over the {budget:.1f}s budget")
+        return total
+
+
+async def home(beak, body):
+    """Homes the eyes and the body at the same time. A motor that doesn't
+    find its switch in time gets stopped and left where it is, rather than
+    keeping the rest of the bird from starting.
+    """
+    print("Initialize motors to a known position")
+    results = await asyncio.gather(body.resetbody_async(), beak.fullblink_async(),
+                                   return_exceptions=True)
+    for part, result in zip(("body", "eyes"), results):
+        if isinstance(result, asyncio.TimeoutError):
+            print(f"Couldn't home the {part}, its switch never came round")
+        elif isinstance(result, BaseException):
+            raise result
+
+
+def _library(directories, cache = None):
+    # Amplitude analysis happens here, once, instead of in the audio loop.
+    # New or changed files get analyzed and saved for next time. numpy and
+    # the rest get imported here too, on this thread, while the motors home.
+    from . import soundbank
+    from .envelope import EnvelopeIndex
+    from .library import SoundLibrary, BUDGET as CACHE_BUDGET
+    if cache is None:
+        cache = CACHE_BUDGET
+    envelopes = EnvelopeIndex.load()
+    if any(soundbank.is_bank(d) for d in directories):
+        library = soundbank.BankLibrary(directories, envelopes, cache)
+    else:
+        library = SoundLibrary(directories, envelopes, cache)
+    count = library.scan()
+    print(f"Sound library ready with {count} clips")
+    return library
+
+
+def _audio():
+    # Same again for the audio stack
+    from . import audioengine
+    return audioengine.get_engine()
+
+
+async def start(beak, body, directories, cache = None, budget = BUDGET, timer = None, library = None):
+    """Homes the motors while scanning the sounds and opening the sound card.
+
+    Args:
+        beak (EyeBeakController): Motor attached to the beak/eyes
+        body (BodyController): Motor attached to the body
+        directories (list): directories of wav files for the library
+        cache (int): bytes of decoded clips to keep in RAM, None for library.BUDGET
+        budget (float): seconds the whole startup should fit in
+        timer (Timer): to carry on timing from, for phases run before this
+        library (SoundLibrary): one that's already scanned, to skip scanning
+
+    Returns:
+        SoundLibrary: the scanned library
+    """
+    timer = timer or Timer()
+    loop = asyncio.get_running_loop()
+    if library is None:
+        scanning = timer.timed("library", loop.run_in_executor(None, _library, directories, cache))
+    else:
+        scanning = asyncio.sleep(0, library)
+    library, _, _ = await asyncio.gather(
+        scanning,
+        # Open the sound card once now, rather than on every clip
+        timer.timed("audio", loop.run_in_executor(None, _audio)),
+        timer.timed("home", home(beak, body)),
+    )
+    timer.done(budget)
+    return library
@@ -0,0 +1,205 @@
+"""Finds the syllables in a clip, for the beak.
+
+The beak used to open whenever a chunk's mean amplitude got over
+envelope.BEAK_THRESHOLD, which holds it wide open through a long loud squawk
+and hardly moves it at all for a quiet clip. A mouth moves once per syllable,
+so this finds the syllables instead:
+
+    - the clip gets cut into overlapping frames (a strided view, nothing
+      copied) and each frame goes through an FFT
+    - energy in the voice band, BAND, measured against the clip's own loud
+      bits, says where there's voice at all, so quiet clips talk as much as
+      loud ones
+    - spectral flux, how much the band just got louder, marks where syllables
+      start, along with dips in the energy between them
+    - the beak opens at the start of each syllable and shuts at its end, or
+      after MAX_OPEN, so a long sound chatters instead of gaping
+
+It runs offline with the rest of envelope.analyze(), and what gets stored is
+just the open and close times in milliseconds, so playback has nothing to
+work out.
+"""
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+# STFT frame and hop, in samples
+FRAME = 1024
+HOP = 256
+# Frames go through the FFT this many at a time, so a long clip doesn't
+# need its whole spectrogram in RAM
+BLOCK = 512
+# Hz, where a voice (or a parrot doing one) has most of its energy
+BAND = (300, 3400)
+# Voice is anything within this many dB of the clip's loud level...
+RANGE_DB = 24
+LOUD_PERCENTILE = 95
+# ...that's also louder than this, in dB of full scale
+FLOOR_DB = -60
+# A syllable starts where the flux is over median + ONSET_K * MAD
+ONSET_K = 3.0
+# or where the energy dips this many dB below the peaks either side
+DIP_DB = 6
+# Seconds either side to look for flux peaks and energy dips
+NEIGHBOURHOOD = 0.05
+# Log compression for the flux, so it goes by ratios more than levels
+COMPRESS = 1000
+
+# Seconds. Anything shorter than MIN_SYLLABLE doesn't get a beak movement,
+# and the rest are what the beak motor can keep up with
+MIN_SYLLABLE = 0.04
+MIN_OPEN = 0.08
+MAX_OPEN = 0.25
+MIN_CLOSED = 0.07
+
+
+def frames(signal, frame=FRAME, hop=HOP):
+    """Overlapping frames of a signal, as a read-only view into it.
+
+    Args:
+        signal (ndarray): 1d samples
+        frame (int): samples per frame
+        hop (int): samples between frame starts
+
+    Returns:
+        ndarray: (frames, frame) view, zero padded if the signal is shorter than a frame
+    """
+    signal = np.ascontiguousarray(signal)
+    if len(signal) < frame:
+        signal = np.pad(signal, (0, frame - len(signal)))
+    count = 1 + (len(signal) - frame) // hop
+    stride = signal.strides[0]
+    return as_strided(signal, shape=(count, frame), strides=(hop * stride, stride), writeable=False)
+
+
+def spectra(mono, rate, frame=FRAME, hop=HOP, band=BAND):
+    """Band energy and spectral flux for every frame.
+
+    Args:
+        mono (ndarray): 1d float samples, full scale is 1
+        rate (int): sample rate
+        frame (int): samples per frame
+        hop (int): samples between frames
+        band (tuple): (low, high) Hz to look at
+
+    Returns:
+        tuple: (energy in dB of full scale, flux), one of each per frame
+    """
+    view = frames(mono, frame, hop)
+    window = np.hanning(frame).astype(np.float32)
+    lo, hi = np.searchsorted(np.fft.rfftfreq(frame, 1 / rate), band)
+    # Parseval, so the band's energy comes out as its mean square
+    scale = 2.0 / (frame * np.sum(window ** 2))
+    energy = np.empty(len(view))
+    flux = np.empty(len(view))
+    last = None
+    for start in range(0, len(view), BLOCK):
+        spec = np.abs(np.fft.rfft(view[start:start + BLOCK] * window, axis=1)[:, lo:hi])
+        end = start + len(spec)
+        energy[start:end] = np.sum(spec ** 2, axis=1) * scale
+        logmag = np.log1p(spec * (COMPRESS * 2 / frame))
+        rise = np.diff(logmag, axis=0, prepend=logmag[:1] if last is None else last)
+        flux[start:end] = np.sum(np.maximum(rise, 0), axis=1)
+        last = logmag[-1:]
+    return 10 * np.log10(energy + 1e-12), flux
+
+
+def _neighbours(x, width, fill):
+    """Each value's neighbourhood, width either side, as a strided view.
+    Off the ends counts as fill."""
+    return frames(np.pad(x, width, constant_values=fill), 2 * width + 1, 1)
+
+
+def syllables(mono, rate, frame=FRAME, hop=HOP):
+    """Where the syllables are.
+
+    Args:
+        mono (ndarray): 1d float samples, full scale is 1
+        rate (int): sample rate
+        frame (int): samples per frame
+        hop (int): samples between frames
+
+    Returns:
+        list: (start, end) seconds of each syllable, in order
+    """
+    db, flux = spectra(mono, rate, frame, hop)
+    loud = db[db > FLOOR_DB]
+    if not len(loud):
+        return []
+    voiced = db > max(FLOOR_DB, np.percentile(loud, LOUD_PERCENTILE) - RANGE_DB)
+    width = max(1, int(NEIGHBOURHOOD * rate / hop))
+
+    # Flux peaks well above what's usual for this clip
+    voiced_flux = flux[voiced]
+    median = np.median(voiced_flux)
+    mad = np.median(np.absolute(voiced_flux - median))
+    around = _neighbours(flux, width, -np.inf)
+    onsets = (flux >= around.max(axis=1)) & (flux > median + ONSET_K * mad)
+
+    # Dips well below the loudest bit on either side
+    around = _neighbours(db, width, -np.inf)
+    sides = np.minimum(around[:, :width].max(axis=1), around[:, width + 1:].max(axis=1))
+    dips = (db <= around.min(axis=1)) & (sides - db >= DIP_DB)
+
+    edges = np.diff(voiced.astype(np.int8), prepend=0, append=0)
+    ends = np.flatnonzero(edges == -1)
+    starts = np.flatnonzero((edges[:-1] == 1) | ((onsets | dips) & voiced))
+    # Each one lasts until the next starts or the voice stops, whichever's first
+    stops = np.minimum(ends[np.searchsorted(ends, starts, side='right')],
+                       np.append(starts[1:], len(db)))
+    # Times are frame centres
+    centre = frame / 2 / rate
+    return list(zip(starts * hop / rate + centre, stops * hop / rate + centre))
+
+
+def beak_track(spans, min_syllable=MIN_SYLLABLE, min_open=MIN_OPEN, max_open=MAX_OPEN,
+               min_closed=MIN_CLOSED):
+    """Turns syllables into beak movements the motor can keep up with.
+
+    Args:
+        spans (list): (start, end) seconds from syllables()
+        min_syllable (float): shortest syllable worth moving for
+        min_open (float): shortest time to hold the beak open
+        max_open (float): longest, after which it shuts and opens again
+        min_closed (float): shortest time to leave it shut
+
+    Returns:
+        list: [open, close] milliseconds for each movement
+    """
+    moves = []
+    for start, end in spans:
+        t = start
+        while end - t >= min_syllable:
+            close = max(min(end, t + max_open), t + min_open)
+            if moves and t - moves[-1][1] < min_closed:
+                if t - min_closed - moves[-1][0] >= min_open:
+                    # Shut the last one early enough to open again on time
+                    moves[-1][1] = t - min_closed
+                else:
+                    # Too soon, open once the last one's been shut long enough
+                    t = moves[-1][1] + min_closed
+                    if end - t < min_syllable:
+                        break
+                    close = max(min(end, t + max_open), t + min_open)
+            moves.append([t, close])
+            t = close + min_closed
+    return [[int(round(a * 1000)), int(round(b * 1000))] for a, b in moves]
+
+
+def track(levels, rate):
+    """The beak track for a whole clip.
+
+    Args:
+        levels (ndarray): (frames, channels) or 1d samples on the 16 bit
+            scale, like WavFile.levels()
+        rate (int): sample rate
+
+    Returns:
+        list: [open, close] milliseconds, see beak_track()
+    """
+    levels = np.asarray(levels)
+    if levels.ndim > 1:
+        mono = levels.mean(axis=1, dtype=np.float32)
+    else:
+        mono = levels.astype(np.float32)
+    return beak_track(syllables(mono * (1 / 32768), rate))
@@ -0,0 +1,338 @@
+"""Flight recorder for the motors and switches.
+
+Every throttle write, GPIO edge and motor decision from the audio goes into a
+ring buffer as a fixed 16 byte record, so there's always a record of the last
+few minutes of what the bird actually did. Recording is one struct.pack_into
+into a preallocated bytearray, well under a microsecond, so it stays on all
+the time. The buffer gets written out on SIGUSR1, or when something crashes:
+
+    kill -USR1 $(pidof python)
+
+and the file can then be looked at with:
+
+    python -m squawker.trace timeline trace.bin
+    python -m squawker.trace replay trace.bin
+
+replay plays the throttle writes back into the simulated bird (in virtual
+time, so it's quick) and lines its switch edges up against the recorded ones.
+Edges that come later and later on the real bird than in the sim are the gears
+slipping or the motor slowing down, edges that are missing are a stuck switch.
+"""
+
+import argparse
+import itertools
+import os
+import signal
+import struct
+import sys
+import threading
+import time
+
+# t (monotonic ns), kind, source, value, extra
+RECORD = struct.Struct('<qBBhf')
+HEADER = struct.Struct('<4sHHIIqd')
+MAGIC = b'SQTR'
+VERSION = 1
+CAPACITY = 65536
+TRACE_PATH = os.path.expanduser("~/.cache/squawker/trace.bin")
+
+# Record kinds
+THROTTLE = 1    # source: motor, value: throttle * 1000
+EDGE = 2        # source: GPIO pin, value: level after the edge
+DECISION = 3    # value: envelope decision, extra: amplitude if it was worked out live
+LIPSYNC = 4     # source: motor, value: on
+MARK = 5        # value: whatever the caller likes, for lining traces up with logs
+KIND_NAMES = {THROTTLE: "throttle", EDGE: "edge", DECISION: "decision", LIPSYNC: "lipsync", MARK: "mark"}
+
+MOTORS = {"eye_beak": 0, "body": 1}
+MOTOR_NAMES = {v: k for k, v in MOTORS.items()}
+
+
+class Tracer:
+    """Fixed-size ring buffer of binary records.
+
+    Args:
+        capacity (int): records to keep, the oldest get overwritten
+    """
+    def __init__(self, capacity = CAPACITY) -> None:
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        # next() on a count is atomic under the GIL, so threads never get the same slot
+        self._count = itertools.count()
+        self._written = 0
+
+    def record(self, kind, source = 0, value = 0, extra = 0.0,
+               _pack=RECORD.pack_into, _now=time.monotonic_ns):
+        """Adds one record. Called from anywhere, including GPIO callbacks."""
+        i = next(self._count)
+        _pack(self.buffer, (i % self.capacity) * RECORD.size, _now(), kind, source, value, extra)
+        self._written = i + 1
+
+    def records(self):
+        """The records in the buffer, oldest first.
+
+        Returns:
+            list: (t_ns, kind, source, value, extra) tuples
+        """
+        written = self._written
+        buf = bytes(self.buffer)
+        if written <= self.capacity:
+            data = buf[:written * RECORD.size]
+        else:
+            split = (written % self.capacity) * RECORD.size
+            data = buf[split:] + buf[:split]
+        return list(RECORD.iter_unpack(data))
+
+    def dump(self, path = TRACE_PATH):
+        """Writes the buffer out.
+
+        Args:
+            path (str): where to write it
+
+        Returns:
+            int: records written
+        """
+        records = self.records()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            # Monotonic and wall clock together, so the records can be lined up with logs
+            f.write(HEADER.pack(MAGIC, VERSION, RECORD.size, len(records), self.capacity,
+                                time.monotonic_ns(), time.time()))
+            for rec in records:
+                f.write(RECORD.pack(*rec))
+        os.replace(tmp, path)
+        print(f"Wrote {len(records)} trace records to {path}")
+        return len(records)
+
+
+tracer = Tracer()
+record = tracer.record
+
+
+def throttle(motor, value):
+    """Records a throttle write.
+
+    Args:
+        motor (str): eye_beak or body
+        value (float): the throttle, None counts as 0
+    """
+    record(THROTTLE, MOTORS.get(motor, 255), int((value or 0) * 1000))
+
+
+def load(path):
+    """Reads a dumped trace.
+
+    Args:
+        path (str): file from Tracer.dump()
+
+    Returns:
+        tuple: (header dict, list of records)
+
+    Raises:
+        ValueError: not a trace file, or one from a different version
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if len(data) < HEADER.size:
+        raise ValueError(f"{path} is too short to be a trace")
+    magic, version, size, count, capacity, mono_ns, wall = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION or size != RECORD.size:
+        raise ValueError(f"{path} isn't a version {VERSION} squawker trace")
+    body = data[HEADER.size:HEADER.size + count * size]
+    header = {"count": count, "capacity": capacity, "monotonic_ns": mono_ns, "wall": wall}
+    return header, list(RECORD.iter_unpack(body))
+
+
+def install(path = TRACE_PATH, sig = signal.SIGUSR1):
+    """Dumps the trace on a signal, and when the main thread or any other
+    thread dies from an exception. Call from the main thread.
+
+    Args:
+        path (str): where dumps go
+        sig (int): signal that asks for a dump
+    """
+    def on_signal(signum, frame):
+        tracer.dump(path)
+    signal.signal(sig, on_signal)
+
+    excepthook = sys.excepthook
+    def on_crash(*exc):
+        tracer.dump(path)
+        excepthook(*exc)
+    sys.excepthook = on_crash
+
+    threadhook = threading.excepthook
+    def on_thread_crash(args):
+        tracer.dump(path)
+        threadhook(args)
+    threading.excepthook = on_thread_crash
+    print(f"Tracing, send signal {sig} to dump to {path}")
+
+
+def _describe(kind, source, value, extra):
+    if kind == THROTTLE:
+        return f"{MOTOR_NAMES.get(source, source)} throttle {value / 1000:+.2f}"
+    if kind == EDGE:
+        return f"pin {source} {'rising' if value else 'falling'}"
+    if kind == DECISION:
+        return f"decision {value}" + (f" (amplitude {extra:.1f})" if extra == extra else "")
+    if kind == LIPSYNC:
+        return f"lipsync {MOTOR_NAMES.get(source, source)} {'on' if value else 'off'}"
+    return f"{KIND_NAMES.get(kind, kind)} {source} {value} {extra}"
+
+
+def timeline(records, step = 0.02, width = 100):
+    """Renders records as lanes of text, one character per step seconds:
+    motors show > forward and < reverse, pins show the level, decisions the
+    number. Long traces get wrapped every width characters.
+
+    Args:
+        records (list): from load()
+        step (float): seconds per character
+        width (int): characters per row
+
+    Returns:
+        str: the picture
+    """
+    if not records:
+        return "Empty trace\n"
+    t0 = records[0][0]
+    end = records[-1][0]
+    steps = int((end - t0) / 1e9 / step) + 1
+    lanes = {}
+    state = {}
+    def lane(name, initial):
+        if name not in lanes:
+            lanes[name] = [None] * steps
+            state[name] = initial
+        return lanes[name]
+    # What each lane reads at each step is whatever it was last set to
+    for t, kind, source, value, extra in records:
+        i = int((t - t0) / 1e9 / step)
+        if kind == THROTTLE:
+            name = MOTOR_NAMES.get(source, str(source))
+            lane(name, ' ')[i] = '>' if value > 0 else '<' if value < 0 else ' '
+        elif kind == EDGE:
+            lane(f"pin {source}", '?')[i] = str(value)
+        elif kind == DECISION:
+            lane("decision", ' ')[i] = str(value)
+    for name, cells in lanes.items():
+        current = state[name]
+        for i, cell in enumerate(cells):
+            if cell is None:
+                cells[i] = current
+            else:
+                current = cell
+    out = []
+    label = max(len(n) for n in lanes)
+    for start in range(0, steps, width):
+        out.append(f"{'':{label}} +{start * step:.2f}s")
+        for name, cells in sorted(lanes.items()):
+            out.append(f"{name:{label}} |{''.join(cells[start:start + width])}|")
+        out.append("")
+    return "\n".join(out)
+
+
+def replay(records, body = None, eyes = None, tick = 0.005):
+    """Plays the throttle writes into the simulated bird in virtual time and
+    matches its switch edges up with the recorded ones.
+
+    Args:
+        records (list): from load()
+        body (float): body position to start the sim at, defaults to the sim's
+        eyes (float): eye cam position to start the sim at
+        tick (float): seconds of virtual time between checks for edges
+
+    Returns:
+        dict: per-pin lists of (recorded t, sim t or None) in seconds from
+        the start of the trace, plus where the sim ended up
+    """
+    from . import sim
+    clock = [records[0][0] / 1e9 if records else 0.0]
+    rig = sim.Rig(clock=lambda: clock[0])
+    if body is not None:
+        rig.body = body
+    if eyes is not None:
+        rig.eyes = eyes
+    rig.levels = {pin: read() for pin, read in rig.pins.items()}
+    gears = {MOTORS["eye_beak"]: rig.eye_gear, MOTORS["body"]: rig.body_gear}
+    t0 = clock[0]
+    seen = 0
+    edges = []
+    def run_to(t):
+        nonlocal seen
+        while clock[0] < t:
+            clock[0] = min(t, clock[0] + tick)
+            rig.advance()
+            new = rig.edgecount - seen
+            seen = rig.edgecount
+            for et, pin, level in list(rig.edgelog)[-new:] if new else []:
+                edges.append((et - t0, pin, level))
+    recorded = []
+    for t, kind, source, value, extra in records:
+        run_to(t / 1e9)
+        if kind == THROTTLE and source in gears:
+            rig.set_throttle(gears[source], value / 1000)
+        elif kind == EDGE:
+            recorded.append((t / 1e9 - t0, source, value))
+    # Let everything coast to a stop
+    run_to(clock[0] + 0.5)
+
+    matches = {}
+    used = set()
+    for rt, pin, level in recorded:
+        best = None
+        for i, (st, spin, slevel) in enumerate(edges):
+            if spin == pin and slevel == level and i not in used:
+                if best is None or abs(st - rt) < abs(edges[best][0] - rt):
+                    best = i
+        if best is not None and abs(edges[best][0] - rt) < 1.0:
+            used.add(best)
+            matches.setdefault(pin, []).append((rt, edges[best][0]))
+        else:
+            matches.setdefault(pin, []).append((rt, None))
+    extra_edges = [e for i, e in enumerate(edges) if i not in used]
+    return {"matches": matches, "unmatched_sim": extra_edges, "body": rig.body, "eyes": rig.eyes}
+
+
+def _main():
+    parser = argparse.ArgumentParser(description='Look at or replay a squawker trace.')
+    sub = parser.add_subparsers(dest='cmd', required=True)
+    show = sub.add_parser('timeline', help="Draw the trace as lanes of text.")
+    show.add_argument('trace')
+    show.add_argument('--step', type=float, default=0.02, help="Seconds per character.")
+    show.add_argument('--width', type=int, default=100, help="Characters per row.")
+    show.add_argument('--list', action='store_true', help="List every record instead.")
+    play = sub.add_parser('replay', help="Replay the throttle writes against the simulated bird.")
+    play.add_argument('trace')
+    play.add_argument('--body', type=float, default=None, help="Body position the trace started at.")
+    play.add_argument('--eyes', type=float, default=None, help="Eye cam position the trace started at.")
+    args = parser.parse_args()
+
+    header, records = load(args.trace)
+    started = header["wall"] - (header["monotonic_ns"] - records[0][0]) / 1e9 if records else header["wall"]
+    print(f"{len(records)} records from {time.ctime(started)}")
+    if args.cmd == 'timeline':
+        if args.list:
+            t0 = records[0][0] if records else 0
+            for rec in records:
+                print(f"{(rec[0] - t0) / 1e6:10.1f}ms  {_describe(*rec[1:])}")
+        else:
+            print(timeline(records, args.step, args.width))
+        return
+    result = replay(records, args.body, args.eyes)
+    for pin, pairs in sorted(result["matches"].items()):
+        offsets = [s - r for r, s in pairs if s is not None]
+        missed = sum(1 for r, s in pairs if s is None)
+        print(f"pin {pin}: {len(pairs)} recorded edges, {missed} with nothing close in the sim")
+        if offsets:
+            print(f"    sim minus real: mean {sum(offsets) / len(offsets) * 1000:+.1f}ms, "
+                  f"first {offsets[0] * 1000:+.1f}ms, last {offsets[-1] * 1000:+.1f}ms, "
+                  f"worst {max(offsets, key=abs) * 1000:+.1f}ms")
+    print(f"{len(result['unmatched_sim'])} sim edges that never happened for real")
+    print(f"Sim ended with the body at {result['body']:.1f} and the eyes at {result['eyes']:.1f}")
+
+
+if __name__ == '__main__':
+    _main()
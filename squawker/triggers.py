@@ -0,0 +1,324 @@
+"""Things that can set the bird off, like an RFID tag being read.
+
+Each source only wakes the event loop when something actually happens,
+instead of re-reading a file as fast as possible:
+
+    file:/tmp/rfid              inotify on a file (polls slowly without inotify)
+    fifo:/tmp/rfid.fifo         a named pipe, one tag per line
+    serial:/dev/ttyUSB0@9600    a serial RFID reader, one tag per line
+    evdev:/dev/input/event0     a USB RFID reader that pretends to be a keyboard
+
+Every source debounces (ignores anything right after an event) and drops
+repeats of the same tag, since readers tend to report a tag several times
+while it's held up to them.
+"""
+
+import asyncio
+import os
+import time
+from . import inotify
+
+DEBOUNCE = 0.5
+DEDUPE = 5.0
+# Seconds before reopening a pipe or device that went away, doubling up to REOPEN_MAX
+REOPEN = 0.5
+REOPEN_MAX = 30.0
+
+
+async def _readable(fd):
+    """Suspends until a file descriptor has something to read."""
+    loop = asyncio.get_running_loop()
+    ready = loop.create_future()
+    loop.add_reader(fd, lambda: ready.done() or ready.set_result(None))
+    try:
+        await ready
+    finally:
+        loop.remove_reader(fd)
+
+
+class TriggerSource:
+    """Base class for trigger sources. Subclasses provide _next(), which
+    waits for and returns the next raw tag.
+
+    Args:
+        debounce (float): seconds after an event during which everything is ignored
+        dedupe (float): seconds during which a repeat of the same tag is ignored
+    """
+    def __init__(self, debounce=DEBOUNCE, dedupe=DEDUPE) -> None:
+        self.debounce = debounce
+        self.dedupe = dedupe
+        self._last_time = None
+        self._seen = {}
+
+    def _accept(self, tag):
+        """Decides whether a raw tag counts as a new event.
+
+        Args:
+            tag (str): the raw tag
+
+        Returns:
+            bool: True if it should be passed on
+        """
+        now = time.monotonic()
+        if self._last_time is not None and now - self._last_time < self.debounce:
+            return False
+        seen = self._seen.get(tag)
+        if seen is not None and now - seen < self.dedupe:
+            return False
+        self._last_time = now
+        self._seen = {t: s for t, s in self._seen.items() if now - s < self.dedupe}
+        self._seen[tag] = now
+        return True
+
+    async def _next(self):
+        raise NotImplementedError
+
+    async def events(self):
+        """Yields tags as they come in, after debounce and de-duplication.
+
+        Yields:
+            str: tag that triggered
+        """
+        while True:
+            tag = await self._next()
+            if tag and self._accept(tag):
+                yield tag
+
+    def close(self):
+        pass
+
+
+class _LineSource(TriggerSource):
+    """A source that reads lines from a non-blocking file descriptor.
+    Subclasses provide _open(), which sets self.fd."""
+    def __init__(self, debounce=DEBOUNCE, dedupe=DEDUPE) -> None:
+        super().__init__(debounce, dedupe)
+        self.fd = -1
+        self._buf = b''
+        self._lines = []
+
+    def _open(self):
+        raise NotImplementedError
+
+    def _fill(self):
+        """Reads whatever's waiting.
+
+        Returns:
+            bool: False at end of file
+        """
+        try:
+            data = os.read(self.fd, 1024)
+        except BlockingIOError:
+            return True
+        if not data:
+            return False
+        self._buf += data
+        *lines, self._buf = self._buf.replace(b'\r', b'\n').split(b'\n')
+        self._lines.extend(line.decode(errors='replace').strip() for line in lines if line.strip())
+        return True
+
+    async def _reopen(self):
+        """The writer went away or the device got unplugged. An fd at end of
+        file always reads as ready, so waiting on it again would spin, close
+        it and keep trying to open it again instead."""
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+        self._buf = b''
+        delay = REOPEN
+        while True:
+            print(f"{type(self).__name__} went away, reopening in {delay:.1f}s")
+            await asyncio.sleep(delay)
+            try:
+                self._open()
+                return
+            except OSError as e:
+                print(f"Couldn't reopen {type(self).__name__}: {e}")
+                delay = min(delay * 2, REOPEN_MAX)
+
+    async def _next(self):
+        while not self._lines:
+            await _readable(self.fd)
+            try:
+                alive = self._fill()
+            except OSError:
+                # Like EIO from a serial adapter that got pulled out
+                alive = False
+            if not alive:
+                await self._reopen()
+        return self._lines.pop(0)
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class FileTrigger(TriggerSource):
+    """Waits for something to write a tag into a file, like the original
+    /tmp/rfid hack. The file is emptied after each read.
+
+    Args:
+        path (str): file to watch
+        poll (float): how often to look when inotify isn't available
+    """
+    def __init__(self, path='/tmp/rfid', poll=0.25, debounce=DEBOUNCE, dedupe=DEDUPE) -> None:
+        super().__init__(debounce, dedupe)
+        self.path = path
+        self.poll = poll
+        with open(path, 'a'):
+            pass
+        self._inotify = None
+        if inotify.available():
+            # Watch the directory so it still works if the file gets replaced
+            self._inotify = inotify.Inotify()
+            self._inotify.add_watch(os.path.dirname(os.path.abspath(path)),
+                                    inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO | inotify.IN_CREATE)
+
+    def _take(self):
+        try:
+            # Only open for writing when there's something to clear, since
+            # closing a writable file fires another inotify event
+            with open(self.path, 'r') as f:
+                text = f.read().strip()
+            if text:
+                with open(self.path, 'w'):
+                    pass
+        except FileNotFoundError:
+            return ''
+        return text
+
+    async def _next(self):
+        name = os.path.basename(self.path)
+        while True:
+            text = self._take()
+            if text:
+                return text
+            if self._inotify is None:
+                await asyncio.sleep(self.poll)
+                continue
+            while not any(n == name for wd, mask, n in await self._inotify.wait()):
+                pass
+
+    def close(self):
+        if self._inotify is not None:
+            self._inotify.close()
+
+
+class FifoTrigger(_LineSource):
+    """Reads tags, one per line, from a named pipe, creating it if needed.
+
+    Args:
+        path (str): the fifo
+    """
+    def __init__(self, path='/tmp/rfid.fifo', debounce=DEBOUNCE, dedupe=DEDUPE) -> None:
+        super().__init__(debounce, dedupe)
+        self.path = path
+        self._keepalive = -1
+        self._open()
+
+    def _open(self):
+        if not os.path.exists(self.path):
+            os.mkfifo(self.path)
+        self.fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        # Holding a write end open ourselves means the pipe never reads as
+        # EOF when a writer goes away, which would otherwise wake us forever.
+        if self._keepalive >= 0:
+            os.close(self._keepalive)
+        self._keepalive = os.open(self.path, os.O_WRONLY | os.O_NONBLOCK)
+
+    def close(self):
+        super().close()
+        if self._keepalive >= 0:
+            os.close(self._keepalive)
+            self._keepalive = -1
+
+
+class SerialTrigger(_LineSource):
+    """Reads tags from a serial RFID reader that sends one ID per line.
+
+    Args:
+        device (str): serial device, like /dev/ttyUSB0
+        baud (int): baud rate
+    """
+    def __init__(self, device='/dev/ttyUSB0', baud=9600, debounce=DEBOUNCE, dedupe=DEDUPE) -> None:
+        super().__init__(debounce, dedupe)
+        self.device = device
+        self.baud = baud
+        self._open()
+
+    def _open(self):
+        import termios
+        import tty
+        self.fd = os.open(self.device, os.O_RDONLY | os.O_NOCTTY | os.O_NONBLOCK)
+        tty.setraw(self.fd)
+        attrs = termios.tcgetattr(self.fd)
+        speed = getattr(termios, f'B{self.baud}')
+        attrs[4] = attrs[5] = speed
+        termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
+
+
+class EvdevTrigger(TriggerSource):
+    """Reads tags from a USB RFID reader that shows up as a keyboard and
+    types the ID followed by Enter. Needs the evdev package.
+
+    Args:
+        device (str): input device, like /dev/input/event0
+    """
+    def __init__(self, device='/dev/input/event0', debounce=DEBOUNCE, dedupe=DEDUPE) -> None:
+        try:
+            import evdev
+        except ImportError:
+            raise ImportError("EvdevTrigger needs the evdev package (pip install evdev)")
+        super().__init__(debounce, dedupe)
+        self._evdev = evdev
+        self.device = evdev.InputDevice(device)
+        # Stop the reader's typing from ending up anywhere else
+        self.device.grab()
+        self._events = self.device.async_read_loop()
+
+    async def _next(self):
+        ecodes = self._evdev.ecodes
+        typed = ''
+        async for event in self._events:
+            if event.type != ecodes.EV_KEY or event.value != 1:
+                continue
+            key = ecodes.KEY.get(event.code, '')
+            if isinstance(key, list):
+                key = key[0]
+            if key in ('KEY_ENTER', 'KEY_KPENTER'):
+                return typed
+            if key.startswith('KEY_') and len(key) == 5:
+                typed += key[4:]
+
+    def close(self):
+        self.device.ungrab()
+        self.device.close()
+
+
+SOURCES = {
+    "file": FileTrigger,
+    "fifo": FifoTrigger,
+    "serial": SerialTrigger,
+    "evdev": EvdevTrigger,
+}
+
+
+def from_spec(spec, debounce=DEBOUNCE, dedupe=DEDUPE):
+    """Makes a trigger source from a "kind:path" string, see the module docstring.
+
+    Args:
+        spec (str): like file:/tmp/rfid or serial:/dev/ttyUSB0@9600
+        debounce (float): debounce time for the source
+        dedupe (float): repeat window for the source
+
+    Returns:
+        TriggerSource: the source
+    """
+    kind, _, path = spec.partition(':')
+    if kind not in SOURCES or not path:
+        raise ValueError(f"Bad trigger {spec}, expected one of {', '.join(SOURCES)} followed by :path")
+    if kind == "serial" and '@' in path:
+        path, baud = path.rsplit('@', 1)
+        return SerialTrigger(path, int(baud), debounce, dedupe)
+    return SOURCES[kind](path, debounce=debounce, dedupe=dedupe)
@@ -0,0 +1,310 @@
+"""A bird that lives on a virtual clock, for soak testing (see soak.py).
+
+run.py's coroutines spend nearly all their time in asyncio.sleep() for 4 to
+60 seconds at a time, so hours of behaviour is only a few thousand events.
+VirtualLoop is an asyncio event loop whose clock jumps straight to the next
+timer instead of waiting for it, and the controllers here stand in for
+EyeBeakController, BodyController and Squawk with the same async methods,
+taking as long as the real ones would in virtual time (from the sim's
+mechanism numbers and BodyEstimator's timing model) but never touching a
+thread, a motor or the sound card.
+
+Everything that would drive a motor or the speaker goes through a Ledger,
+which keeps who had what and when, and notices when two things drive the same
+motor at once.
+"""
+
+import asyncio
+import random
+from . import envelope, lipsync, motors, sim
+from .bodyposition import BodyEstimator
+from .triggers import TriggerSource
+
+# Seconds for the eye cam to go from open to closed or back, half an eye cycle
+HALF_BLINK = sim.EYE_CYCLE / 2 / (sim.BODY_MAX / sim.CYCLE)
+
+
+class _WarpSelector:
+    """Wraps the loop's selector so that, with nothing ready, waiting for a
+    timeout moves the virtual clock on by that much instead."""
+    def __init__(self, selector, loop) -> None:
+        self._selector = selector
+        self._loop = loop
+
+    def select(self, timeout=None):
+        ready = self._selector.select(0)
+        if ready or timeout == 0:
+            return ready
+        if timeout is None:
+            # Nothing scheduled and nothing ready, so nothing ever will be
+            raise RuntimeError("Virtual loop has nothing left to wait for")
+        self._loop._now += timeout
+        return []
+
+    def __getattr__(self, attr):
+        return getattr(self._selector, attr)
+
+
+class VirtualLoop(asyncio.SelectorEventLoop):
+    """An event loop where time only passes when everything's waiting for it.
+    Anything using a thread or a real file descriptor will still work, but
+    won't get any time to do it in, so keep to asyncio.sleep().
+
+    Args:
+        start (float): virtual time to start from
+    """
+    def __init__(self, start=0.0) -> None:
+        super().__init__()
+        self._now = start
+        self._selector = _WarpSelector(self._selector, self)
+
+    def time(self):
+        return self._now
+
+
+class Ledger:
+    """Who drove what, and when.
+
+    Args:
+        loop (VirtualLoop): whose clock to go by
+    """
+    def __init__(self, loop) -> None:
+        self.loop = loop
+        # resource -> (since, owner) while it's on
+        self.on = {}
+        # resource -> list of (start, end, owner)
+        self.intervals = {}
+        # (time, resource, holder, owner)
+        self.violations = []
+
+    def start(self, resource, owner):
+        now = self.loop.time()
+        held = self.on.get(resource)
+        if held is not None:
+            if held[1] != owner:
+                self.violations.append((now, resource, held[1], owner))
+            return
+        self.on[resource] = (now, owner)
+
+    def stop(self, resource, owner):
+        held = self.on.get(resource)
+        if held is None or held[1] != owner:
+            return
+        del self.on[resource]
+        self.intervals.setdefault(resource, []).append((held[0], self.loop.time(), owner))
+
+    def close(self):
+        """Ends anything still on, for the totals."""
+        for resource, (_, owner) in list(self.on.items()):
+            self.stop(resource, owner)
+
+    def on_time(self, resource):
+        """Seconds a resource spent on."""
+        return sum(end - start for start, end, _ in self.intervals.get(resource, []))
+
+    def gaps(self):
+        """Stretches where nothing at all was on.
+
+        Returns:
+            list: (start, length) of each gap, in time order
+        """
+        busy = sorted((s, e) for spans in self.intervals.values() for s, e, _ in spans)
+        gaps = []
+        until = None
+        for start, end in busy:
+            if until is not None and start > until:
+                gaps.append((until, start - until))
+            until = end if until is None else max(until, end)
+        return gaps
+
+
+class VirtualBeak:
+    """Stands in for EyeBeakController.
+
+    Args:
+        ledger (Ledger): where the motor time goes
+    """
+    def __init__(self, ledger) -> None:
+        self.ledger = ledger
+        self.eyes = 'open'
+        self.blinks = 0
+        self._lock = None
+
+    @property
+    def motor_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    async def idle(self):
+        async with self.motor_lock:
+            pass
+
+    def get_eye_state(self):
+        return self.eyes
+
+    async def halfblink_async(self):
+        async with self.motor_lock:
+            self.ledger.start("eye_beak", "blink")
+            try:
+                await asyncio.sleep(HALF_BLINK)
+                self.eyes = 'closed' if self.eyes == 'open' else 'open'
+            finally:
+                self.ledger.stop("eye_beak", "blink")
+        return self.eyes
+
+    async def set_eyes_async(self, state):
+        while self.eyes != state:
+            await self.halfblink_async()
+        if state == 'open':
+            self.blinks += 1
+        return self.eyes
+
+    async def fullblink_async(self):
+        await self.set_eyes_async('closed')
+        return await self.set_eyes_async('open')
+
+
+class VirtualBody:
+    """Stands in for BodyController, with moves timed by a BodyEstimator that
+    never sees a switch edge, so it keeps its starting guesses.
+
+    Args:
+        ledger (Ledger): where the motor time goes
+    """
+    MAX = motors.BodyController.MAX
+    DRIFT_PER_MOVE = motors.BodyController.DRIFT_PER_MOVE
+    DRIFT_PER_UNIT = motors.BodyController.DRIFT_PER_UNIT
+    _moveparams = motors.BodyController._moveparams
+    drift_for = motors.BodyController.drift_for
+
+    def __init__(self, ledger) -> None:
+        self.ledger = ledger
+        self.estimator = BodyEstimator(None, self.DRIFT_PER_MOVE, self.DRIFT_PER_UNIT)
+        self.position = 0.0
+        self.drift = 0.0
+        self.moves = 0
+        self.resets = 0
+        self._last = 0
+        self._lock = None
+
+    @property
+    def motor_lock(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        return self._lock
+
+    @property
+    def timeposition(self):
+        return int(round(self.position)) % self.MAX
+
+    async def idle(self):
+        async with self.motor_lock:
+            pass
+
+    async def _run(self, units, direction):
+        """Runs the motor for as long as units takes, or until cancelled.
+
+        Returns:
+            float: units travelled
+        """
+        seconds = self.estimator.time_for(units, direction, self._last == -direction)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        self.ledger.start("body", "body")
+        try:
+            await asyncio.sleep(seconds)
+            return units
+        finally:
+            self.ledger.stop("body", "body")
+            self._last = direction
+            # Cut short, it got part of the way
+            done = units * min(1.0, (loop.time() - started) / seconds) if seconds else units
+            to_zero = (self.MAX - self.position) % self.MAX or self.MAX if direction == 1 else self.position
+            if done >= to_zero:
+                self.drift = self.drift_for(done - to_zero, 0)
+            else:
+                self.drift += self.drift_for(done)
+            self.position = (self.position + direction * done) % self.MAX
+
+    async def move_to(self, dst = 0, d = None, mx = 222):
+        async with self.motor_lock:
+            if dst == self.timeposition:
+                return
+            units, direction = self._moveparams(self.timeposition, dst, mx)
+            if d is not None and d != direction:
+                units, direction = mx - units, d
+            self.moves += 1
+            await self._run(units, direction)
+
+    async def resetbody_async(self):
+        async with self.motor_lock:
+            self.resets += 1
+            await self._run((self.MAX - self.position) % self.MAX or self.MAX, 1)
+            self.position = 0.0
+            self.drift = 0.0
+
+
+class VirtualSquawk:
+    """Stands in for Squawk. Plays nothing, but runs the beak and body off
+    the clip's envelope for as long as the clip lasts.
+
+    Args:
+        beak (VirtualBeak): the beak
+        body (VirtualBody): the body
+        library (SoundLibrary): where the clip lengths and envelopes come from
+    """
+    def __init__(self, beak, body, library) -> None:
+        self.beak = beak
+        self.body = body
+        self.library = library
+        self.ledger = beak.ledger
+        self.played = 0
+
+    def play(self, filename, trigger=None):
+        return asyncio.ensure_future(self._play(filename))
+
+    async def _play(self, filename):
+        entry = self.library.entries.get(filename)
+        analysis = self.library.envelopes.get(filename) or envelope.analyze(filename)
+        duration = entry["duration"]
+        chunk_seconds = analysis["chunk"] / entry["rate"]
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self.played += 1
+        self.ledger.start("audio", "sound")
+        try:
+            for t, motor, on in lipsync.schedule(analysis["decisions"], chunk_seconds,
+                                                  beak=analysis.get("beak")):
+                await asyncio.sleep(max(0.0, start + t - loop.time()))
+                resource = "eye_beak" if motor == "beak" else "body"
+                if on:
+                    self.ledger.start(resource, "sound")
+                else:
+                    self.ledger.stop(resource, "sound")
+            await asyncio.sleep(max(0.0, start + duration - loop.time()))
+        finally:
+            self.ledger.stop("eye_beak", "sound")
+            self.ledger.stop("body", "sound")
+            self.ledger.stop("audio", "sound")
+        return float(analysis["mean"])
+
+
+class VirtualTrigger(TriggerSource):
+    """RFID taps at random, on average every `every` seconds.
+
+    Args:
+        every (float): mean seconds between taps
+        rng (Random): where the randomness comes from
+    """
+    def __init__(self, every, rng=None) -> None:
+        # Debounce and dedupe go by the real clock, which barely moves
+        super().__init__(debounce=0, dedupe=0)
+        self.every = every
+        self.rng = rng or random.Random()
+        self.taps = 0
+
+    async def _next(self):
+        await asyncio.sleep(self.rng.expovariate(1 / self.every))
+        self.taps += 1
+        return f"virtual-{self.taps}"
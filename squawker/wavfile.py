@@ -0,0 +1,190 @@
+"""Memory-mapped wav reader.
+
+The wave module hands out a new bytes object for every readframes() call and
+only really copes with 16 bit files. This maps the whole file, reads the RIFF
+header itself and hands out numpy views straight into the mapping, so playing
+a long clip doesn't allocate anything per chunk.
+
+Handles 8 bit unsigned, 16/24/32 bit signed and 32/64 bit float samples, in
+plain PCM, IEEE float or WAVE_FORMAT_EXTENSIBLE files.
+"""
+
+import mmap
+import struct
+import numpy as np
+
+WAVE_FORMAT_PCM = 0x0001
+WAVE_FORMAT_IEEE_FLOAT = 0x0003
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+class WavError(ValueError):
+    """The file isn't a wav file this can play."""
+
+
+_PCM_DTYPES = {1: np.dtype('u1'), 2: np.dtype('<i2'), 4: np.dtype('<i4')}
+_FLOAT_DTYPES = {4: np.dtype('<f4'), 8: np.dtype('<f8')}
+
+
+class WavFile:
+    """An open, memory-mapped wav file.
+
+    Args:
+        path (str): Path to the wave file
+
+    Raises:
+        WavError: not a RIFF/WAVE file or an unsupported format
+    """
+    def __init__(self, path) -> None:
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            self._file.close()
+            raise WavError(f"{path} is empty")
+        try:
+            self._parse()
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self):
+        buf = self._map
+        if len(buf) < 12 or buf[0:4] != b'RIFF' or buf[8:12] != b'WAVE':
+            raise WavError(f"{self.path} is not a RIFF/WAVE file")
+        fmt = None
+        data = None
+        pos = 12
+        while pos + 8 <= len(buf):
+            cid, size = struct.unpack_from('<4sI', buf, pos)
+            body = pos + 8
+            if cid == b'fmt ':
+                fmt = (body, size)
+            elif cid == b'data':
+                # Some writers leave the size at 0 or too big, trust the file length
+                size = min(size, len(buf) - body) if size else len(buf) - body
+                data = (body, size)
+            # Chunks are padded to an even length
+            pos = body + size + (size & 1)
+        if fmt is None or data is None:
+            raise WavError(f"{self.path} is missing its fmt or data chunk")
+
+        body, size = fmt
+        if size < 16:
+            raise WavError(f"{self.path} has a short fmt chunk")
+        tag, channels, rate, byterate, align, bits = struct.unpack_from('<HHIIHH', buf, body)
+        if tag == WAVE_FORMAT_EXTENSIBLE:
+            if size < 40:
+                raise WavError(f"{self.path} has a short extensible fmt chunk")
+            # The real format is the first two bytes of the SubFormat GUID
+            valid_bits, mask, subtag = struct.unpack_from('<HIH', buf, body + 18)
+            tag = subtag
+        if channels < 1 or align != channels * ((bits + 7) // 8):
+            raise WavError(f"{self.path} has an inconsistent fmt chunk")
+
+        self.channels = channels
+        self.rate = rate
+        self.sampwidth = align // channels
+        self.bits = bits
+        if tag == WAVE_FORMAT_PCM and self.sampwidth in (1, 2, 3, 4):
+            self.format = 'pcm'
+            self._raw = np.dtype((np.uint8, 3)) if self.sampwidth == 3 else _PCM_DTYPES[self.sampwidth]
+        elif tag == WAVE_FORMAT_IEEE_FLOAT and self.sampwidth in _FLOAT_DTYPES:
+            self.format = 'float'
+            self._raw = _FLOAT_DTYPES[self.sampwidth]
+        else:
+            raise WavError(f"{self.path}: unsupported format {tag:#x} at {bits} bits")
+
+        body, size = data
+        self.nframes = size // align
+        self.data_offset = body
+        self.frames = np.frombuffer(buf, dtype=self._raw, count=self.nframes * channels,
+                                    offset=body).reshape(self.nframes, channels, *self._raw.shape)
+
+    @property
+    def dtype(self):
+        """numpy dtype of the arrays samples() returns. 24 bit comes out as int32."""
+        if self.sampwidth == 3:
+            return np.dtype('<i4')
+        return self._raw
+
+    @property
+    def duration(self):
+        """Length of the clip in seconds."""
+        return self.nframes / self.rate
+
+    def chunks(self, n):
+        """Yields views of n frames at a time, straight out of the mapping.
+
+        Args:
+            n (int): frames per chunk
+
+        Yields:
+            ndarray: (frames, channels) view, the last one may be short
+        """
+        for start in range(0, self.nframes, n):
+            yield self.frames[start:start + n]
+
+    def samples(self, view):
+        """Turns a chunk view into plain samples. No copy except for 24 bit,
+        which gets widened to left-justified int32.
+
+        Args:
+            view (ndarray): from chunks()
+
+        Returns:
+            ndarray: (frames, channels) of self.dtype
+        """
+        if self.sampwidth != 3:
+            return view
+        wide = np.zeros(view.shape[:2] + (4,), dtype=np.uint8)
+        wide[..., 1:] = view
+        return wide.view('<i4')[..., 0]
+
+    def levels(self, view):
+        """The chunk's samples on the 16 bit scale the amplitude thresholds
+        were tuned for. No copy for 16 bit files.
+
+        Args:
+            view (ndarray): from chunks()
+
+        Returns:
+            ndarray: samples scaled like int16
+        """
+        samples = self.samples(view)
+        if samples.dtype == np.int16:
+            return samples
+        if self.format == 'float':
+            return samples * 32768.0
+        if self.sampwidth == 1:
+            return (samples.astype(np.int16) - 128) * 256
+        return samples * (1.0 / 65536)
+
+    def raw(self, view):
+        """Bytes of a chunk view for the audio output, without copying.
+
+        Args:
+            view (ndarray): from chunks()
+
+        Returns:
+            memoryview: the chunk's bytes
+        """
+        return memoryview(view).cast('B')
+
+    def close(self):
+        self.frames = None
+        if getattr(self, '_map', None) is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                # A view is still out there, the mapping goes when it does
+                pass
+            self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()